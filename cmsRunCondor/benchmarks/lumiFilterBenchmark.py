@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Benchmark lumi mask & run range filtering on a synthetic dataset.
+
+Compares the old per-file LumiList functions (filter_by_lumi_list,
+filter_by_run_num) against the FileCatalog sweep, with and without numpy,
+and checks they all give the same result.
+
+Needs a CMSSW environment (for LumiList).
+"""
+
+
+import os
+import sys
+import random
+import argparse
+from time import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cmsRunCondor as crc
+
+
+def make_dataset(n_files, n_runs, seed):
+    """Make a list of synthetic DatasetFiles, each with a few runs and LS ranges.
+    Like real data, each run's lumisections are spread over consecutive files."""
+    rng = random.Random(seed)
+    files = []
+    run = 270000
+    ls = 1
+    for i in xrange(n_files):
+        compact_list = {}
+        for _ in xrange(rng.randint(1, 3)):
+            for _ in xrange(rng.randint(1, 4)):
+                n_ls = rng.randint(1, 30)
+                compact_list.setdefault(str(run), []).append([ls, ls + n_ls - 1])
+                ls += n_ls + rng.choice([0, 0, 0, 5])
+            if rng.random() < n_runs * 1. / n_files:
+                run += 1
+                ls = 1
+        files.append(crc.DatasetFile('/store/synthetic/file%d.root' % i,
+                                     crc.LumiList.LumiList(compactList=compact_list)))
+    return files
+
+
+def make_lumi_mask(files, seed):
+    """Make a 'golden JSON' with most of the lumisections in most runs"""
+    rng = random.Random(seed)
+    runs = set()
+    max_ls = {}
+    for f in files:
+        for run, lumis in f.lumi_list.getCompactList().iteritems():
+            runs.add(run)
+            max_ls[run] = max(max_ls.get(run, 0), lumis[-1][1])
+    compact_list = {}
+    for run in runs:
+        if rng.random() < 0.1:
+            continue
+        ls = 1
+        while ls < max_ls[run]:
+            n_ls = rng.randint(20, 200)
+            compact_list[run] = compact_list.get(run, []) + [[ls, ls + n_ls - 1]]
+            ls += n_ls + rng.randint(1, 10)
+    return crc.LumiList.LumiList(compactList=compact_list)
+
+
+def timed(name, func, *args):
+    start = time()
+    result = func(*args)
+    print '%-40s: %.3f s' % (name, time() - start)
+    return result
+
+
+def compact_lists(catalog):
+    return [(f.name, f.lumi_list.getCompactList()) for f in catalog.files()]
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nFiles', type=int, default=50000,
+                        help='Number of files in synthetic dataset')
+    parser.add_argument('--nRuns', type=int, default=400,
+                        help='Approximate number of runs in synthetic dataset')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    parser.add_argument('--skipLegacy', action='store_true',
+                        help="Don't run the per-file LumiList functions")
+    args = parser.parse_args(in_args)
+
+    files = timed('Make %d files' % args.nFiles, make_dataset, args.nFiles, args.nRuns, args.seed)
+    lumi_mask = make_lumi_mask(files, args.seed)
+    run_list = sorted(int(r) for r in lumi_mask.getCompactList())[::3]
+    catalog = timed('Make FileCatalog', crc.FileCatalog.from_files, files)
+    print '%d rows, %d lumisections, %d runs in mask' % (len(catalog.run), catalog.num_lumis(),
+                                                          len(lumi_mask.getCompactList()))
+
+    paths = [False]
+    if crc.np is not None:
+        paths.append(True)
+    else:
+        print 'numpy not available, skipping numpy path'
+
+    results = {}
+    for use_numpy in paths:
+        label = 'numpy' if use_numpy else 'python'
+        results[label, 'lumi'] = compact_lists(
+            timed('FileCatalog lumi mask (%s)' % label, catalog.filter_by_lumi_mask, lumi_mask, use_numpy))
+        results[label, 'run'] = compact_lists(
+            timed('FileCatalog run range (%s)' % label, catalog.filter_by_run_num, run_list, use_numpy))
+
+    if not args.skipLegacy:
+        legacy = timed('Per-file filter_by_lumi_list', crc.filter_by_lumi_list, files, lumi_mask)
+        results['legacy', 'lumi'] = [(f.name, f.lumi_list.getCompactList()) for f in legacy]
+        files = make_dataset(args.nFiles, args.nRuns, args.seed)
+        legacy = timed('Per-file filter_by_run_num', crc.filter_by_run_num, files, run_list)
+        results['legacy', 'run'] = [(f.name, f.lumi_list.getCompactList()) for f in legacy]
+
+    for kind in ['lumi', 'run']:
+        outputs = [v for k, v in results.iteritems() if k[1] == kind]
+        if any(o != outputs[0] for o in outputs):
+            print 'ERROR: %s filtering results differ!' % kind
+            return 1
+    print 'All results identical'
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Benchmark sandbox compression codecs on a synthetic CMSSW_BASE tree.
+
+For each codec in cmsRunCondor.SANDBOX_COMPRESSIONS whose command is
+installed, reports the time to build the sandbox, its size, and the time
+to extract it using the same extract_tarball function as cmsRun_worker.sh
+(so the decompression command must also be installed here).
+Also reports the time to build a cached (chunked) sandbox from scratch,
+and to rebuild it after changing one library.
+"""
+
+
+import os
+import re
+import sys
+import shutil
+import random
+import argparse
+import tempfile
+import subprocess
+from time import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cmsRunCondor as crc
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmsRun_worker.sh')
+
+
+def make_file(filename, size, rng):
+    """Make a file that compresses a bit like a shared library:
+    a mix of repeated chunks & random bytes."""
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    chunks = [os.urandom(4096) for _ in xrange(8)]
+    with open(filename, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = rng.choice(chunks) if rng.random() < 0.7 else os.urandom(4096)
+            f.write(chunk)
+            written += len(chunk)
+
+
+def make_cmssw_base(base_dir, n_libs, lib_size, n_packages, seed):
+    """Make a synthetic CMSSW area with libs, python, and src/*/*/data|interface"""
+    rng = random.Random(seed)
+    for i in xrange(n_libs):
+        size = int(lib_size * rng.uniform(0.2, 2))
+        make_file(os.path.join(base_dir, 'lib', 'slc6_amd64_gcc530', 'libPkg%d.so' % i), size, rng)
+    for i in xrange(n_packages):
+        pkg = os.path.join('Pkg%d' % (i // 4), 'Sub%d' % i)
+        with open(os.path.join(base_dir, 'lib', 'slc6_amd64_gcc530', 'Pkg%d.edmplugin' % i), 'w') as f:
+            f.write('plugin\n')
+        py_dir = os.path.join(base_dir, 'python', pkg)
+        os.makedirs(py_dir)
+        with open(os.path.join(py_dir, '__init__.py'), 'w') as f:
+            f.write('import FWCore.ParameterSet.Config as cms\n' * 200)
+        make_file(os.path.join(base_dir, 'src', pkg, 'data', 'calib.txt'), lib_size // 10, rng)
+        os.makedirs(os.path.join(base_dir, 'src', pkg, 'interface'))
+        with open(os.path.join(base_dir, 'src', pkg, 'interface', 'Sub%d.h' % i), 'w') as f:
+            f.write('class Sub%d {\n public:\n  int x;\n};\n' % i * 50)
+
+
+def extract_function():
+    """Get the extract_tarball function from the worker script"""
+    with open(WORKER_SCRIPT) as f:
+        match = re.search(r'^extract_tarball\(\) \{.*?^\}$', f.read(), re.MULTILINE | re.DOTALL)
+    return match.group(0)
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nLibs', type=int, default=100, help='Number of shared libraries')
+    parser.add_argument('--libSize', type=int, default=2000000, help='Mean library size in bytes')
+    parser.add_argument('--nPackages', type=int, default=200, help='Number of src packages')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    parser.add_argument('--codecs', nargs='+', default=['gzip', 'pigz', 'zstd', 'lz4'],
+                        choices=sorted(crc.SANDBOX_COMPRESSIONS), help='Codecs to test')
+    args = parser.parse_args(in_args)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        base_dir = os.path.join(tmp_dir, 'CMSSW_8_0_0')
+        start = time()
+        make_cmssw_base(base_dir, args.nLibs, args.libSize, args.nPackages, args.seed)
+        sandbox_files = crc.list_sandbox_files(base_dir)
+        print 'Made CMSSW area with %d files, %.1f MB in %.1f s' % (len(sandbox_files), dir_size(base_dir) / 1E6,
+                                                                  time() - start)
+        print 'Using %d threads' % crc.cpu_count()
+        print '%-6s %10s %10s %12s %14s %14s' % ('codec', 'build [s]', 'size [MB]', 'extract [s]',
+                                                 'chunked [s]', 'rebuild [s]')
+
+        extract_script = extract_function() + '\nset -o pipefail\nextract_tarball "$1" > /dev/null\n'
+        for codec in args.codecs:
+            ext, compress_cmd = crc.SANDBOX_COMPRESSIONS[codec]
+            if compress_cmd and not crc.find_executable(compress_cmd[0]):
+                print '%-6s not installed, skipping' % codec
+                continue
+            sandbox = os.path.join(tmp_dir, 'sandbox_%s%s' % (codec, ext))
+            start = time()
+            crc.create_tarball(sandbox, sandbox_files, codec)
+            build_time = time() - start
+            build_size = os.path.getsize(sandbox)
+
+            extract_dir = os.path.join(tmp_dir, 'extract_%s' % codec)
+            os.makedirs(extract_dir)
+            start = time()
+            subprocess.check_call(['bash', '-e', '-c', extract_script, 'extract', sandbox], cwd=extract_dir)
+            extract_time = time() - start
+            if dir_size(extract_dir) != sum(os.path.getsize(f) for f, _ in sandbox_files):
+                print 'ERROR: extracted %s sandbox is different' % codec
+                return 1
+            shutil.rmtree(extract_dir)
+
+            # chunked sandbox, then change one lib & rebuild
+            start = time()
+            manifest = crc.create_chunked_tarball(sandbox, sandbox_files, codec)
+            chunked_time = time() - start
+            changed_lib = [f for f, a in sandbox_files if a.endswith('.so')][0]
+            with open(changed_lib, 'ab') as f:
+                f.write('changed')
+            start = time()
+            crc.create_chunked_tarball(sandbox, sandbox_files, codec, previous_manifest=manifest)
+            rebuild_time = time() - start
+
+            print '%-6s %10.2f %10.1f %12.2f %14.2f %14.2f' % (codec, build_time, build_size / 1E6,
+                                                              extract_time, chunked_time, rebuild_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,18 +10,46 @@ Robin Aggleton 201[5|6]
 import os
 import re
 import sys
+import csv
 import json
 import math
+import gzip
+import time
+import bisect
+import shutil
+import heapq
+import hashlib
 import logging
 import tarfile
+import tempfile
+import fnmatch
 import argparse
 import subprocess
+from array import array
 from time import strftime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
 from itertools import izip_longest, izip, product
+import xml.etree.cElementTree as ElementTree
 import FWCore.PythonUtilities.LumiList as LumiList
 
 import htcondenser as ht
 
+# numpy is optional, it just makes filtering large datasets faster
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# haddaway is only needed for --haddModule
+try:
+    import haddaway
+except ImportError:
+    haddaway = None
+
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -33,6 +61,48 @@ USER_DICT = {
     'timestamp': strftime("%H%M%S")
 }
 
+# Max number of das_client.py processes to run at once
+DAS_QUERY_THREADS = 4
+# Time to wait for a DAS query (seconds). Also means that Ctrl-C works
+# whilst waiting for the result.
+DAS_QUERY_TIMEOUT = 3600
+_das_pool = None
+
+# Files at this site can be read directly from /hdfs, instead of via XRootD
+LOCAL_SITE = 'T2_UK_SGrid_Bristol'
+LOCAL_PFN_PREFIX = 'file:/hdfs/dpm/phy.bris.ac.uk/home/cms'
+
+# Directories in $CMSSW_BASE to put in the sandbox
+SANDBOX_LIB_DIRS = ['biglib', 'lib', 'module', 'python']
+# Directories anywhere in $CMSSW_BASE/src to put in the sandbox
+SANDBOX_SRC_DIRS = ['data', 'interface']
+# Files not to put in the sandbox, as well as any in $CMSSW_BASE/.sandboxignore
+# Patterns are for the path in the sandbox, or the filename if no '/'
+DEFAULT_SANDBOX_IGNORE = [
+    '*.pyc', '*.pyo', '*/__pycache__/*',  # python remakes these
+    '*~', '*.swp', '.#*', '*.orig', '*.rej',  # editor & patch files
+    '*/.git/*', '*/.svn/*', '*/CVS/*', '.gitignore',
+    '*.debug', '*.dSYM/*',  # separate debug info
+]
+# Symlinks to these are kept as symlinks in the sandbox, since they
+# exist on the worker nodes too
+SANDBOX_EXTERNAL_PREFIXES = ['/cvmfs/']
+# Change if the sandbox contents change, to invalidate cached sandboxes
+SANDBOX_VERSION = 2
+# Delete cached sandboxes not used for this many days
+SANDBOX_CACHE_DAYS = 14
+# Max uncompressed size of each separately-compressed chunk of a cached sandbox
+SANDBOX_CHUNK_SIZE = 4 * 1024 * 1024
+# Sandbox compression: (file extension, command to compress stdin to stdout).
+# gzip uses python's tarfile, the others need the command on the submit
+# & worker nodes. pigz makes normal gzip files using several threads.
+SANDBOX_COMPRESSIONS = {
+    'gzip': ('.tgz', None),
+    'pigz': ('.tgz', ['pigz', '-p', '{threads}']),
+    'zstd': ('.tar.zst', ['zstd', '-q', '-T{threads}']),
+    'lz4': ('.tar.lz4', ['lz4', '-q']),
+}
+
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
                       argparse.RawDescriptionHelpFormatter):
     """For better argparse output"""
@@ -101,6 +171,14 @@ class ArgParser(argparse.ArgumentParser):
                           type=float,
                           default=-1)
 
+        div.add_argument("--targetJobMinutes",
+                          help="Choose --unitsPerJob automatically, so each job takes about "
+                          "this many minutes. Uses the time per event measured in "
+                          "previous jobs with the same config, or by a probe job "
+                          "(see --probeEvents), and the number of events from DAS. "
+                          "Only for --dataset.",
+                          type=float)
+
         split_group = div.add_mutually_exclusive_group()
         split_group.add_argument("--splitByFiles",
                                  help='Unit = file',
@@ -109,6 +187,25 @@ class ArgParser(argparse.ArgumentParser):
                                  help='Unit = lumisection. '
                                  'Not available for --filelist',
                                  action='store_true')
+        split_group.add_argument("--splitByEvents",
+                                 help='Unit = event. Uses the number of events in each '
+                                 'lumisection from DAS, so files may be split across jobs. '
+                                 'Not available for --filelist',
+                                 action='store_true')
+
+        div.add_argument("--grouping",
+                         help="How to group files into jobs for --splitByFiles. "
+                         "'sequential' takes --unitsPerJob files at a time in DAS order. "
+                         "'lpt' (longest-processing-time first) and 'ffd' (first-fit decreasing) "
+                         "pack files into the same number of jobs so each job has a similar "
+                         "load, using the file size or number of events (see --groupingWeight). "
+                         "Only for --dataset.",
+                         choices=['sequential', 'lpt', 'ffd'],
+                         default='sequential')
+        div.add_argument("--groupingWeight",
+                         help="File property to balance between jobs for --grouping lpt|ffd.",
+                         choices=['size', 'events'],
+                         default='size')
 
         filtering = self.add_argument_group("Dataset filtering", "(Only for --dataset)")
         filtering.add_argument('--lumiMask',
@@ -118,6 +215,88 @@ class ArgParser(argparse.ArgumentParser):
                           '(or combine). Must be comma separated. '
                           'e.g. 259700,269710-259720')
 
+        das_group = self.add_argument_group("DAS lookup", "(Only for --dataset)")
+        das_group.add_argument('--dasCache',
+                               help='Directory to cache DAS query results in, so '
+                               'resubmitting the same dataset does not need to query '
+                               'DAS again. Set to "" to disable caching.',
+                               default=generate_das_cache_dir(USER_DICT))
+        das_group.add_argument('--dasCacheTTL',
+                               help='Number of hours a cached DAS result is valid for.',
+                               type=float,
+                               default=24)
+        das_group.add_argument('--refreshDAS',
+                               help='Ignore any cached DAS results and re-query DAS. '
+                               'The cache is updated with the new results.',
+                               action='store_true')
+        das_group.add_argument('--siteAware',
+                               help='Get the sites hosting each file from DAS, and group '
+                               'files at the same site into the same jobs. Files at %s '
+                               'are read directly from /hdfs instead of via XRootD.' % LOCAL_SITE,
+                               action='store_true')
+
+        timing_group = self.add_argument_group("Job timing", "(For --targetJobMinutes)")
+        timing_group.add_argument('--probeEvents',
+                                  help='Run cmsRun locally over this many events of the '
+                                  'dataset to measure the time per event. '
+                                  'Set to 0 to only use previous jobs.',
+                                  type=int,
+                                  default=0)
+        timing_group.add_argument('--timingDir',
+                                  help='Directory to store the time per event history & log '
+                                  'directories of every submission of each config in. '
+                                  'Used by --targetJobMinutes & --autoResources.',
+                                  default=generate_timing_dir(USER_DICT))
+
+        resource_group = self.add_argument_group("Job resources")
+        resource_group.add_argument('--memory',
+                                    help='Memory to request for each job',
+                                    default='2GB')
+        resource_group.add_argument('--disk',
+                                    help='Disk space to request for each job',
+                                    default='3GB')
+        resource_group.add_argument('--autoResources',
+                                    help='Request memory & disk from the peak usage of previous '
+                                    'jobs with the same config, plus --resourceMargin. Uses '
+                                    '--memory & --disk if there are no previous jobs.',
+                                    action='store_true')
+        resource_group.add_argument('--resourceMargin',
+                                    help='Fraction to add to the peak memory & disk of previous jobs, '
+                                    'and to the estimates for --haddModule jobs',
+                                    type=float,
+                                    default=0.25)
+
+        sandbox_group = self.add_argument_group("Sandbox")
+        sandbox_group.add_argument('--sandboxCache',
+                                   help='Directory to cache the sandbox of libraries etc from '
+                                   '$CMSSW_BASE in, so it is only remade when those files change. '
+                                   'Set to "" to disable caching.',
+                                   default=generate_sandbox_cache_dir(USER_DICT))
+        sandbox_group.add_argument('--sandboxStore',
+                                   help='Directory on /hdfs to store the cached sandbox in. '
+                                   'Jobs then copy it from here, and keep a copy on the worker node '
+                                   'for later jobs, instead of it being transferred with every job. '
+                                   'Needs --sandboxCache. Set to "" to transfer it with each job.',
+                                   default=generate_sandbox_store_dir(USER_DICT))
+        sandbox_group.add_argument('--sandboxCompression',
+                                   help='How to compress the sandbox. pigz and zstd use several '
+                                   'threads, lz4 is fastest but makes a larger sandbox. '
+                                   'zstd & lz4 must also be installed on the worker nodes.',
+                                   choices=['gzip', 'pigz', 'zstd', 'lz4'],
+                                   default='gzip')
+        sandbox_group.add_argument('--sandboxStripDebug',
+                                   help='Remove debug sections from shared libraries in the sandbox, '
+                                   'to make it smaller. Files can also be left out of the sandbox by '
+                                   'listing them in $CMSSW_BASE/.sandboxignore',
+                                   action='store_true')
+        sandbox_group.add_argument('--sandboxReport',
+                                   help='Print the size of the sandbox and its largest files & directories.',
+                                   action='store_true')
+        sandbox_group.add_argument('--shipRuntime',
+                                   help='Save the scramv1 runtime environment when submitting, and '
+                                   'use it in the jobs instead of running scramv1 project & '
+                                   'scramv1 runtime in every job.',
+                                   action='store_true')
 
         output_group = self.add_argument_group('OUTPUT\n'+'-'*bar_length,
                                                "Options for outputs")
@@ -141,6 +320,26 @@ class ArgParser(argparse.ArgumentParser):
                                   help="Directory to store job stdout/err/log files. "
                                   "Should be on /storage or /scratch",
                                   default=generate_log_dir(USER_DICT))
+        output_group.add_argument('--haddModule',
+                                  help="Label of output module(s) (or TFileService) to hadd "
+                                  "the output files of. Each group of jobs is merged as soon as "
+                                  "it has finished, while the other jobs are still running. "
+                                  "The final file is in --outputDir. Needs --dag.",
+                                  nargs='+')
+        output_group.add_argument('--haddSize',
+                                  help="Number of files for each hadd job, for --haddModule",
+                                  type=int,
+                                  default=20)
+        output_group.add_argument('--haddArgs',
+                                  help="Arguments to pass to hadd, for --haddModule. Any compression "
+                                  "option (-f...) is only used for the final hadd, intermediate hadds "
+                                  "use fast compression.")
+        output_group.add_argument('--haddFileMB',
+                                  help="Expected size of each job's output file in MB, for --haddModule. "
+                                  "Used to work out the memory & disk for each hadd job "
+                                  "(plus --resourceMargin).",
+                                  type=float,
+                                  default=100)
 
         other_group = self.add_argument_group("MISC\n"+'-'*bar_length)
 
@@ -165,6 +364,22 @@ def generate_log_dir(user_dict):
     return '/storage/{username}/cmsRunCondor/{datestamp}/logs'.format(**user_dict)
 
 
+def generate_das_cache_dir(user_dict):
+    return '/storage/{username}/cmsRunCondor/dasCache'.format(**user_dict)
+
+
+def generate_sandbox_cache_dir(user_dict):
+    return '/storage/{username}/cmsRunCondor/sandboxCache'.format(**user_dict)
+
+
+def generate_sandbox_store_dir(user_dict):
+    return '/hdfs/user/{username}/cmsRunCondor/sandboxes'.format(**user_dict)
+
+
+def generate_timing_dir(user_dict):
+    return '/storage/{username}/cmsRunCondor/timing'.format(**user_dict)
+
+
 def flag_mutually_exclusive_args(args, opts_a, opts_b):
     """Ensure each of the options in opts_a is incompatible with each of the options in opts_b."""
     arg_dict = vars(args)
@@ -203,12 +418,22 @@ def check_args(args):
     if not os.path.isfile(args.config):
         raise IOError("Cannot find config file %s" % args.config)
 
-    flag_mutually_exclusive_args(args, ['filelist'], ['splitByLumis', 'lumiMask', 'runRange'])
+    flag_mutually_exclusive_args(args, ['filelist'],
+                                 ['splitByLumis', 'splitByEvents', 'lumiMask', 'runRange',
+                                  'targetJobMinutes'])
 
     flag_mutually_exclusive_args(args,
                                  ['asIs', 'valgrind', 'callgrind'],
-                                 ['splitByFiles', 'splitByLumis', 'lumiMask', 'runRange',
-                                  'unitsPerJob', 'totalUnits', 'secondaryDataset'])
+                                 ['splitByFiles', 'splitByLumis', 'splitByEvents', 'lumiMask', 'runRange',
+                                  'unitsPerJob', 'totalUnits', 'secondaryDataset',
+                                  'targetJobMinutes'])
+
+    flag_mutually_exclusive_args(args, ['unitsPerJob'], ['targetJobMinutes'])
+
+    flag_mutually_exclusive_args(args, ['filelist', 'asIs', 'valgrind', 'callgrind'], ['grouping', 'siteAware'])
+
+    if args.grouping != 'sequential' and not args.splitByFiles:
+        raise RuntimeError("--grouping %s only works with --splitByFiles" % args.grouping)
 
     args.condorScript = os.path.abspath(args.condorScript)
 
@@ -223,8 +448,9 @@ def check_args(args):
         args.splitByFiles = True
 
     elif args.dataset:
-      if not args.splitByFiles and not args.splitByLumis:
-          raise RuntimeError("If using --dataset, need either --splitByFiles or --splitByLumis")
+      if not args.splitByFiles and not args.splitByLumis and not args.splitByEvents:
+          raise RuntimeError("If using --dataset, need one of --splitByFiles, "
+                             "--splitByLumis, or --splitByEvents")
 
     # for now, restrict output dir to /hdfs
     if not args.outputDir.startswith('/hdfs'):
@@ -248,7 +474,44 @@ def check_args(args):
     if args.lumiMask and not is_url(args.lumiMask):
         args.lumiMask = os.path.abspath(args.lumiMask)
 
-    for f in [args.condorScript, args.dag, args.logDir]:
+    if args.dasCache:
+        args.dasCache = os.path.abspath(args.dasCache)
+
+    args.timingDir = os.path.abspath(args.timingDir)
+
+    if args.sandboxCache:
+        args.sandboxCache = os.path.abspath(args.sandboxCache)
+
+    if args.sandboxStore:
+        args.sandboxStore = os.path.abspath(args.sandboxStore)
+        if not args.sandboxStore.startswith('/hdfs'):
+            raise RuntimeError('Sandbox store (--sandboxStore) not on /hdfs')
+        if not args.sandboxCache:
+            log.warning("--sandboxStore needs --sandboxCache, so the sandbox will be "
+                        "transferred with each job")
+            args.sandboxStore = None
+
+    compress_cmd = SANDBOX_COMPRESSIONS[args.sandboxCompression][1]
+    if compress_cmd and not find_executable(compress_cmd[0]):
+        raise RuntimeError("Cannot find %s for --sandboxCompression" % compress_cmd[0])
+
+    if args.targetJobMinutes is not None and args.targetJobMinutes <= 0:
+        raise RuntimeError("--targetJobMinutes must be > 0")
+
+    if args.resourceMargin < 0:
+        raise RuntimeError("--resourceMargin must be >= 0")
+
+    if args.haddModule:
+        if args.haddFileMB <= 0:
+            raise RuntimeError("--haddFileMB must be > 0")
+        if not args.dag:
+            raise RuntimeError("--haddModule needs --dag")
+        if haddaway is None:
+            raise RuntimeError("--haddModule needs haddaway: install this package, "
+                               "or add its directory to PYTHONPATH")
+
+    for f in [args.condorScript, args.dag, args.logDir, args.dasCache, args.timingDir,
+              args.sandboxCache]:
         if f:
             if os.path.abspath(f).startswith("/hdfs") or os.path.abspath(f).startswith("/users"):
                 raise IOError("You cannot put %s on /users or /hdfs" % f)
@@ -272,6 +535,8 @@ def is_url(path):
 class DatasetFile(object):
     """Hold info about a file in a dataset"""
 
+    __slots__ = ('name', 'lumi_list', 'parents', 'sites')
+
     def __init__(self, name, lumi_list):
         """
         Parameters
@@ -284,10 +549,454 @@ class DatasetFile(object):
         self.name = name
         self.lumi_list = lumi_list
         self.parents = []
+        self.sites = []
 
     def __repr__(self):
-        return ('DatasetFile(name={name:s}, lumi_list={lumi_list:s}, '
-                'parents={parents:s})'.format(**self.__dict__))
+        return ('DatasetFile(name={0}, lumi_list={1}, '
+                'parents={2})'.format(self.name, self.lumi_list, self.parents))
+
+
+class CatalogFile(DatasetFile):
+    """DatasetFile that is a view of one file in a FileCatalog.
+
+    Its LumiList is only made from the catalog when asked for.
+    """
+
+    __slots__ = ('catalog', 'file_id')
+
+    def __init__(self, catalog, file_id):
+        """
+        Parameters
+        ----------
+        catalog : FileCatalog
+            Catalog holding the file
+        file_id : int
+            Index of file in catalog
+        """
+        self.catalog = catalog
+        self.file_id = file_id
+        self.name = catalog.names[file_id]
+        self.parents = catalog.parents[file_id]
+        self.sites = catalog.sites[file_id]
+
+    @property
+    def lumi_list(self):
+        return self.catalog.lumi_list([self.file_id])
+
+
+# (run, LS) is encoded as a single integer key: run << LS_KEY_BITS | LS
+LS_KEY_BITS = 32
+LS_KEY_MASK = (1 << LS_KEY_BITS) - 1
+
+
+def lumi_key(run, ls):
+    """Encode run and lumisection as one integer, that sorts by run then LS"""
+    return (run << LS_KEY_BITS) | ls
+
+
+def merge_ls_ranges(ls_ranges):
+    """Sort lumisection ranges, merging any that overlap or are adjacent.
+
+    e.g. [[5, 6], [1, 3], [4, 4]] -> [[1, 6]]
+    """
+    merged = []
+    for ls_start, ls_end in sorted(ls_ranges):
+        if merged and ls_start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], ls_end)
+        else:
+            merged.append([ls_start, ls_end])
+    return merged
+
+
+class FileCatalog(object):
+    """Compact, columnar store of files and their run/lumisection ranges.
+
+    Each contiguous lumisection range is a row in the file_id, run, ls_start,
+    ls_end, and events arrays. The rows of each file are contiguous, and the
+    rows for file i are between file_offsets[i] and file_offsets[i+1].
+    Filtering works directly on these arrays, and a LumiList is only made when
+    asked for with lumi_list().
+
+    The number of events in each row is -1 if unknown. If the number of events
+    in each lumisection is known, each lumisection gets its own row.
+    The number of events and size (bytes) of each file are -1 if unknown.
+    """
+
+    __slots__ = ('names', 'parents', 'sites', 'file_events', 'file_size', 'file_offsets',
+                 'file_id', 'run', 'ls_start', 'ls_end', 'events')
+
+    def __init__(self):
+        self.names = []
+        self.parents = []
+        self.sites = []
+        self.file_events = array('l')
+        self.file_size = array('l')
+        self.file_offsets = array('l', [0])
+        self.file_id = array('l')
+        self.run = array('l')
+        self.ls_start = array('l')
+        self.ls_end = array('l')
+        self.events = array('l')
+
+    @classmethod
+    def from_files(cls, files):
+        """Make a FileCatalog from DatasetFiles"""
+        catalog = cls()
+        for f in files:
+            catalog.add_file(f.name, f.lumi_list.getCompactList())
+        return catalog
+
+    def add_file(self, name, compact_list, num_events=-1, lumi_events=None, size=-1):
+        """Add a file to the catalog.
+
+        Parameters
+        ----------
+        name : str
+            Filename
+        compact_list : {str: list[list[int, int]]}
+            Lumisection ranges for each run, as for LumiList(compactList=...)
+        num_events : int, optional
+            Number of events in the file, -1 if unknown. If lumi_events is not
+            given, these are shared out between the lumisections.
+        lumi_events : {int: {int: int}}, optional
+            Number of events in each lumisection of each run.
+        size : int, optional
+            File size in bytes, -1 if unknown.
+
+        Returns
+        -------
+        int
+            Index of file in catalog
+        """
+        file_id = len(self.names)
+        ranges = [(int(run), ls_range) for run in sorted(compact_list, key=int)
+                  for ls_range in merge_ls_ranges(compact_list[run])]
+        if lumi_events:
+            ranges = [(run, [ls, ls]) for run, ls_range in ranges
+                      for ls in xrange(ls_range[0], ls_range[1] + 1)]
+            num_events = sum(lumi_events.get(run, {}).get(ls_range[0], 0) for run, ls_range in ranges)
+        num_lumis = sum(ls_range[1] - ls_range[0] + 1 for run, ls_range in ranges)
+
+        self.names.append(name)
+        self.parents.append([])
+        self.sites.append([])
+        self.file_events.append(num_events)
+        self.file_size.append(size)
+        for run, (ls_start, ls_end) in ranges:
+            if lumi_events:
+                events = lumi_events.get(run, {}).get(ls_start, 0)
+            elif num_events >= 0:
+                events = int(round(num_events * (ls_end - ls_start + 1.) / num_lumis))
+            else:
+                events = -1
+            self.file_id.append(file_id)
+            self.run.append(run)
+            self.ls_start.append(ls_start)
+            self.ls_end.append(ls_end)
+            self.events.append(events)
+        self.file_offsets.append(len(self.run))
+        return file_id
+
+    def __len__(self):
+        return len(self.names)
+
+    def num_lumis(self):
+        """Total number of lumisections in the catalog"""
+        return sum(ls_end - ls_start + 1 for ls_start, ls_end in izip(self.ls_start, self.ls_end))
+
+    def rows(self):
+        """Iterate over (file_id, run, ls_start, ls_end) rows"""
+        return izip(self.file_id, self.run, self.ls_start, self.ls_end)
+
+    def files(self):
+        """Get list of CatalogFile, one for each file"""
+        return [CatalogFile(self, i) for i in xrange(len(self))]
+
+    def lumi_list(self, file_ids=None):
+        """Make a LumiList of the lumisections in some or all files.
+
+        Parameters
+        ----------
+        file_ids : list[int], optional
+            Indices of files to include. If None, uses all files.
+
+        Returns
+        -------
+        LumiList.LumiList
+        """
+        if file_ids is None:
+            file_ids = xrange(len(self))
+        compact_list = {}
+        for i in file_ids:
+            for row in xrange(self.file_offsets[i], self.file_offsets[i + 1]):
+                compact_list.setdefault(str(self.run[row]), []).append([self.ls_start[row], self.ls_end[row]])
+        return LumiList.LumiList(compactList=compact_list)
+
+    def rebuild(self, rows):
+        """Make a new FileCatalog from a subset of rows. Files without any rows
+        are dropped, the order of files is kept.
+
+        Parameters
+        ----------
+        rows : iterable[(int, int, int)]
+            (row index, ls_start, ls_end) for each new row, in the same order
+            as this catalog. A row can appear several times, and its
+            lumisection range can be narrowed, in which case its number of
+            events is scaled accordingly.
+
+        Returns
+        -------
+        FileCatalog
+        """
+        catalog = FileCatalog()
+        last_file_id = None
+        for row, ls_start, ls_end in rows:
+            file_id = self.file_id[row]
+            if file_id != last_file_id:
+                if last_file_id is not None:
+                    catalog.file_offsets.append(len(catalog.run))
+                catalog.names.append(self.names[file_id])
+                catalog.parents.append(self.parents[file_id])
+                catalog.sites.append(self.sites[file_id])
+                catalog.file_events.append(self.file_events[file_id])
+                catalog.file_size.append(self.file_size[file_id])
+                last_file_id = file_id
+            events = self.events[row]
+            if events > 0 and (ls_start, ls_end) != (self.ls_start[row], self.ls_end[row]):
+                events = int(round(events * (ls_end - ls_start + 1.) /
+                                   (self.ls_end[row] - self.ls_start[row] + 1)))
+            catalog.file_id.append(len(catalog.names) - 1)
+            catalog.run.append(self.run[row])
+            catalog.ls_start.append(ls_start)
+            catalog.ls_end.append(ls_end)
+            catalog.events.append(events)
+        if last_file_id is not None:
+            catalog.file_offsets.append(len(catalog.run))
+        return catalog
+
+    def filter_by_run_num(self, run_list, use_numpy=None):
+        """Make a new FileCatalog with only the runs in run_list.
+
+        Parameters
+        ----------
+        run_list : list[int]
+            List of run numbers to keep.
+        use_numpy : bool, optional
+            Use numpy to do the filtering. Default is to use it if available.
+
+        Returns
+        -------
+        FileCatalog
+        """
+        runs = set(int(r) for r in run_list)
+        if use_numpy or (use_numpy is None and np is not None):
+            run = np.frombuffer(self.run, dtype='i%d' % self.run.itemsize)
+            rows = np.nonzero(np.in1d(run, list(runs)))[0]
+            return self.rebuild(izip(rows.tolist(), np.asarray(self.ls_start)[rows].tolist(),
+                                     np.asarray(self.ls_end)[rows].tolist()))
+        return self.rebuild((row, self.ls_start[row], self.ls_end[row])
+                            for row, run in enumerate(self.run) if run in runs)
+
+    def filter_by_lumi_mask(self, lumi_mask, use_numpy=None):
+        """Make a new FileCatalog with only the run:LS in lumi_mask.
+
+        The mask and rows are merged in a single sweep, where each (run, LS)
+        is encoded as one integer key. A row is split if it overlaps
+        several mask ranges. The result is identical to using
+        filter_by_lumi_list() on each file.
+
+        Parameters
+        ----------
+        lumi_mask : LumiList.LumiList
+            LumiList of {run:[lumisections]} to filter against.
+        use_numpy : bool, optional
+            Use numpy to do the filtering. Default is to use it if available.
+
+        Returns
+        -------
+        FileCatalog
+        """
+        # mask ranges as sorted, non-overlapping keys
+        mask_starts, mask_ends = [], []
+        for run in sorted(lumi_mask.getCompactList(), key=int):
+            for ls_start, ls_end in merge_ls_ranges(lumi_mask.getCompactList()[run]):
+                mask_starts.append(lumi_key(int(run), ls_start))
+                mask_ends.append(lumi_key(int(run), ls_end))
+
+        if use_numpy or (use_numpy is None and np is not None):
+            return self._filter_by_lumi_mask_numpy(mask_starts, mask_ends)
+
+        starts = [lumi_key(run, ls) for run, ls in izip(self.run, self.ls_start)]
+        ends = [lumi_key(run, ls) for run, ls in izip(self.run, self.ls_end)]
+        matches = []
+        i_mask, n_mask = 0, len(mask_starts)
+        for row in sorted(xrange(len(starts)), key=starts.__getitem__):
+            start, end = starts[row], ends[row]
+            # rows are sorted by start, so no later row can overlap
+            # any mask range that ends before this one starts
+            while i_mask < n_mask and mask_ends[i_mask] < start:
+                i_mask += 1
+            i = i_mask
+            while i < n_mask and mask_starts[i] <= end:
+                matches.append((row, max(start, mask_starts[i]), min(end, mask_ends[i])))
+                i += 1
+        # put back into file order
+        matches.sort()
+        return self.rebuild((row, start & LS_KEY_MASK, end & LS_KEY_MASK)
+                            for row, start, end in matches)
+
+    def _filter_by_lumi_mask_numpy(self, mask_starts, mask_ends):
+        """numpy version of filter_by_lumi_mask(), takes mask ranges as sorted keys"""
+        mask_starts = np.array(mask_starts, dtype=np.int64)
+        mask_ends = np.array(mask_ends, dtype=np.int64)
+        run, ls_start, ls_end = [np.frombuffer(c, dtype='i%d' % c.itemsize).astype(np.int64)
+                                 for c in (self.run, self.ls_start, self.ls_end)]
+        starts = (run << LS_KEY_BITS) | ls_start
+        ends = (run << LS_KEY_BITS) | ls_end
+        # for each row, the mask ranges [lo, hi) overlap it
+        lo = np.searchsorted(mask_ends, starts, side='left')
+        hi = np.searchsorted(mask_starts, ends, side='right')
+        counts = np.maximum(hi - lo, 0)
+        # make one entry per (row, overlapping mask range)
+        rows = np.repeat(np.arange(len(starts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        mask_ind = np.repeat(lo, counts) + offsets
+        new_starts = np.maximum(starts[rows], mask_starts[mask_ind]) & LS_KEY_MASK
+        new_ends = np.minimum(ends[rows], mask_ends[mask_ind]) & LS_KEY_MASK
+        return self.rebuild(izip(rows.tolist(), new_starts.tolist(), new_ends.tolist()))
+
+    def head_lumis(self, num_lumis):
+        """Make a new FileCatalog with only the first num_lumis lumisections."""
+        def head_rows():
+            remaining = num_lumis
+            for row, (ls_start, ls_end) in enumerate(izip(self.ls_start, self.ls_end)):
+                if remaining <= 0:
+                    break
+                ls_end = min(ls_end, ls_start + remaining - 1)
+                remaining -= ls_end - ls_start + 1
+                yield row, ls_start, ls_end
+
+        return self.rebuild(head_rows())
+
+    def group_by_site(self, local_site=LOCAL_SITE):
+        """Reorder files so that files at the same site are next to each other.
+
+        Files at local_site come first, then files grouped by site, then
+        files with no known site. Otherwise the order of files is kept.
+
+        Parameters
+        ----------
+        local_site : str, optional
+            Site to put first
+
+        Returns
+        -------
+        FileCatalog
+        """
+        site_order = {}
+        for file_id in xrange(len(self)):
+            site = choose_site(self.sites[file_id], local_site)
+            site_order.setdefault(site, []).append(file_id)
+
+        def site_key(site):
+            return (site != local_site, site is None, site)
+
+        def site_rows():
+            for site in sorted(site_order, key=site_key):
+                for file_id in site_order[site]:
+                    for row in xrange(self.file_offsets[file_id], self.file_offsets[file_id + 1]):
+                        yield row, self.ls_start[row], self.ls_end[row]
+
+        return self.rebuild(site_rows())
+
+    def match_parents(self, lumi_index):
+        """Set the parents of each file by lumisection matching against an
+        index of the secondary (parent) dataset, in one pass over all rows.
+
+        Parameters
+        ----------
+        lumi_index : LumiIndex
+            Index of files from the secondary dataset.
+
+        Raises
+        ------
+        RuntimeError
+            If no files in `lumi_index` match a lumisection range.
+        """
+        for file_id, run, ls_start, ls_end in self.rows():
+            res = lumi_index.find(run, [ls_start, ls_end])
+            if not res:
+                raise RuntimeError('No matching RAW file for run %d LS %s' % (run, [ls_start, ls_end]))
+            parents = self.parents[file_id]
+            parents.extend(p for p in res if p not in parents)
+
+
+class LumiIndex(object):
+    """Per-run interval index of lumisection ranges -> DatasetFile.
+
+    Built once from a list of DatasetFiles or a FileCatalog, it allows fast lookup of which
+    files cover a given run:LS range, without scanning every file for every LS.
+    For each run, holds the LS ranges sorted by start, along with a running
+    maximum of the range ends, so that overlapping ranges can be found with
+    bisect.
+    """
+
+    def __init__(self, files):
+        """
+        Parameters
+        ----------
+        files : list[DatasetFile] or FileCatalog
+            Files to index. For a FileCatalog, lookups return CatalogFiles.
+        """
+        intervals = {}
+        if isinstance(files, FileCatalog):
+            records = files.files()
+            for file_id, run, ls_start, ls_end in files.rows():
+                intervals.setdefault(run, []).append((ls_start, ls_end, records[file_id]))
+        else:
+            for f in files:
+                for run, lumis in f.lumi_list.getCompactList().iteritems():
+                    for ls_start, ls_end in lumis:
+                        intervals.setdefault(int(run), []).append((ls_start, ls_end, f))
+
+        # for each run store (starts, running max of ends, ends, files)
+        self.runs = {}
+        for run, entries in intervals.iteritems():
+            entries.sort(key=lambda x: x[0])
+            max_ends, current_max = [], None
+            for entry in entries:
+                current_max = entry[1] if current_max is None else max(current_max, entry[1])
+                max_ends.append(current_max)
+            self.runs[run] = ([e[0] for e in entries], max_ends,
+                              [e[1] for e in entries], [e[2] for e in entries])
+
+    def find(self, run, ls_range):
+        """Find all files that have lumisections within ls_range for a given run.
+
+        Parameters
+        ----------
+        run : int or str
+            Run number
+        ls_range : list[int, int]
+            Edges of lumisection range to match, e.g. [610, 621]
+
+        Returns
+        -------
+        list[DatasetFile]
+            List of unique DatasetFiles that overlap ls_range.
+        """
+        if int(run) not in self.runs:
+            return []
+        starts, max_ends, ends, files = self.runs[int(run)]
+        # everything before lo ends before the range starts,
+        # everything from hi onwards starts after the range ends
+        lo = bisect.bisect_left(max_ends, ls_range[0])
+        hi = bisect.bisect_right(starts, ls_range[1])
+        matching_files = []
+        for i in xrange(lo, hi):
+            if ends[i] >= ls_range[0] and files[i] not in matching_files:
+                matching_files.append(files[i])
+        return matching_files
 
 
 def find_matching_run_ls_range(raw_files, run, ls_range):
@@ -295,8 +1004,9 @@ def find_matching_run_ls_range(raw_files, run, ls_range):
 
     Parameters
     ----------
-    raw_files : list[DatasetFile]
-        List of files to match against.
+    raw_files : LumiIndex or list[DatasetFile]
+        Files to match against. Can be a pre-built LumiIndex, which should be
+        preferred if calling this several times with the same files.
     run : int
         Run number
     ls_range : list[int, int]
@@ -307,10 +1017,9 @@ def find_matching_run_ls_range(raw_files, run, ls_range):
     list[DatasetFile]
         List of unique DatasetFiles that cover ls_range.
     """
-    matching_files = []
-    for ls in xrange(ls_range[0], ls_range[1] + 1):
-        matching_files.extend([f for f in raw_files if f.lumi_list.contains(run=run, lumiSection=ls)])
-    return list(set(matching_files))
+    if not isinstance(raw_files, LumiIndex):
+        raw_files = LumiIndex(raw_files)
+    return raw_files.find(run, ls_range)
 
 
 def find_matching_files(raw_files, lumi_list):
@@ -318,8 +1027,9 @@ def find_matching_files(raw_files, lumi_list):
 
     Parameters
     ----------
-    raw_files : list[DatasetFile]
-        List of files to match against.
+    raw_files : LumiIndex or list[DatasetFile]
+        Files to match against. Can be a pre-built LumiIndex, which should be
+        preferred if calling this several times with the same files.
     lumi_list : LumiList.LumiList
         LumiList holding {run: lumisections}
 
@@ -333,20 +1043,43 @@ def find_matching_files(raw_files, lumi_list):
     RuntimeError
         If no files in `raw_files` match the lumisection.
     """
+    if not isinstance(raw_files, LumiIndex):
+        raw_files = LumiIndex(raw_files)
     matching_files = []
     for run, lumis in lumi_list.compactList.iteritems():
         for lsr in lumis:
-            res = find_matching_run_ls_range(raw_files, run, lsr)
+            res = raw_files.find(run, lsr)
             if not res:
-                print lsr
-                print len(raw_files)
-                for rf in raw_files:
-                    print rf
-                raise RuntimeError('No matching RAW file for this LS %s' % lsr)
+                raise RuntimeError('No matching RAW file for run %s LS %s' % (run, lsr))
             matching_files.extend(res)
     return list(set(matching_files))
 
 
+def match_parent_files(list_of_files, list_of_secondary_files):
+    """Set the parents of each file in list_of_files by lumisection matching
+    against list_of_secondary_files. The secondary files are indexed once,
+    then each file is looked up in the index.
+
+    Parameters
+    ----------
+    list_of_files : iterable[DatasetFile]
+        Files from the primary (child) dataset. Their parents are modified.
+    list_of_secondary_files : LumiIndex or list[DatasetFile]
+        Files from the secondary (parent) dataset, or a LumiIndex of them.
+
+    Yields
+    ------
+    DatasetFile
+        Each file in list_of_files, with parents set
+    """
+    lumi_index = list_of_secondary_files
+    if not isinstance(lumi_index, LumiIndex):
+        lumi_index = LumiIndex(list_of_secondary_files)
+    for f in list_of_files:
+        f.parents = find_matching_files(lumi_index, f.lumi_list)
+        yield f
+
+
 def generate_filelist_filename(dataset):
     """Generate a filelist filename from a dataset name."""
     dset_uscore = dataset[1:]
@@ -444,6 +1177,122 @@ def group_files_by_lumis_per_job(list_of_lumis, lumis_per_job):
     return group_files, group_lumis
 
 
+def group_catalog_by_lumis_per_job(catalog, lumis_per_job):
+    """Makes groups of files from a FileCatalog, splitting based on lumis_per_job.
+
+    Lumisection ranges are split between jobs where necessary, so each job
+    (except the last) has exactly lumis_per_job lumisections.
+
+    Parameters
+    ----------
+    catalog : FileCatalog
+        Catalog of files & lumisections
+    lumis_per_job : int
+        Number of LS per job
+
+    Returns
+    -------
+    list[list[CatalogFile]], list[LumiList]
+        List of list of files for each job, and list of LumiList obj for each job
+    """
+    files = catalog.files()
+    group_files, group_lumis = [], []
+    job_file_ids, job_lumis, job_num_lumis = [], {}, 0
+
+    def finish_job():
+        group_files.append([files[i] for i in job_file_ids])
+        group_lumis.append(LumiList.LumiList(compactList=job_lumis))
+
+    for file_id, run, ls_start, ls_end in catalog.rows():
+        while ls_start <= ls_end:
+            this_end = min(ls_end, ls_start + lumis_per_job - job_num_lumis - 1)
+            if file_id not in job_file_ids:
+                job_file_ids.append(file_id)
+            job_lumis.setdefault(str(run), []).append([ls_start, this_end])
+            job_num_lumis += this_end - ls_start + 1
+            ls_start = this_end + 1
+            if job_num_lumis == lumis_per_job:
+                finish_job()
+                job_file_ids, job_lumis, job_num_lumis = [], {}, 0
+    if job_num_lumis:
+        finish_job()
+    return group_files, group_lumis
+
+
+def group_catalog_by_events_per_job(catalog, events_per_job, max_events=-1):
+    """Makes groups of files from a FileCatalog, splitting based on events_per_job.
+
+    Lumisections are added to a job until it has at least events_per_job
+    events, so files are split across jobs where necessary. A lumisection
+    cannot be split, so a job may have more events than events_per_job if
+    a lumisection has many events.
+    If the catalog only has the number of events for lumisection ranges,
+    they are assumed to be shared equally between the lumisections in the range.
+
+    Parameters
+    ----------
+    catalog : FileCatalog
+        Catalog of files, lumisections & events
+    events_per_job : int
+        Target number of events per job
+    max_events : int, optional
+        Stop after this many events. If < 0, use all events.
+
+    Returns
+    -------
+    list[list[CatalogFile]], list[LumiList]
+        List of list of files for each job, and list of LumiList obj for each job
+
+    Raises
+    ------
+    RuntimeError
+        If the number of events is not known for a lumisection range.
+    """
+    files = catalog.files()
+    group_files, group_lumis = [], []
+    job_file_ids, job_lumis, job_events = [], {}, 0
+    total_events = 0
+
+    def finish_job():
+        group_files.append([files[i] for i in job_file_ids])
+        group_lumis.append(LumiList.LumiList(compactList=job_lumis))
+
+    for file_id, run, ls_start, ls_end, events in izip(catalog.file_id, catalog.run, catalog.ls_start,
+                                                       catalog.ls_end, catalog.events):
+        if events < 0:
+            raise RuntimeError('Number of events unknown for %s run %d LS %s'
+                               % (catalog.names[file_id], run, [ls_start, ls_end]))
+        if 0 <= max_events <= total_events:
+            break
+        num_lumis = ls_end - ls_start + 1
+        events_per_lumi = float(events) / num_lumis
+        while ls_start <= ls_end:
+            # take enough LS to reach the target, but at least 1
+            target = events_per_job - job_events
+            if max_events >= 0:
+                target = min(target, max_events - total_events)
+            if events_per_lumi > 0:
+                this_num = max(1, int(math.ceil(target / events_per_lumi - 1e-9)))
+            else:
+                this_num = num_lumis
+            this_end = min(ls_end, ls_start + this_num - 1)
+            this_events = int(round(events_per_lumi * (this_end - ls_start + 1)))
+            if file_id not in job_file_ids:
+                job_file_ids.append(file_id)
+            job_lumis.setdefault(str(run), []).append([ls_start, this_end])
+            job_events += this_events
+            total_events += this_events
+            ls_start = this_end + 1
+            if job_events >= events_per_job or 0 <= max_events <= total_events:
+                finish_job()
+                job_file_ids, job_lumis, job_events = [], {}, 0
+                if 0 <= max_events <= total_events:
+                    break
+    if job_file_ids:
+        finish_job()
+    return group_files, group_lumis
+
+
 def group_files_by_files_per_job(list_of_files, files_per_job):
     """Makes groups of files, splitting into groups of files_per_job.
 
@@ -466,10 +1315,158 @@ def group_files_by_files_per_job(list_of_files, files_per_job):
     return groups
 
 
+def group_files_by_lpt(list_of_files, weights, num_groups):
+    """Makes num_groups groups of files, using longest-processing-time-first
+    bin packing: each file, in order of decreasing weight, is added to the
+    group with the smallest total weight so far.
+
+    Parameters
+    ----------
+    list_of_files : list[obj]
+        List of files to be grouped
+    weights : list[float]
+        Weight (e.g. size or number of events) of each file
+    num_groups : int
+        Number of groups
+
+    Returns
+    -------
+    list[list[obj]]
+        List of file groups, one per job/group. Files in each group are in
+        their original order.
+    """
+    num_groups = max(1, min(num_groups, len(list_of_files)))
+    loads = [(0, i) for i in xrange(num_groups)]
+    group_inds = [[] for _ in xrange(num_groups)]
+    for ind in sorted(xrange(len(list_of_files)), key=lambda i: weights[i], reverse=True):
+        load, group = heapq.heappop(loads)
+        group_inds[group].append(ind)
+        heapq.heappush(loads, (load + weights[ind], group))
+    return [[list_of_files[i] for i in sorted(inds)] for inds in group_inds if inds]
+
+
+def group_files_by_ffd(list_of_files, weights, num_groups):
+    """Makes groups of files using first-fit-decreasing bin packing.
+
+    The capacity of each group is the mean weight for num_groups groups
+    (or the largest single weight if bigger). Each file, in order of
+    decreasing weight, is added to the first group it fits in, or a new group
+    if none have space. This may therefore make more than num_groups groups.
+
+    Parameters
+    ----------
+    list_of_files : list[obj]
+        List of files to be grouped
+    weights : list[float]
+        Weight (e.g. size or number of events) of each file
+    num_groups : int
+        Target number of groups
+
+    Returns
+    -------
+    list[list[obj]]
+        List of file groups, one per job/group. Files in each group are in
+        their original order.
+    """
+    if not list_of_files:
+        return []
+    capacity = max(float(sum(weights)) / max(1, num_groups), max(weights))
+    loads, group_inds = [], []
+    for ind in sorted(xrange(len(list_of_files)), key=lambda i: weights[i], reverse=True):
+        for group, load in enumerate(loads):
+            if load + weights[ind] <= capacity * (1 + 1E-9):
+                break
+        else:
+            group = len(loads)
+            loads.append(0)
+            group_inds.append([])
+        loads[group] += weights[ind]
+        group_inds[group].append(ind)
+    return [[list_of_files[i] for i in sorted(inds)] for inds in group_inds]
+
+
+def choose_site(sites, local_site=LOCAL_SITE):
+    """Choose which site a file should be read from.
+
+    Parameters
+    ----------
+    sites : list[str]
+        Sites hosting the file
+    local_site : str, optional
+        Preferred site
+
+    Returns
+    -------
+    str
+        local_site if it hosts the file, otherwise the first site
+        alphabetically, or None if no sites are known.
+    """
+    if local_site in sites:
+        return local_site
+    return min(sites) if sites else None
+
+
+def split_files_by_site(list_of_files, local_site=LOCAL_SITE):
+    """Split files into lists of files at the same site, using choose_site().
+
+    Parameters
+    ----------
+    list_of_files : list[DatasetFile]
+        Files to split
+    local_site : str, optional
+        Preferred site
+
+    Returns
+    -------
+    list[list[DatasetFile]]
+        Files for each site, in original order. Files at local_site are first.
+    """
+    site_files = {}
+    for f in list_of_files:
+        site_files.setdefault(choose_site(f.sites, local_site), []).append(f)
+    return [site_files[site] for site in sorted(site_files,
+                                                key=lambda x: (x != local_site, x is None, x))]
+
+
+def log_group_loads(groups, weight_func, weight_name):
+    """Print the predicted max & mean load of groups of files.
+
+    Parameters
+    ----------
+    groups : list[list[obj]]
+        List of file groups
+    weight_func : callable
+        Function to get the weight of a file
+    weight_name : str
+        Name of weight for printout, e.g. 'size'
+
+    Returns
+    -------
+    float, float
+        Max & mean load
+    """
+    loads = [sum(weight_func(f) for f in group) for group in groups]
+    max_load = max(loads) if loads else 0
+    mean_load = float(sum(loads)) / len(loads) if loads else 0
+    log.info("Predicted job %s: max %g, mean %g (max/mean = %.2f)",
+             weight_name, max_load, mean_load, max_load / mean_load if mean_load else 0)
+    return max_load, mean_load
+
+
+def local_pfn(f, local_site=LOCAL_SITE):
+    """Get filename to use for a DatasetFile: the local PFN if the file is
+    at local_site, otherwise its LFN (so will be read via XRootD)."""
+    if local_site in f.sites and f.name.startswith('/store/'):
+        return LOCAL_PFN_PREFIX + f.name
+    return f.name
+
+
 def create_filelist(jobs_input_files, filelist_filename):
     """Write python dict to file with input files for each job.
     It can then be used in worker script to override the PoolSource.
 
+    Files at LOCAL_SITE use their local PFN, so they are read directly.
+
     Parameters
     ----------
     jobs_input_files : list[list[DatasetFile]]
@@ -480,7 +1477,7 @@ def create_filelist(jobs_input_files, filelist_filename):
     with open(filelist_filename, "w") as file_list:
         file_list.write("fileNames = {")
         for n, flist in enumerate(jobs_input_files):
-            file_list.write("%d: [%s],\n" % (n, ', '.join(["'%s'" % f.name for f in flist if f])))
+            file_list.write("%d: [%s],\n" % (n, ', '.join(["'%s'" % local_pfn(f) for f in flist if f])))
         file_list.write("}\n")
 
         file_list.write("secondaryFileNames = {")
@@ -514,86 +1511,1089 @@ def create_lumilists(jobs_lumis, lumilist_filename):
     log.info("List of lumis for each job written to %s", lumilist_filename)
 
 
-def setup_sandbox(sandbox_filename, cmssw_config_filename,
-                  input_filelist, additional_input_files):
-    """Create sandbox gzip of libs/headers/py/config/input filelist.
+class SandboxIgnore(object):
+    """Rules for which files not to put in the sandbox, like a .gitignore.
+
+    Each rule is a shell-style pattern, matched against the path in the
+    sandbox (e.g. lib/slc6_amd64_gcc530/libFoo.so), or against the
+    filename if the pattern has no '/'. A rule starting with '!' puts
+    back files matched by an earlier rule. The last matching rule wins.
+    """
+
+    def __init__(self, patterns):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            self.rules.append((negate, pattern.lstrip('!')))
+
+    @classmethod
+    def from_file(cls, filename, defaults=DEFAULT_SANDBOX_IGNORE):
+        """Make rules from the defaults plus those in filename, if it exists"""
+        patterns = list(defaults)
+        if os.path.isfile(filename):
+            log.debug('Using sandbox ignore rules from %s', filename)
+            with open(filename) as f:
+                patterns.extend(f.readlines())
+        return cls(patterns)
+
+    def ignored(self, arcname):
+        """Test if path in sandbox should be left out"""
+        result = False
+        for negate, pattern in self.rules:
+            target = arcname if '/' in pattern else os.path.basename(arcname)
+            if fnmatch.fnmatch(target, pattern):
+                result = not negate
+        return result
+
+
+def is_external_link(path):
+    """Test if path is a symlink to somewhere in SANDBOX_EXTERNAL_PREFIXES"""
+    return (os.path.islink(path) and
+            any(os.path.realpath(path).startswith(p) for p in SANDBOX_EXTERNAL_PREFIXES))
+
+
+def list_sandbox_files(cmssw_base, ignore=None, skipped=None):
+    """List the files from the user's CMSSW area that go in the sandbox:
+    libs, python, and headers/data files in src.
+
+    Symlinks to SANDBOX_EXTERNAL_PREFIXES are listed, but not followed.
 
     Parameters
     ----------
-    sandbox_filename : str
-        Filename of sandbox
-    cmssw_config_filename : str
-        Filename of CMSSW config file to be included.
-    input_filelist : str or None
-        Filename of list of files for worker. If None, will not be added, and
-        worker will use whatever files are specified in config.
-    additional_input_files : list[str]
-        List of additional input files to add to sandbox
+    cmssw_base : str
+        CMSSW area, i.e. $CMSSW_BASE
+    ignore : SandboxIgnore, optional
+        Rules for files to leave out
+    skipped : list, optional
+        If given, (filename, name in sandbox) of each ignored file is added to it.
 
+    Returns
+    -------
+    list[(str, str)]
+        (filename, name in sandbox) for each file, sorted by name in sandbox.
     """
-    log.info('Creating sandbox')
+    sandbox_files = []
 
-    sandbox_filename = "sandbox.tgz"
-    sandbox_dirs = ['biglib', 'lib', 'module', 'python']
-    tar = tarfile.open(sandbox_filename, mode="w:gz", dereference=True)
-    cmssw_base = os.environ['CMSSW_BASE']
-    for directory in sandbox_dirs:
-        fullPath = os.path.join(cmssw_base, directory)
-        if os.path.isdir(fullPath):
-            log.debug('Adding %s to tar', fullPath)
-            tar.add(fullPath, directory, recursive=True)
+    def add_file(full_path, file_arcname):
+        if ignore and ignore.ignored(file_arcname):
+            if skipped is not None:
+                skipped.append((full_path, file_arcname))
+        else:
+            sandbox_files.append((full_path, file_arcname))
+
+    def add_dir(path, arcname):
+        log.debug('Adding %s to tar', path)
+        for root, dirs, files in os.walk(path, followlinks=True):
+            for d in [d for d in dirs if is_external_link(os.path.join(root, d))]:
+                dirs.remove(d)
+                add_file(os.path.join(root, d), os.path.join(arcname, os.path.relpath(os.path.join(root, d), path)))
+            for f in files:
+                full_path = os.path.join(root, f)
+                # skips broken symlinks
+                if os.path.isfile(full_path):
+                    add_file(full_path, os.path.join(arcname, os.path.relpath(full_path, path)))
+
+    for directory in SANDBOX_LIB_DIRS:
+        full_path = os.path.join(cmssw_base, directory)
+        if os.path.isdir(full_path):
+            add_dir(full_path, directory)
 
     # special case for /src - need to include src/package/sub_package/data
     # and src/package/sub_package/interface
-    src_dirs = ['data', 'interface']
     src_path = os.path.join(cmssw_base, 'src')
-    for root, dirs, files in os.walk(os.path.join(cmssw_base, 'src')):
-        if os.path.basename(root) in src_dirs:
-            d = root.replace(src_path, 'src')
-            log.debug('Adding %s to tar', d)
-            tar.add(root, d, recursive=True)
+    for root, dirs, files in os.walk(src_path):
+        if os.path.basename(root) in SANDBOX_SRC_DIRS:
+            add_dir(root, root.replace(src_path, 'src'))
+            dirs[:] = []  # already added everything below here
 
-    # add in the config file and input filelist
-    tar.add(cmssw_config_filename, arcname="src/config.py")
-    if input_filelist:
-        log.debug('Adding %s to tar', input_filelist)
-        tar.add(input_filelist, arcname="src/filelist.py")
+    return sorted(sandbox_files, key=lambda x: x[1])
 
-    # add in any other files the user wants
-    for input_file in additional_input_files:
-        if not os.path.isfile(input_file):
-            raise IOError('Cannot find additional file %s' % input_file)
-            log.debug('Adding %s to tar', input_file)
-        # we want it to end up in CMSSW_BASE/src, for now
-        tar.add(input_file, arcname=os.path.join('src', os.path.basename(input_file)))
 
-    tar.close()
+def hash_sandbox_files(sandbox_files, options=''):
+    """Hash the names, sizes, and modification times of the sandbox files.
 
+    Parameters
+    ----------
+    sandbox_files : list[(str, str)]
+        (filename, name in sandbox) for each file
+    options : str, optional
+        Any options that change the sandbox contents, e.g. stripping
 
-def das_file_to_lumilist(data):
-    """Extract LumiList object from DAS file entry"""
-    lumi_dict = {}
-    for rn, lumi in izip(data['run'], data['lumi']):
-        run_num = str(rn['run_number'])
-        lumis = lumi['number']
-        lumi_dict[run_num] = lumis
-    return LumiList.LumiList(compactList=lumi_dict)
+    Returns
+    -------
+    str
+        SHA1 hex digest
+    """
+    sha1 = hashlib.sha1('sandbox version %d %s\n' % (SANDBOX_VERSION, options))
+    for filename, arcname in sandbox_files:
+        stat = os.stat(filename)
+        sha1.update('%s %d %d\n' % (arcname, stat.st_size, stat.st_mtime))
+    return sha1.hexdigest()
+
+
+def add_tar_members(tar, sandbox_files):
+    """Add files to a TarFile. Links to SANDBOX_EXTERNAL_PREFIXES are added as symlinks."""
+    for filename, arcname in sandbox_files:
+        if is_external_link(filename):
+            link_info = tarfile.TarInfo(arcname)
+            link_info.type = tarfile.SYMTYPE
+            link_info.linkname = os.path.realpath(filename)
+            tar.addfile(link_info)
+        else:
+            tar.add(filename, arcname=arcname, recursive=False)
 
 
-def get_list_of_files_from_das(dataset, num_files):
-    """Create list of num_files filenames for dataset using DAS.
+def create_tarball(tar_filename, sandbox_files, compression='gzip'):
+    """Create a compressed tarball of files.
+
+    The tarball is written to a temporary file first, so tar_filename
+    only exists once it is complete.
 
     Parameters
     ----------
-    dataset : str
+    tar_filename : str
+        Filename of tarball
+    sandbox_files : list[(str, str)]
+        (filename, name in tarball) for each file
+    compression : str, optional
+        Key in SANDBOX_COMPRESSIONS. Except for gzip, the tar stream is
+        piped through the compression command.
+
+    Raises
+    ------
+    RuntimeError
+        If the compression command fails
+    """
+    compress_cmd = SANDBOX_COMPRESSIONS[compression][1]
+    out_dir = os.path.dirname(os.path.abspath(tar_filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    os.close(fd)
+    proc = None
+    try:
+        if compress_cmd:
+            with open(tmp_filename, 'wb') as out_file:
+                proc = subprocess.Popen([c.format(threads=cpu_count()) for c in compress_cmd],
+                                        stdin=subprocess.PIPE, stdout=out_file)
+                tar = tarfile.open(fileobj=proc.stdin, mode="w|", dereference=True)
+        else:
+            tar = tarfile.open(tmp_filename, mode="w:gz", dereference=True)
+        add_tar_members(tar, sandbox_files)
+        tar.close()
+        if proc:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise RuntimeError("%s failed with exit code %d" % (compress_cmd[0], proc.returncode))
+        os.chmod(tmp_filename, 0644)
+        os.rename(tmp_filename, tar_filename)
+    except BaseException:
+        if proc and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        os.remove(tmp_filename)
+        raise
+
+
+def split_sandbox_chunks(sandbox_files, chunk_size=SANDBOX_CHUNK_SIZE):
+    """Split sandbox files into chunks, each of files in one directory with
+    total size up to chunk_size. Since chunks don't cross directories,
+    adding or removing a file only changes the chunks for its directory.
+
+    Parameters
+    ----------
+    sandbox_files : list[(str, str)]
+        (filename, name in sandbox) for each file, sorted by name in sandbox
+    chunk_size : int, optional
+        Max size of a chunk in bytes, unless it is a single file
+
+    Returns
+    -------
+    list[list[(str, str)]]
+        Files in each chunk
+    """
+    chunks = []
+    last_dir, current_size = None, 0
+    for filename, arcname in sandbox_files:
+        file_size = 0 if is_external_link(filename) else os.path.getsize(filename)
+        this_dir = os.path.dirname(arcname)
+        if this_dir != last_dir or current_size + file_size > chunk_size:
+            chunks.append([])
+            last_dir, current_size = this_dir, 0
+        chunks[-1].append((filename, arcname))
+        current_size += file_size
+    return chunks
+
+
+def sandbox_member_info(filename, arcname):
+    """Get [name in sandbox, size, mtime] of a sandbox file, to check if it has changed."""
+    stat = os.lstat(filename) if is_external_link(filename) else os.stat(filename)
+    return [arcname, stat.st_size, int(stat.st_mtime)]
+
+
+def sandbox_member_hash(filename):
+    """Get SHA1 of a sandbox file, or where it links to for an external link"""
+    if is_external_link(filename):
+        return hashlib.sha1(os.path.realpath(filename)).hexdigest()
+    return hash_file(filename)
+
+
+def compress_tar_chunk(sandbox_files, out_filename, compression='gzip', strip_debug=False):
+    """Write files as part of a tar archive (without the end-of-archive marker),
+    as one compressed stream. Concatenating these, followed by
+    compress_tar_chunk([]) with the marker, gives a valid compressed tarball.
+
+    Parameters
+    ----------
+    sandbox_files : list[(str, str)]
+        (filename, name in sandbox) for each file
+    out_filename : str
+        Output file
+    compression : str, optional
+        Key in SANDBOX_COMPRESSIONS
+    strip_debug : bool, optional
+        Remove debug sections from shared libraries
+    """
+    compress_cmd = SANDBOX_COMPRESSIONS[compression][1]
+    strip_dir = tempfile.mkdtemp() if strip_debug else None
+    with open(out_filename, 'wb') as out_file:
+        if compress_cmd:
+            # parallelism comes from compressing several chunks at once
+            proc = subprocess.Popen([c.format(threads=1) for c in compress_cmd],
+                                    stdin=subprocess.PIPE, stdout=out_file)
+            stream = PipeWriter(proc.stdin)
+        else:
+            proc = None
+            stream = gzip.GzipFile(fileobj=out_file, mode='wb', mtime=0)
+        try:
+            if not sandbox_files:
+                stream.write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+            else:
+                if strip_debug:
+                    sandbox_files = strip_debug_symbols(sandbox_files, strip_dir, num_threads=1)
+                # don't close the TarFile, that would add the end-of-archive marker
+                tar = tarfile.open(fileobj=stream, mode="w", dereference=True)
+                add_tar_members(tar, sandbox_files)
+            stream.close()
+            if proc and proc.wait() != 0:
+                raise RuntimeError("%s failed with exit code %d" % (compress_cmd[0], proc.returncode))
+        finally:
+            if proc and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if strip_dir:
+                shutil.rmtree(strip_dir)
+
+
+class PipeWriter(object):
+    """Wrap a pipe so it can be used by TarFile, which needs tell()"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.offset = 0
+
+    def write(self, data):
+        self.pipe.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self.pipe.close()
+
+
+def create_chunked_tarball(tar_filename, sandbox_files, compression='gzip', strip_debug=False,
+                           previous_manifest=None):
+    """Create a compressed tarball as a series of independently compressed
+    chunks, reusing unchanged chunks from a previous tarball.
+
+    Returns a manifest of the tarball, with the offset and length of each
+    chunk in the tarball, and the name, size, mtime and SHA1 of each file in
+    it. A chunk from previous_manifest is reused if it has the same files,
+    and each file has the same size & mtime or the same SHA1, so only chunks
+    with changed files are compressed again. Chunks are compressed in parallel.
+    previous_manifest is only used if it was made with the same compression,
+    strip_debug and SANDBOX_VERSION, since its files' info is from the
+    original files, not what went in the tarball.
+
+    Parameters
+    ----------
+    tar_filename : str
+        Filename of tarball
+    sandbox_files : list[(str, str)]
+        (filename, name in tarball) for each file, sorted by name in tarball
+    compression : str, optional
+        Key in SANDBOX_COMPRESSIONS
+    strip_debug : bool, optional
+        Remove debug sections from shared libraries
+    previous_manifest : dict, optional
+        Manifest of previous tarball, from create_chunked_tarball()
+
+    Returns
+    -------
+    dict
+        Manifest of new tarball
+    """
+    out_dir = os.path.dirname(os.path.abspath(tar_filename))
+    previous_chunks, previous_tarball = {}, None
+    if previous_manifest and manifest_matches(previous_manifest, compression, strip_debug):
+        previous_tarball = os.path.join(out_dir, previous_manifest['tarball'])
+        for chunk in previous_manifest['chunks']:
+            previous_chunks[tuple(m[0] for m in chunk['members'])] = chunk
+
+    def reuse_chunk(chunk_files):
+        """Get previous chunk & current member info if chunk is unchanged, else None"""
+        previous = previous_chunks.get(tuple(arcname for _, arcname in chunk_files))
+        if previous is None:
+            return None
+        members = []
+        for (filename, arcname), old_member in izip(chunk_files, previous['members']):
+            member = sandbox_member_info(filename, arcname)
+            if member[1:] != old_member[1:3] and sandbox_member_hash(filename) != old_member[3]:
+                return None
+            members.append(member + [old_member[3]])
+        return previous, members
+
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
+    try:
+        chunks = []
+        for ind, chunk_files in enumerate(split_sandbox_chunks(sandbox_files)):
+            reused = reuse_chunk(chunk_files) if previous_tarball else None
+            chunks.append((ind, chunk_files, reused))
+
+        def encode(chunk):
+            ind, chunk_files, reused = chunk
+            compress_tar_chunk(chunk_files, os.path.join(tmp_dir, str(ind)), compression, strip_debug)
+            return [sandbox_member_info(f, a) + [sandbox_member_hash(f)] for f, a in chunk_files]
+
+        to_encode = [c for c in chunks if c[2] is None]
+        log.info('Compressing %d/%d sandbox chunks', len(to_encode), len(chunks))
+        pool = ThreadPool(cpu_count())
+        try:
+            encoded_members = dict(izip([c[0] for c in to_encode], pool.map(encode, to_encode)))
+        finally:
+            pool.close()
+        compress_tar_chunk([], os.path.join(tmp_dir, 'end'), compression)
+
+        # Put the chunks together
+        manifest = {'tarball': os.path.basename(tar_filename), 'compression': compression,
+                    'strip_debug': strip_debug, 'version': SANDBOX_VERSION, 'chunks': []}
+        fd, tmp_filename = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as out_file:
+            previous_file = open(previous_tarball, 'rb') if previous_tarball else None
+            try:
+                for ind, chunk_files, reused in chunks:
+                    offset = out_file.tell()
+                    if reused:
+                        previous_file.seek(reused[0]['offset'])
+                        copy_bytes(previous_file, out_file, reused[0]['length'])
+                        members = reused[1]
+                    else:
+                        with open(os.path.join(tmp_dir, str(ind)), 'rb') as chunk_file:
+                            shutil.copyfileobj(chunk_file, out_file)
+                        members = encoded_members[ind]
+                    manifest['chunks'].append({'offset': offset, 'length': out_file.tell() - offset,
+                                               'members': members})
+                with open(os.path.join(tmp_dir, 'end'), 'rb') as chunk_file:
+                    shutil.copyfileobj(chunk_file, out_file)
+            finally:
+                if previous_file:
+                    previous_file.close()
+        os.chmod(tmp_filename, 0644)
+        os.rename(tmp_filename, tar_filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return manifest
+
+
+def copy_bytes(in_file, out_file, length, block_size=1024 * 1024):
+    """Copy length bytes from in_file to out_file"""
+    while length > 0:
+        data = in_file.read(min(block_size, length))
+        if not data:
+            raise IOError('Unexpected end of file copying %s' % in_file.name)
+        out_file.write(data)
+        length -= len(data)
+
+
+def manifest_matches(manifest, compression, strip_debug):
+    """Check if chunks from a sandbox manifest can be reused for a sandbox
+    with this compression & stripping"""
+    return (manifest.get('compression') == compression and
+            manifest.get('strip_debug') == strip_debug and
+            manifest.get('version') == SANDBOX_VERSION)
+
+
+def load_latest_manifest(cache_dir, compression, strip_debug=False):
+    """Get the manifest of the most recently used cached sandbox with the
+    given compression & stripping, or None if there isn't one."""
+    manifests = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.manifest.json')]
+    for manifest_filename in sorted(manifests, key=os.path.getmtime, reverse=True):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        if (manifest_matches(manifest, compression, strip_debug) and
+                os.path.isfile(os.path.join(cache_dir, manifest['tarball']))):
+            return manifest
+    return None
+
+
+def strip_debug_symbols(sandbox_files, out_dir, num_threads=None):
+    """Make copies of shared libraries without debug sections, using objcopy.
+
+    Parameters
+    ----------
+    sandbox_files : list[(str, str)]
+        (filename, name in sandbox) for each file
+    out_dir : str
+        Directory to put stripped libraries in
+    num_threads : int, optional
+        Number of objcopy to run at once. Default is the number of cores.
+
+    Returns
+    -------
+    list[(str, str)]
+        sandbox_files, with stripped copies instead of the original libraries
+    """
+    if not find_executable('objcopy'):
+        log.warning('Cannot find objcopy, not stripping debug symbols')
+        return sandbox_files
+
+    def strip(entry):
+        filename, arcname = entry
+        if not arcname.endswith('.so') or is_external_link(filename):
+            return entry
+        stripped_filename = os.path.join(out_dir, arcname.replace('/', '_'))
+        if subprocess.call(['objcopy', '--strip-debug', filename, stripped_filename]) != 0:
+            log.warning('Could not strip %s, using original', filename)
+            return entry
+        return stripped_filename, arcname
+
+    if num_threads == 1:
+        return map(strip, sandbox_files)
+    pool = ThreadPool(num_threads or cpu_count())
+    try:
+        return pool.map(strip, sandbox_files)
+    finally:
+        pool.close()
+
+
+def sandbox_report(sandbox_files, skipped, num_largest=20):
+    """Print the total size of the sandbox, and its largest files & directories.
+
+    Parameters
+    ----------
+    sandbox_files : list[(str, str)]
+        (filename, name in sandbox) for each file in the sandbox
+    skipped : list[(str, str)]
+        (filename, name in sandbox) for each ignored file
+    num_largest : int, optional
+        Number of files & directories to print
+    """
+    def size(filename):
+        return 0 if is_external_link(filename) else os.path.getsize(filename)
+
+    sizes = [(size(filename), arcname) for filename, arcname in sandbox_files]
+    dir_sizes = {}
+    for file_size, arcname in sizes:
+        dir_sizes[os.path.dirname(arcname)] = dir_sizes.get(os.path.dirname(arcname), 0) + file_size
+    log.info('Sandbox has %d files, %.1f MB (before compression)',
+             len(sizes), sum(x[0] for x in sizes) / 1E6)
+    log.info('Ignored %d files, %.1f MB', len(skipped), sum(size(f) for f, _ in skipped) / 1E6)
+    log.info('Largest directories:')
+    for dirname, dir_size in sorted(dir_sizes.iteritems(), key=lambda x: x[1], reverse=True)[:num_largest]:
+        log.info('  %10.2f MB  %s', dir_size / 1E6, dirname)
+    log.info('Largest files:')
+    for file_size, arcname in sorted(sizes, reverse=True)[:num_largest]:
+        log.info('  %10.2f MB  %s', file_size / 1E6, arcname)
+
+
+def prune_sandbox_cache(cache_dir, max_age_days=SANDBOX_CACHE_DAYS):
+    """Delete cached sandboxes that haven't been used for max_age_days"""
+    min_mtime = time.time() - max_age_days * 24 * 3600
+    for f in os.listdir(cache_dir):
+        filename = os.path.join(cache_dir, f)
+        if f.startswith('sandbox_') and os.path.getmtime(filename) < min_mtime:
+            log.debug('Removing old cached sandbox %s', filename)
+            os.remove(filename)
+
+
+def setup_base_sandbox(sandbox_filename, cmssw_base, cache_dir=None, compression='gzip',
+                       strip_debug=False, report=False):
+    """Create the base sandbox of libs/headers/py from the user's CMSSW area,
+    or reuse a cached one.
+
+    The cached sandbox is named from a hash of the names, sizes, and
+    modification times of all its files, so it is only rebuilt when
+    something changes.
+
+    Files matching DEFAULT_SANDBOX_IGNORE or $CMSSW_BASE/.sandboxignore
+    are left out.
+
+    Parameters
+    ----------
+    sandbox_filename : str
+        Filename of sandbox, if not using the cache
+    cmssw_base : str
+        CMSSW area, i.e. $CMSSW_BASE
+    cache_dir : str, optional
+        Directory of cached sandboxes. If None, always makes sandbox_filename.
+    compression : str, optional
+        Key in SANDBOX_COMPRESSIONS
+    strip_debug : bool, optional
+        Remove debug sections from shared libraries
+    report : bool, optional
+        Print the largest contributors to the sandbox
+
+    Returns
+    -------
+    str
+        Filename of the sandbox to use
+    """
+    ignore = SandboxIgnore.from_file(os.path.join(cmssw_base, '.sandboxignore'))
+    skipped = []
+    sandbox_files = list_sandbox_files(cmssw_base, ignore, skipped)
+    if report:
+        sandbox_report(sandbox_files, skipped)
+    if cache_dir:
+        check_create_dir(cache_dir)
+        sandbox_hash = hash_sandbox_files(sandbox_files, 'strip' if strip_debug else '')
+        sandbox_filename = os.path.join(cache_dir, 'sandbox_%s%s' % (sandbox_hash[:16],
+                                                                     SANDBOX_COMPRESSIONS[compression][0]))
+        manifest_filename = sandbox_filename + '.manifest.json'
+        if os.path.isfile(sandbox_filename):
+            log.info('Reusing cached sandbox %s', sandbox_filename)
+            # mark as recently used
+            for f in [sandbox_filename, manifest_filename]:
+                if os.path.isfile(f):
+                    os.utime(f, None)
+            return sandbox_filename
+        prune_sandbox_cache(cache_dir)
+
+        # Only recompress the parts that changed since the last sandbox
+        log.info('Creating sandbox %s', sandbox_filename)
+        start = time.time()
+        manifest = create_chunked_tarball(sandbox_filename, sandbox_files, compression, strip_debug,
+                                          load_latest_manifest(cache_dir, compression, strip_debug))
+        with open(manifest_filename, 'w') as f:
+            json.dump(manifest, f)
+        log.debug('Made sandbox in %.1f s', time.time() - start)
+        return sandbox_filename
+
+    log.info('Creating sandbox %s', sandbox_filename)
+    start = time.time()
+    strip_dir = tempfile.mkdtemp() if strip_debug else None
+    try:
+        if strip_debug:
+            sandbox_files = strip_debug_symbols(sandbox_files, strip_dir)
+        create_tarball(sandbox_filename, sandbox_files, compression)
+    finally:
+        if strip_dir:
+            shutil.rmtree(strip_dir)
+    log.debug('Made sandbox in %.1f s', time.time() - start)
+    return sandbox_filename
+
+
+def store_sandbox(sandbox_filename, store_dir):
+    """Copy a cached sandbox to store_dir (e.g. on /hdfs), unless it is already there.
+
+    Since the cached sandbox is named by its contents, an existing file with
+    the same name can be used as is.
+
+    Parameters
+    ----------
+    sandbox_filename : str
+        Sandbox to store
+    store_dir : str
+        Directory to store it in
+
+    Returns
+    -------
+    str
+        Filename of stored sandbox
+    """
+    stored_filename = os.path.join(store_dir, os.path.basename(sandbox_filename))
+    if os.path.isfile(stored_filename):
+        log.info('Using stored sandbox %s', stored_filename)
+        return stored_filename
+
+    log.info('Copying sandbox to %s', stored_filename)
+    check_create_dir(store_dir)
+    # copy to a temporary name first, so jobs never see a partial file
+    tmp_filename = stored_filename + '.tmp%d' % os.getpid()
+    if store_dir.startswith('/hdfs'):
+        subprocess.check_call(['hadoop', 'fs', '-copyFromLocal', '-f', sandbox_filename,
+                               tmp_filename.replace('/hdfs', '', 1)])
+        subprocess.check_call(['hadoop', 'fs', '-mv', tmp_filename.replace('/hdfs', '', 1),
+                               stored_filename.replace('/hdfs', '', 1)])
+    else:
+        shutil.copy2(sandbox_filename, tmp_filename)
+        os.rename(tmp_filename, stored_filename)
+    return stored_filename
+
+
+def capture_runtime_env(cmssw_base, env_filename):
+    """Save the output of `scramv1 runtime -sh` for cmssw_base, so the worker
+    can source it instead of making a project area & running scramv1 itself.
+
+    Any paths in cmssw_base are replaced by ${CMSRUNCONDOR_CMSSW_BASE},
+    which the worker sets to its own project area.
+
+    Parameters
+    ----------
+    cmssw_base : str
+        $CMSSW_BASE of the project area to use
+    env_filename : str
+        Filename for the saved environment
+    """
+    log.info('Saving scramv1 runtime environment to %s', env_filename)
+    start = time.time()
+    env = subprocess.check_output(['scramv1', 'runtime', '-sh'], cwd=os.path.join(cmssw_base, 'src'))
+    for base in sorted({cmssw_base.rstrip('/'), os.path.realpath(cmssw_base)}, key=len, reverse=True):
+        env = env.replace(base, '${CMSRUNCONDOR_CMSSW_BASE}')
+    with open(env_filename, 'w') as env_file:
+        env_file.write(env)
+    log.debug('scramv1 runtime took %.1f s', time.time() - start)
+    return env_filename
+
+
+def setup_sandbox(sandbox_filename, overlay_filename, cmssw_config_filename,
+                  input_filelist, additional_input_files, cache_dir=None, compression='gzip',
+                  strip_debug=False, report=False, runtime_env=None):
+    """Create sandbox gzips: a base sandbox of libs/headers/py
+    (see setup_base_sandbox), and a small overlay with the per-submission
+    config/input filelist/additional files.
+
+    Parameters
+    ----------
+    sandbox_filename : str
+        Filename of base sandbox, if not using the cache
+    overlay_filename : str
+        Filename of overlay
+    cmssw_config_filename : str
+        Filename of CMSSW config file to be included.
+    input_filelist : str or None
+        Filename of list of files for worker. If None, will not be added, and
+        worker will use whatever files are specified in config.
+    additional_input_files : list[str]
+        List of additional input files to add to sandbox
+    cache_dir : str, optional
+        Directory of cached base sandboxes. If None, the base sandbox is always made.
+    compression : str, optional
+        Compression for the base sandbox, key in SANDBOX_COMPRESSIONS.
+        The overlay is small so always uses gzip.
+    strip_debug : bool, optional
+        Remove debug sections from shared libraries in the base sandbox
+    report : bool, optional
+        Print the largest contributors to the base sandbox
+    runtime_env : str, optional
+        Filename of saved runtime environment (see capture_runtime_env)
+        to add to the overlay
+
+    Returns
+    -------
+    str, str
+        Filenames of base sandbox & overlay
+    """
+    base_sandbox = setup_base_sandbox(sandbox_filename, os.environ['CMSSW_BASE'], cache_dir, compression,
+                                      strip_debug, report)
+
+    log.info('Creating sandbox overlay')
+    # add in the config file and input filelist
+    overlay_files = [(cmssw_config_filename, "src/config.py")]
+    if input_filelist:
+        log.debug('Adding %s to tar', input_filelist)
+        overlay_files.append((input_filelist, "src/filelist.py"))
+    if runtime_env:
+        overlay_files.append((runtime_env, "src/runtime_env.sh"))
+
+    # add in any other files the user wants
+    for input_file in additional_input_files:
+        if not os.path.isfile(input_file):
+            raise IOError('Cannot find additional file %s' % input_file)
+        log.debug('Adding %s to tar', input_file)
+        # we want it to end up in CMSSW_BASE/src, for now
+        overlay_files.append((input_file, os.path.join('src', os.path.basename(input_file))))
+
+    create_tarball(overlay_filename, overlay_files)
+    return base_sandbox, overlay_filename
+
+
+def das_lumi_numbers_to_ranges(lumis):
+    """Convert DAS lumi numbers to lumisection ranges.
+
+    DAS gives ranges ([[1, 10], ...]) for `file,run,lumi` queries,
+    but single lumisections ([1, 2, ...]) if events are also requested.
+    """
+    return [[ls, ls] if isinstance(ls, int) else ls for ls in lumis]
+
+
+def das_file_to_compact_list(data):
+    """Extract {run: lumisection ranges} from DAS file entry"""
+    lumi_dict = {}
+    for rn, lumi in izip(data['run'], data['lumi']):
+        run_num = str(rn['run_number'])
+        lumis = das_lumi_numbers_to_ranges(lumi['number'])
+        lumi_dict.setdefault(run_num, []).extend(lumis)
+    return lumi_dict
+
+
+def das_file_to_lumi_events(data):
+    """Extract {run: {lumisection: number of events}} from DAS file entry.
+    Returns None if the entry doesn't have events for each lumisection."""
+    if 'events' not in data:
+        return None
+    lumi_events = {}
+    for rn, lumi, events in izip(data['run'], data['lumi'], data['events']):
+        run_events = lumi_events.setdefault(int(rn['run_number']), {})
+        for ls, num in izip(lumi['number'], events['number']):
+            if not isinstance(ls, int) or num is None:
+                return None
+            run_events[ls] = run_events.get(ls, 0) + num
+    return lumi_events
+
+
+def das_file_number(info, key):
+    """Get a number from the file part of a DAS file entry,
+    or -1 if it is missing or null."""
+    value = info.get(key)
+    return -1 if value is None else value
+
+
+def das_file_to_lumilist(data):
+    """Extract LumiList object from DAS file entry"""
+    return LumiList.LumiList(compactList=das_file_to_compact_list(data))
+
+
+class DASCache(object):
+    """On-disk cache of das_client.py results.
+
+    Each result is stored as a gzipped JSON file, with a filename built from
+    the dataset name and a hash of the full query, so changing e.g. the
+    number of files gives a separate entry.
+    """
+
+    def __init__(self, cache_dir, ttl_hours=24, refresh=False):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory to store cached results in. Created if it doesn't exist.
+        ttl_hours : float, optional
+            Number of hours a cached result is valid for.
+        refresh : bool, optional
+            If True, ignore any cached results. New results are still stored.
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl_hours * 3600.
+        self.refresh = refresh
+
+    def filename(self, query):
+        """Get cache filename for a query string."""
+        dataset = re.search(r'dataset=(\S+)', query)
+        stem = dataset.group(1)[1:].replace("/", "_").replace("-", "_") if dataset else 'query'
+        return os.path.join(self.cache_dir,
+                            '%s_%s.json.gz' % (stem, hashlib.sha1(query).hexdigest()[:16]))
+
+    def open(self, query):
+        """Open the cached output for a query string.
+
+        Returns None if there is no valid cached result.
+        """
+        if self.refresh:
+            return None
+        filename = self.filename(query)
+        if not os.path.isfile(filename):
+            return None
+        age = time.time() - os.path.getmtime(filename)
+        if age > self.ttl:
+            log.debug("Cached DAS result %s has expired", filename)
+            return None
+        log.info("Using cached DAS result from %s (%.1f hours old)", filename, age / 3600.)
+        return gzip.open(filename)
+
+    def writer(self, query):
+        """Get a DASCacheWriter to store the output for a query string."""
+        try:
+            check_create_dir(self.cache_dir)
+        except OSError:
+            # another query may have just made it
+            if not os.path.isdir(self.cache_dir):
+                raise
+        return DASCacheWriter(self.filename(query))
+
+
+class DASCacheWriter(object):
+    """Write a DAS result to a temporary file, only moving it into the cache
+    once commit() is called, so a partial result is never read back."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        fd, self.tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        self.tmp_file = os.fdopen(fd, 'wb')
+        self.gz_file = gzip.GzipFile(fileobj=self.tmp_file, mode='wb')
+
+    def write(self, data):
+        self.gz_file.write(data)
+
+    def _close(self):
+        self.gz_file.close()
+        self.tmp_file.close()
+
+    def commit(self):
+        self._close()
+        os.rename(self.tmp_filename, self.filename)
+        log.debug("Stored DAS result in %s", self.filename)
+
+    def abort(self):
+        self._close()
+        os.remove(self.tmp_filename)
+
+
+def iter_json_list(stream, list_key, header, chunk_size=65536):
+    """Incrementally parse a JSON object from a stream, yielding the entries of
+    one of its lists one by one.
+
+    Only one entry (plus one chunk of the stream) is held in memory at a time,
+    so this can be used on very large das_client.py outputs.
+
+    Parameters
+    ----------
+    stream : file
+        File-like object with JSON object, e.g. subprocess stdout.
+    list_key : str
+        Key of the list in the top-level object to iterate over.
+    header : dict
+        All other top-level entries are stored in this dict.
+        Note that they may appear in the stream after the list.
+    chunk_size : int, optional
+        Number of bytes to read from stream at a time.
+
+    Yields
+    ------
+    object
+        Decoded entry from the list.
+
+    Raises
+    ------
+    ValueError
+        If the stream is not a valid JSON object.
+    """
+    decoder = json.JSONDecoder()
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def fill():
+        # drop what we've already parsed, then read some more
+        if state['eof']:
+            raise ValueError('Unexpected end of JSON stream')
+        chunk = stream.read(chunk_size)
+        state['buf'] = state['buf'][state['pos']:] + chunk
+        state['pos'] = 0
+        state['eof'] = not chunk
+
+    def next_char():
+        # skip whitespace, return next significant character
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            fill()
+
+    def expect(char):
+        if next_char() != char:
+            raise ValueError('Expected %s in JSON stream at %r' % (char, state['buf'][state['pos']:][:50]))
+        state['pos'] += 1
+
+    def decode():
+        # raw_decode fails if the value is incomplete, so keep reading until
+        # it works. Also need a delimiter after the value, otherwise a number
+        # split across chunks (e.g. "1" + ".5") could be decoded too early
+        while True:
+            next_char()
+            try:
+                obj, end = decoder.raw_decode(state['buf'], state['pos'])
+                if state['eof'] or (end < len(state['buf']) and state['buf'][end] in ' \t\r\n,:]}'):
+                    state['pos'] = end
+                    return obj
+            except ValueError:
+                if state['eof']:
+                    raise
+            fill()
+
+    expect('{')
+    while True:
+        char = next_char()
+        if char == '}':
+            break
+        elif char == ',':
+            state['pos'] += 1
+            continue
+        key = decode()
+        expect(':')
+        if key != list_key:
+            header[key] = decode()
+            continue
+        expect('[')
+        while True:
+            char = next_char()
+            if char == ']':
+                state['pos'] += 1
+                break
+            elif char == ',':
+                state['pos'] += 1
+                continue
+            yield decode()
+
+
+class DASQuery(object):
+    """Run a query with das_client.py, optionally using a DASCache.
+
+    The das_client.py process is started immediately, and the entries in the
+    "data" list of its output are parsed as they are read when iterating over
+    this object. All other top-level entries (e.g. "status") are stored in
+    `header`. Once iteration has finished, the output is stored in the cache,
+    unless the query failed.
+    """
+
+    def __init__(self, query, limit=None, das_cache=None):
+        """
+        Parameters
+        ----------
+        query : str
+            DAS query string, e.g. "summary dataset=/A/B/C"
+        limit : int, optional
+            Maximum number of results
+        das_cache : DASCache, optional
+            Cache to use. If None, always queries DAS.
+        """
+        self.cmds = ['das_client.py', '--query', query]
+        if limit is not None:
+            self.cmds.append('--limit=%d' % limit)
+        self.cmds.append('--format=json')
+        self.cache_key = ' '.join(self.cmds[2:])
+        self.das_cache = das_cache
+        self.header = {}
+        self.proc = None
+        self.stream = das_cache.open(self.cache_key) if das_cache else None
+        if self.stream is None:
+            log.debug(' '.join(self.cmds))
+            self.proc = subprocess.Popen(self.cmds, stdout=subprocess.PIPE)
+            self.stream = self.proc.stdout
+
+    def close(self):
+        """Stop the query, e.g. if the results are no longer needed."""
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.stream.close()
+
+    def __iter__(self):
+        writer = self.das_cache.writer(self.cache_key) if self.das_cache and self.proc else None
+        stream = self.stream
+        if writer:
+            stream = TeeReader(self.stream, writer)
+        try:
+            for entry in iter_json_list(stream, 'data', self.header):
+                yield entry
+            self.stream.close()
+            if self.proc and self.proc.wait() != 0:
+                raise subprocess.CalledProcessError(self.proc.returncode, self.cmds)
+        except BaseException:
+            # includes GeneratorExit if the caller stops iterating early
+            if writer:
+                writer.abort()
+            self.close()
+            raise
+        if writer:
+            # don't store failed queries
+            if self.header.get('status') == 'fail':
+                writer.abort()
+            else:
+                writer.commit()
+
+
+class TeeReader(object):
+    """File-like wrapper that also writes whatever is read to another file."""
+
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.copy.write(data)
+        return data
+
+
+def das_query(query, limit=None, das_cache=None):
+    """Run a query with das_client.py, optionally using a DASCache.
+
+    Parameters
+    ----------
+    query : str
+        DAS query string, e.g. "summary dataset=/A/B/C"
+    limit : int, optional
+        Maximum number of results
+    das_cache : DASCache, optional
+        Cache to use. If None, always queries DAS.
+
+    Returns
+    -------
+    dict
+        Decoded JSON output from das_client.py
+    """
+    query = DASQuery(query, limit, das_cache)
+    data = list(query)
+    result = query.header
+    result['data'] = data
+    return result
+
+
+def get_das_pool():
+    """Get the thread pool used to run DAS queries."""
+    global _das_pool
+    if _das_pool is None:
+        _das_pool = ThreadPool(DAS_QUERY_THREADS)
+    return _das_pool
+
+
+def das_query_async(query, limit=None, das_cache=None):
+    """Start a DAS query in the background. Arguments are as for das_query().
+
+    Returns
+    -------
+    multiprocessing.pool.AsyncResult
+        Use get() to get the decoded JSON output.
+    """
+    return get_das_pool().apply_async(das_query, (query, limit, das_cache))
+
+
+def iter_das_file_entries(dataset, num_files, das_cache=None, fields='file,run,lumi'):
+    """Get num_files file entries for dataset using DAS, one at a time.
+
+    The DAS output is parsed as it arrives, so only the current file is
+    held in memory. The queries are started as soon as this is called;
+    files are only read when iterating over the result.
+
+    Parameters
+    ----------
+    dataset : str
         Name of dataset
     num_files : int
         Total number of files to get.
+    das_cache : DASCache, optional
+        Cache for DAS results. If None, always queries DAS.
+    fields : str, optional
+        Fields to get for each file, e.g. 'file,run,lumi,events'
 
     Returns
     -------
-    list[DatasetFile]
-        List of DatasetFile obj with filename and lumisections for each file.
+    iterator[dict]
+        DAS entry with filename and lumisections for each file.
 
     Raises
     ------
@@ -602,53 +2602,991 @@ def get_list_of_files_from_das(dataset, num_files):
 
     """
     # TODO: use das_client API
-    log.info("Querying DAS for dataset info, please be patient...")
-    cmds = ['das_client.py', '--query',
-            'summary dataset=%s' % dataset, '--format=json']
-    output_summary = subprocess.check_output(cmds)
-    log.debug(output_summary)
-    summary = json.loads(output_summary)
-
-    # check to make sure dataset is valid
-    if summary['status'] == 'fail':
-        log.error('Error querying dataset with das_client:')
-        log.error(summary['reason'])
-        raise RuntimeError('Error querying dataset with das_client')
+    log.info("Querying DAS for dataset %s, please be patient...", dataset)
+    summary_query = das_query_async('summary dataset=%s' % dataset, das_cache=das_cache)
 
     # get required number of files
     # can either have:
     # < 0 : all files
     # 0 - 1 : use that fraction of the dataset
     # >= 1 : use that number of files
+    # Unless it's a fraction, we don't need the summary to make the file query,
+    # so run it at the same time
+    file_query_str = '%s dataset=%s status=VALID' % (fields, dataset)
+    file_query = None
+    if num_files < 0:
+        file_query = DASQuery(file_query_str, das_cache=das_cache)
+    elif num_files >= 1:
+        file_query = DASQuery(file_query_str, limit=int(num_files), das_cache=das_cache)
+
+    try:
+        summary = summary_query.get(DAS_QUERY_TIMEOUT)
+        log.debug(summary)
+
+        # check to make sure dataset is valid
+        if summary['status'] == 'fail':
+            log.error('Error querying dataset with das_client:')
+            log.error(summary['reason'])
+            raise RuntimeError('Error querying dataset with das_client')
+    except BaseException:
+        if file_query:
+            file_query.close()
+        raise
+
     num_dataset_files = int(summary['data'][0]['summary'][0]['nfiles'])
     if num_files < 0:
         num_files = num_dataset_files
     elif num_files < 1:
         num_files = math.ceil(num_files * num_dataset_files)
+        file_query = DASQuery(file_query_str, limit=num_files, das_cache=das_cache)
     elif num_files > num_dataset_files:
         num_files = num_dataset_files
         log.warning("You specified more files than exist. Using all %d files.",
                     num_dataset_files)
 
     # Make a list of input files for each job to avoid doing it on worker node
-    log.info("Querying DAS for %d filenames, please be patient...", num_files)
-    cmds = ['das_client.py', '--query',
-            'file,run,lumi dataset=%s status=VALID' % dataset,
-            '--limit=%d' % (num_files), '--format=json']
-    log.debug(' '.join(cmds))
-    das_output = subprocess.check_output(cmds)
-    file_dict = json.loads(das_output)
+    log.info("Reading %d files in %s from DAS...", num_files, dataset)
+    return iter(file_query)
+
+
+def iter_files_from_das(dataset, num_files, das_cache=None):
+    """Get num_files files for dataset using DAS, one at a time.
+
+    Arguments are as for iter_das_file_entries().
+
+    Returns
+    -------
+    iterator[DatasetFile]
+        DatasetFile obj with filename and lumisections for each file.
+    """
+    return (DatasetFile(name=entry['file'][0]['name'], lumi_list=das_file_to_lumilist(entry))
+            for entry in iter_das_file_entries(dataset, num_files, das_cache))
+
+
+def das_entry_sites(entry):
+    """Get CMS site names (e.g. T2_UK_SGrid_Bristol) from a DAS site entry"""
+    return [site['name'] for site in entry.get('site', [])
+            if re.match(r'^T[0-3]_', site.get('name', ''))]
+
+
+def get_file_sites_from_das(dataset, das_cache=None, site_query=None):
+    """Get the sites hosting each file in a dataset using DAS.
+
+    Gets the list of sites for the dataset, then the files at each site.
+    The file queries for all sites are run at the same time.
+
+    Parameters
+    ----------
+    dataset : str
+        Name of dataset
+    das_cache : DASCache, optional
+        Cache for DAS results. If None, always queries DAS.
+    site_query : multiprocessing.pool.AsyncResult, optional
+        Result of an already-started das_query_async() for 'site dataset=...'
+
+    Returns
+    -------
+    dict{str: set[str]}
+        Sites for each filename
+
+    Raises
+    ------
+    RuntimeError
+        If a DAS query fails
+    """
+    if site_query is None:
+        site_query = das_query_async('site dataset=%s' % dataset, das_cache=das_cache)
+    result = site_query.get(DAS_QUERY_TIMEOUT)
+    if result['status'] == 'fail':
+        raise RuntimeError('Error querying sites with das_client: %s' % result.get('reason'))
+    sites = sorted(set(site for entry in result['data'] for site in das_entry_sites(entry)))
+    log.debug("Sites for %s: %s", dataset, sites)
+
+    file_queries = [(site, das_query_async('file dataset=%s site=%s' % (dataset, site), das_cache=das_cache))
+                    for site in sites]
+    file_sites = {}
+    for site, query in file_queries:
+        result = query.get(DAS_QUERY_TIMEOUT)
+        if result['status'] == 'fail':
+            raise RuntimeError('Error querying files at %s with das_client: %s' % (site, result.get('reason')))
+        for entry in result['data']:
+            file_sites.setdefault(entry['file'][0]['name'], set()).add(site)
+    return file_sites
+
+
+def get_file_catalog_from_das(dataset, num_files, das_cache=None, events=False, sizes=False,
+                              sites=False):
+    """Create FileCatalog of num_files files for dataset using DAS.
+
+    Arguments are as for iter_das_file_entries(), except:
+
+    Parameters
+    ----------
+    events : bool, optional
+        If True, also get the number of events in each file & lumisection.
+    sizes : bool, optional
+        If True, also get the size & number of events of each file.
+        This is a separate DAS query, run at the same time.
+    sites : bool, optional
+        If True, also get the sites hosting each file.
+        These are separate DAS queries, started at the same time.
+
+    Returns
+    -------
+    FileCatalog
+        Catalog with filename and lumisections for each file.
+    """
+    if sizes:
+        size_query = das_query_async('file dataset=%s status=VALID' % dataset, das_cache=das_cache)
+    if sites:
+        site_query = das_query_async('site dataset=%s' % dataset, das_cache=das_cache)
+    catalog = FileCatalog()
+    fields = 'file,run,lumi,events' if events else 'file,run,lumi'
+    for entry in iter_das_file_entries(dataset, num_files, das_cache, fields):
+        catalog.add_file(entry['file'][0]['name'], das_file_to_compact_list(entry),
+                         num_events=das_file_number(entry['file'][0], 'nevents'),
+                         lumi_events=das_file_to_lumi_events(entry),
+                         size=das_file_number(entry['file'][0], 'size'))
+    if sizes:
+        result = size_query.get(DAS_QUERY_TIMEOUT)
+        if result['status'] == 'fail':
+            raise RuntimeError('Error querying file sizes with das_client: %s' % result.get('reason'))
+        file_info = dict((entry['file'][0]['name'], entry['file'][0]) for entry in result['data'])
+        for file_id, name in enumerate(catalog.names):
+            info = file_info.get(name, {})
+            catalog.file_size[file_id] = das_file_number(info, 'size')
+            if catalog.file_events[file_id] < 0:
+                catalog.file_events[file_id] = das_file_number(info, 'nevents')
+    if sites:
+        file_sites = get_file_sites_from_das(dataset, das_cache, site_query)
+        for file_id, name in enumerate(catalog.names):
+            catalog.sites[file_id].extend(sorted(file_sites.get(name, [])))
+    return catalog
+
+
+def get_list_of_files_from_das(dataset, num_files, das_cache=None):
+    """Create list of num_files filenames for dataset using DAS.
+
+    Parameters
+    ----------
+    dataset : str
+        Name of dataset
+    num_files : int
+        Total number of files to get.
+    das_cache : DASCache, optional
+        Cache for DAS results. If None, always queries DAS.
+
+    Returns
+    -------
+    list[DatasetFile]
+        List of DatasetFile obj with filename and lumisections for each file.
+
+    Raises
+    ------
+    RuntimeError
+        If DAS fails to find dataset
+
+    """
+    return list(iter_files_from_das(dataset, num_files, das_cache))
+
+
+def median(values):
+    """Median of a non-empty list of numbers"""
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else 0.5 * (values[mid - 1] + values[mid])
+
+
+TIME_REPORT_RE = re.compile(r'^TimeReport\s+event loop Real/event = ([0-9.eE+-]+)', re.MULTILINE)
+
+
+def parse_time_per_event(text):
+    """Get the real time per event (in seconds) from the cmsRun TimeReport.
+
+    Parameters
+    ----------
+    text : str
+        cmsRun output, e.g. contents of job .err file
+
+    Returns
+    -------
+    float
+        Time per event, or None if there is no TimeReport
+        (e.g. job failed, or wantSummary not set).
+    """
+    match = TIME_REPORT_RE.search(text)
+    return float(match.group(1)) if match else None
+
+
+def hash_file(filename):
+    """Get SHA1 hash of file contents"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def job_log_stem(config_hash):
+    """Start of the out/err/log filenames of jobs for a config,
+    to tell them apart from other jobs in the same log directory."""
+    return 'cmsRun.%s' % config_hash[:8]
+
+
+class TimingHistory(object):
+    """History of measured time per event & previous jobs for a CMSSW config.
+
+    Stored as JSON in timing_dir, one file per config hash, so that
+    repeated submissions of the same config use all previous measurements.
+    Each measurement is stored with its source (e.g. job .err file), so that
+    logs are only read once. The log directories of previous submissions are
+    also stored, so their jobs can be read once they have finished.
+    """
+
+    def __init__(self, timing_dir, config_filename):
+        self.config_hash = hash_file(config_filename)
+        stem = os.path.splitext(os.path.basename(config_filename))[0]
+        self.filename = os.path.join(timing_dir, '%s_%s.json' % (stem, self.config_hash[:16]))
+        self.data = {'config': os.path.abspath(config_filename),
+                     'logDirs': [], 'measurements': {}}
+        if os.path.isfile(self.filename):
+            with open(self.filename) as f:
+                self.data.update(json.load(f))
+
+    def add_log_dir(self, log_dir):
+        if log_dir not in self.data['logDirs']:
+            self.data['logDirs'].append(log_dir)
+
+    def add_measurement(self, source, time_per_event):
+        self.data['measurements'][source] = time_per_event
+
+    def job_log_files(self, extension):
+        """Get files ending in extension (e.g. .err) of previous jobs with this config"""
+        stem = job_log_stem(self.config_hash) + '.'
+        files = []
+        for log_dir in self.data['logDirs']:
+            if os.path.isdir(log_dir):
+                files.extend(os.path.join(log_dir, f) for f in sorted(os.listdir(log_dir))
+                             if f.startswith(stem) and f.endswith(extension))
+        return files
+
+    def update_from_logs(self):
+        """Read time per event from .err files of previous jobs not yet in the history.
+
+        Returns
+        -------
+        int
+            Number of new measurements
+        """
+        num_new = 0
+        for log_file in self.job_log_files('.err'):
+            if log_file in self.data['measurements']:
+                continue
+            with open(log_file) as f:
+                time_per_event = parse_time_per_event(f.read())
+            if time_per_event is not None:
+                self.add_measurement(log_file, time_per_event)
+                num_new += 1
+        log.debug("Found %d new timing measurements", num_new)
+        return num_new
+
+    def time_per_event(self):
+        """Median time per event in seconds, or None if no measurements."""
+        values = self.data['measurements'].values()
+        return median(values) if values else None
+
+    def save(self):
+        check_create_dir(os.path.dirname(self.filename))
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
+
+
+def run_probe_job(cmssw_config_filename, input_files, num_events):
+    """Run cmsRun locally over a few events to measure the time per event.
+
+    Parameters
+    ----------
+    cmssw_config_filename : str
+        CMSSW config filename
+    input_files : list[str]
+        Input files for the probe job
+    num_events : int
+        Number of events to run over
+
+    Returns
+    -------
+    float
+        Time per event in seconds
+
+    Raises
+    ------
+    RuntimeError
+        If cmsRun fails, or does not report the time per event
+    """
+    log.info("Running probe job over %d events to measure time per event...", num_events)
+    probe_dir = tempfile.mkdtemp()
+    wrapper_filename = os.path.join(probe_dir, 'probe.py')
+    with open(wrapper_filename, 'w') as wrapper:
+        wrapper.write("import sys\n")
+        wrapper.write("sys.path.insert(0, '%s')\n" % os.path.dirname(os.path.abspath(cmssw_config_filename)))
+        wrapper.write("import FWCore.ParameterSet.Config as cms\n")
+        wrapper.write("from %s import process\n" % os.path.splitext(os.path.basename(cmssw_config_filename))[0])
+        wrapper.write("process.source.fileNames = cms.untracked.vstring(%s)\n" % input_files)
+        wrapper.write("process.maxEvents = cms.untracked.PSet(input=cms.untracked.int32(%d))\n" % num_events)
+        wrapper.write("if not hasattr(process, 'options'): process.options = cms.untracked.PSet()\n")
+        wrapper.write("process.options.wantSummary = cms.untracked.bool(True)\n")
+    try:
+        # run in probe_dir so that any output files don't clutter the user's area
+        proc = subprocess.Popen(['cmsRun', wrapper_filename], cwd=probe_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+    finally:
+        shutil.rmtree(probe_dir)
+    if proc.returncode != 0:
+        log.error(out)
+        raise RuntimeError("Probe job failed with exit code %d" % proc.returncode)
+    time_per_event = parse_time_per_event(out)
+    if time_per_event is None:
+        raise RuntimeError("Probe job did not report the time per event")
+    log.info("Probe job: %g s/event", time_per_event)
+    return time_per_event
+
+
+def choose_units_per_job(catalog, time_per_event, target_minutes, unit='events'):
+    """Choose number of units per job to make each job take target_minutes.
+
+    Parameters
+    ----------
+    catalog : FileCatalog
+        Catalog of files with number of events
+    time_per_event : float
+        Time per event in seconds
+    target_minutes : float
+        Target job duration in minutes
+    unit : str, optional
+        One of 'events', 'lumis', 'files'
+
+    Returns
+    -------
+    int
+        Units per job, at least 1
+
+    Raises
+    ------
+    RuntimeError
+        If the number of events is unknown
+    """
+    total_events = sum(catalog.events)
+    if min(catalog.events or [0]) < 0 or total_events == 0:
+        raise RuntimeError("Need the number of events in each file to choose units per job")
+    events_per_job = target_minutes * 60. / time_per_event
+    if unit == 'events':
+        units = events_per_job
+    elif unit == 'lumis':
+        units = events_per_job * catalog.num_lumis() / total_events
+    elif unit == 'files':
+        units = events_per_job * len(catalog) / total_events
+    else:
+        raise RuntimeError("Unknown unit %s" % unit)
+    return max(1, int(round(units)))
+
+
+JOB_TIMING_RE = re.compile(r'^timing(\d+)\.json$')
+
+
+def load_job_timings(output_dir):
+    """Load the timing{ind}.json files written by cmsRun_worker.sh
+    into output_dir, sorted by job index.
+
+    Each has the wall & CPU time of each phase of the job,
+    and the CPU time & peak RSS of cmsRun.
+    """
+    timings = []
+    for filename in os.listdir(output_dir):
+        match = JOB_TIMING_RE.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(output_dir, filename)) as f:
+            try:
+                timing = json.load(f)
+            except ValueError:
+                log.warning('Cannot read timing file %s', filename)
+                continue
+        timing['job'] = int(match.group(1))
+        timings.append(timing)
+    return sorted(timings, key=lambda t: t['job'])
+
+
+def summarise_job_timings(timings):
+    """Aggregate job timings across all jobs (e.g. in a DAG).
+
+    Parameters
+    ----------
+    timings : list[dict]
+        Job timings, from load_job_timings
+
+    Returns
+    -------
+    dict
+        'phases': list of per-phase dicts, in the order they ran, of
+        name, jobs, wall_mean, wall_median, wall_max, wall_total, cpu_total.
+        Also the number of jobs, failed jobs, cmsRun CPU time,
+        and the median & max cmsRun peak RSS in kB.
+    """
+    phase_names = []
+    phase_walls, phase_cpus = {}, {}
+    for timing in timings:
+        for phase in timing['phases']:
+            if phase['name'] not in phase_walls:
+                phase_names.append(phase['name'])
+            phase_walls.setdefault(phase['name'], []).append(phase['wall'])
+            phase_cpus.setdefault(phase['name'], []).append(phase['cpu'])
+
+    phases = []
+    for name in phase_names:
+        walls = phase_walls[name]
+        phases.append(dict(name=name, jobs=len(walls), wall_mean=sum(walls) / len(walls),
+                           wall_median=median(walls), wall_max=max(walls), wall_total=sum(walls),
+                           cpu_total=sum(phase_cpus[name])))
+
+    cmsrun = [t['cmsRun'] for t in timings if 'cmsRun' in t]
+    rss = [c['max_rss_kb'] for c in cmsrun]
+    return dict(phases=phases, jobs=len(timings),
+                failed=sum(1 for t in timings if t.get('exit_code', 0) != 0),
+                cmsrun_cpu=sum(c['user'] + c['sys'] for c in cmsrun),
+                max_rss_kb_median=median(rss) if rss else None,
+                max_rss_kb_max=max(rss) if rss else None)
+
+
+def print_job_timings(summary):
+    """Print table of job timings summary from summarise_job_timings"""
+    log.info('%d jobs, %d failed', summary['jobs'], summary['failed'])
+    total_wall = sum(p['wall_total'] for p in summary['phases'])
+    log.info('%-16s %6s %10s %10s %10s %12s %12s %6s',
+             'phase', 'jobs', 'mean [s]', 'median [s]', 'max [s]', 'total [s]', 'CPU [s]', 'wall%')
+    for p in summary['phases']:
+        log.info('%-16s %6d %10.1f %10.1f %10.1f %12.1f %12.1f %5.1f%%',
+                 p['name'], p['jobs'], p['wall_mean'], p['wall_median'], p['wall_max'],
+                 p['wall_total'], p['cpu_total'], 100. * p['wall_total'] / total_wall if total_wall else 0)
+    if summary['max_rss_kb_max'] is not None:
+        log.info('cmsRun CPU: %.1f s, peak RSS median: %.1f MB, max: %.1f MB', summary['cmsrun_cpu'],
+                 summary['max_rss_kb_median'] / 1024., summary['max_rss_kb_max'] / 1024.)
+
+
+def job_timing(in_args=sys.argv[2:]):
+    """Summarise the phase timings of all jobs in an output directory.
+    Run as `cmsRunCondor.py timing <outputDir>`."""
+    parser = argparse.ArgumentParser(prog='cmsRunCondor.py timing', description=job_timing.__doc__)
+    parser.add_argument('outputDir', help='--outputDir of the jobs')
+    parser.add_argument('--json', help='Also save the summary to this JSON file')
+    args = parser.parse_args(args=in_args)
+
+    timings = load_job_timings(args.outputDir)
+    if not timings:
+        raise IOError('No timing files in %s' % args.outputDir)
+    summary = summarise_job_timings(timings)
+    print_job_timings(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+JOB_REPORT_RE = re.compile(r'^report(\d+)\.xml$')
+
+# Columns for per-job & per-file CSV output of job reports
+JOB_REPORT_COLUMNS = ['job', 'exit_code', 'events', 'wall', 'cpu', 'threads', 'cpu_efficiency',
+                      'read_mb', 'read_s', 'read_mb_per_s', 'peak_rss_mb', 'files_read', 'files_failed']
+FILE_REPORT_COLUMNS = ['job', 'lfn', 'pfn', 'input_type', 'events', 'read_mb', 'read_s', 'read_mb_per_s',
+                       'status']
+
+# FrameworkError types that mean an input file couldn't be read
+FILE_ERROR_TYPES = ['FileOpenError', 'FileReadError', 'FallbackFileOpenError']
+FILE_ERROR_NAME_RE = re.compile(r'((?:root|file|gsiftp|srm)://?\S+|/store/\S+)')
+
+
+def report_float(value, default=0.):
+    """float(value), or default if it isn't a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_job_report(filename):
+    """Parse a cmsRun FrameworkJobReport XML file.
+
+    Parsed incrementally, clearing each top-level element (InputFile,
+    PerformanceReport, etc) once finished, so large reports don't need to
+    be held in memory.
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    dict, list[dict]
+        Job summary with JOB_REPORT_COLUMNS keys, and a dict for each input
+        file with FILE_REPORT_COLUMNS keys. A report with no job number in its
+        filename has job = -1. An unreadable report (e.g. job killed while
+        writing it) has exit_code = -1.
+
+    The FJR only has read statistics for the whole job, so each file's
+    read_mb and read_s are the job's, shared in proportion to events read.
+    """
+    match = JOB_REPORT_RE.match(os.path.basename(filename))
+    job_ind = int(match.group(1)) if match else -1
+    metrics = {}
+    files = []
+    failed = []
+    exit_code = 0
+    root = None
+    depth = 0
+    try:
+        for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if elem.tag == 'InputFile':
+                files.append(dict(job=job_ind, lfn=elem.findtext('LFN', '').strip(),
+                                  pfn=elem.findtext('PFN', '').strip(),
+                                  input_type=elem.findtext('InputType', 'primaryFiles').strip(),
+                                  events=int(report_float(elem.findtext('EventsRead'))), status='ok'))
+            elif elem.tag == 'Metric':
+                # Newer CMSSW prefix storage metrics with Timing-
+                name = elem.get('Name', '')
+                metrics[name[7:] if name.startswith('Timing-') else name] = elem.get('Value')
+            elif elem.tag == 'SkippedFile':
+                failed.append(dict(job=job_ind, lfn=elem.get('Lfn', ''), pfn=elem.get('Pfn', ''),
+                                   input_type='', events=0, status='skipped'))
+            elif elem.tag == 'FrameworkError':
+                exit_code = int(report_float(elem.get('ExitStatus'), -1)) or exit_code
+                if elem.get('Type') in FILE_ERROR_TYPES:
+                    name = FILE_ERROR_NAME_RE.search(elem.text or '')
+                    failed.append(dict(job=job_ind, lfn='', pfn=name.group(1).rstrip('.,\'"') if name else '',
+                                       input_type='', events=0, status='failed'))
+            if depth == 1:
+                root.clear()
+    except SyntaxError as err:  # ElementTree.ParseError is a SyntaxError
+        log.warning('Cannot parse job report %s: %s', filename, err)
+        exit_code = -1
+
+    # secondary files have the same events as the primary ones
+    primary_files = [f for f in files if f['input_type'] != 'secondaryFiles']
+    events = sum(f['events'] for f in primary_files)
+    wall = report_float(metrics.get('TotalJobTime'))
+    cpu = report_float(metrics.get('TotalJobCPU'))
+    threads = int(report_float(metrics.get('NumberOfThreads'), 1)) or 1
+    read_mb = report_float(metrics.get('tstoragefile-read-totalMegabytes'))
+    read_s = report_float(metrics.get('tstoragefile-read-totalMsecs')) / 1000.
+    job = dict(job=job_ind, exit_code=exit_code, events=events, wall=wall, cpu=cpu, threads=threads,
+               cpu_efficiency=cpu / (wall * threads) if wall else 0.,
+               read_mb=read_mb, read_s=read_s, read_mb_per_s=read_mb / read_s if read_s else 0.,
+               peak_rss_mb=report_float(metrics.get('PeakValueRss')),
+               files_read=len(files), files_failed=len(failed))
+    file_events = sum(f['events'] for f in files)
+    for f in files:
+        fraction = float(f['events']) / file_events if file_events else 1. / len(files)
+        f.update(read_mb=read_mb * fraction, read_s=read_s * fraction, read_mb_per_s=job['read_mb_per_s'])
+    for f in failed:
+        f.update(read_mb=0., read_s=0., read_mb_per_s=0.)
+    return job, files + failed
+
+
+def parse_job_reports(filenames, num_procs=None):
+    """Parse many job reports in parallel with parse_job_report.
+
+    Returns
+    -------
+    list[dict], list[dict]
+        Job summaries sorted by job number, and all their input files.
+    """
+    jobs, files = [], []
+    if not filenames:
+        return jobs, files
+    pool = Pool(min(num_procs or cpu_count(), len(filenames)))
     try:
-        files = [DatasetFile(name=entry['file'][0]['name'], lumi_list=das_file_to_lumilist(entry))
-                 for entry in file_dict['data']]
-    except KeyError as e:
-        print file_dict
-        raise e
-    return files
+        for job, job_files in pool.imap_unordered(parse_job_report, filenames, chunksize=16):
+            jobs.append(job)
+            files.extend(job_files)
+    finally:
+        pool.close()
+        pool.join()
+    jobs.sort(key=lambda j: j['job'])
+    files.sort(key=lambda f: f['job'])
+    return jobs, files
+
+
+def summarise_job_reports(jobs, files):
+    """Aggregate job report summaries from parse_job_reports over all jobs"""
+    wall = sum(j['wall'] for j in jobs)
+    read_s = sum(j['read_s'] for j in jobs)
+    read_mb = sum(j['read_mb'] for j in jobs)
+    throughputs = [j['read_mb_per_s'] for j in jobs if j['read_s']]
+    return dict(jobs=len(jobs), failed_jobs=sum(1 for j in jobs if j['exit_code'] != 0),
+                events=sum(j['events'] for j in jobs), wall=wall,
+                cpu=sum(j['cpu'] for j in jobs),
+                cpu_efficiency=(sum(j['cpu'] for j in jobs) / sum(j['wall'] * j['threads'] for j in jobs)
+                                if wall else 0.),
+                read_mb=read_mb, read_s=read_s, read_mb_per_s=read_mb / read_s if read_s else 0.,
+                median_read_mb_per_s=median(throughputs) if throughputs else 0.,
+                peak_rss_mb=max([j['peak_rss_mb'] for j in jobs] or [0.]),
+                files_read=sum(1 for f in files if f['status'] == 'ok'),
+                failed_files=sorted({f['pfn'] or f['lfn'] for f in files if f['status'] != 'ok'}))
+
+
+def print_job_reports(summary, num_failed_files=20):
+    """Print table of job report summary from summarise_job_reports"""
+    rows = [('Jobs', '%d' % summary['jobs']),
+            ('Failed jobs', '%d' % summary['failed_jobs']),
+            ('Events processed', '%d' % summary['events']),
+            ('Events/s', '%.2f' % (summary['events'] / summary['wall'] if summary['wall'] else 0)),
+            ('Wall time [h]', '%.2f' % (summary['wall'] / 3600.)),
+            ('CPU time [h]', '%.2f' % (summary['cpu'] / 3600.)),
+            ('CPU efficiency', '%.1f%%' % (100. * summary['cpu_efficiency'])),
+            ('Read [GB]', '%.2f' % (summary['read_mb'] / 1024.)),
+            ('Read time [h]', '%.2f' % (summary['read_s'] / 3600.)),
+            ('Read rate [MB/s]', '%.2f' % summary['read_mb_per_s']),
+            ('Median job read rate [MB/s]', '%.2f' % summary['median_read_mb_per_s']),
+            ('Max peak RSS [MB]', '%.1f' % summary['peak_rss_mb']),
+            ('Files read', '%d' % summary['files_read']),
+            ('Failed files', '%d' % len(summary['failed_files']))]
+    for name, value in rows:
+        log.info('%-28s %12s', name, value)
+    for filename in summary['failed_files'][:num_failed_files]:
+        log.info('  failed: %s', filename)
+    if len(summary['failed_files']) > num_failed_files:
+        log.info('  ... and %d more', len(summary['failed_files']) - num_failed_files)
+
+
+def save_report_table(rows, columns, filename):
+    """Save list of dicts to CSV, or Parquet if filename ends in .parquet
+    (needs pandas with pyarrow or fastparquet)."""
+    if filename.endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise RuntimeError('Need pandas to save %s, use .csv instead' % filename)
+        pd.DataFrame(rows, columns=columns).to_parquet(filename)
+    else:
+        with open(filename, 'wb') as f:
+            writer = csv.DictWriter(f, columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+    log.info('Saved %d rows to %s', len(rows), filename)
+
+
+def job_report(in_args=sys.argv[2:]):
+    """Summarise the cmsRun job reports (report<N>.xml) of all jobs in an
+    output directory: events, CPU efficiency, read rates, failed files.
+    Run as `cmsRunCondor.py report <outputDir>`."""
+    parser = argparse.ArgumentParser(prog='cmsRunCondor.py report', description=job_report.__doc__)
+    parser.add_argument('outputDir', help='--outputDir of the jobs')
+    parser.add_argument('--jobsFile', help='Save per-job results to this .csv or .parquet file')
+    parser.add_argument('--filesFile', help='Save per-input file results to this .csv or .parquet file')
+    parser.add_argument('--procs', type=int, default=cpu_count(), help='Number of processes to parse with')
+    args = parser.parse_args(args=in_args)
+
+    filenames = [os.path.join(args.outputDir, f) for f in os.listdir(args.outputDir) if JOB_REPORT_RE.match(f)]
+    if not filenames:
+        raise IOError('No job reports in %s' % args.outputDir)
+    log.info('Parsing %d job reports', len(filenames))
+    jobs, files = parse_job_reports(filenames, args.procs)
+    summary = summarise_job_reports(jobs, files)
+    print_job_reports(summary)
+    if args.jobsFile:
+        save_report_table(jobs, JOB_REPORT_COLUMNS, args.jobsFile)
+    if args.filesFile:
+        save_report_table(files, FILE_REPORT_COLUMNS, args.filesFile)
+    return summary
+
+
+# HTCondor user log event header, e.g.
+# 005 (153388.000.000) 10/24 14:36:49 Job terminated.
+# Newer versions use 2016-10-24 for the date
+CONDOR_EVENT_RE = re.compile(r'^(\d{3}) \((\d+)\.(\d+)\.\d+\) (\S+) (\d\d:\d\d:\d\d)(?:\.\d+)? (.*)$')
+CONDOR_RETURN_RE = re.compile(r'\((return value|signal) (\d+)\)')
+CONDOR_USAGE_RE = re.compile(r'Usr (\d+) (\d+):(\d+):(\d+), Sys (\d+) (\d+):(\d+):(\d+)  -  Run Remote Usage')
+CONDOR_VALUE_RE = re.compile(r'^\s*(\d+)  -  (.+)$')
+CONDOR_RESOURCE_RE = re.compile(r'^\s*(Cpus|Disk \(KB\)|Memory \(MB\))\s*:\s*(\d*)\s+(\d+)\s+(\d+)')
+
+# Columns for per-job & time series CSV output of condor logs
+CONDOR_JOB_COLUMNS = ['cluster', 'proc', 'log', 'host', 'return_value', 'signal', 'executions', 'evictions',
+                      'holds', 'queue_wait', 'run_time', 'cpu', 'cpu_efficiency', 'peak_rss_kb', 'peak_memory_mb',
+                      'memory_request_mb', 'disk_kb', 'disk_request_kb', 'bytes_sent', 'bytes_received']
+CONDOR_SERIES_COLUMNS = ['cluster', 'proc', 'time', 'memory_mb', 'rss_kb']
+
+
+def parse_condor_time(date, clock, previous=None):
+    """Convert condor log date & time to datetime.
+
+    Old logs have no year (10/24), so use a leap year (so 02/29 works),
+    and go to the next year if time goes backwards from previous.
+    """
+    if '-' in date:
+        return datetime.strptime(date + ' ' + clock, '%Y-%m-%d %H:%M:%S')
+    parts = date.split('/')
+    year = int(parts[2]) + 2000 if len(parts) == 3 else (previous.year if previous else 2000)
+    this_time = datetime.strptime('%s/%s/%d %s' % (parts[0], parts[1], year, clock), '%m/%d/%Y %H:%M:%S')
+    if previous and len(parts) == 2 and this_time < previous - timedelta(days=1):
+        this_time = this_time.replace(year=year + 1)
+    return this_time
+
+
+def iter_condor_log_events(log_file):
+    """Iterate over events in a condor user log, one line at a time.
+
+    Parameters
+    ----------
+    log_file : file
+        Open condor user log
+
+    Yields
+    ------
+    int, int, int, datetime, str, list[str]
+        Event code, cluster, process, time, header text, other lines of event
+    """
+    event = None
+    previous_time = None
+    for line in log_file:
+        line = line.rstrip('\n')
+        if line == '...':
+            if event:
+                yield event
+            event = None
+            continue
+        match = CONDOR_EVENT_RE.match(line)
+        if match and event is None:
+            previous_time = parse_condor_time(match.group(4), match.group(5), previous_time)
+            event = (int(match.group(1)), int(match.group(2)), int(match.group(3)), previous_time,
+                     match.group(6), [])
+        elif event:
+            event[5].append(line)
+    if event:
+        yield event
+
+
+def new_condor_job(cluster, proc, log_filename):
+    """Empty job for parse_condor_log to fill in"""
+    job = {k: None for k in CONDOR_JOB_COLUMNS}
+    job.update(cluster=cluster, proc=proc, log=log_filename, executions=0, evictions=0, holds=0,
+               peak_rss_kb=0, peak_memory_mb=0, series=[], submit=None, first_start=None, start=None,
+               end=None)
+    return job
+
+
+def parse_condor_log(log_filename):
+    """Parse a condor user log.
+
+    Parameters
+    ----------
+    log_filename : str
+
+    Returns
+    -------
+    list[dict]
+        For each job in the log, a dict with CONDOR_JOB_COLUMNS keys,
+        plus 'series': list of (seconds since job started running,
+        MemoryUsage in MB, ResidentSetSize in KB) from image size updates.
+        queue_wait is time from submission to first execution,
+        run_time from last execution to termination, and cpu the remote
+        user + sys CPU time, all in seconds. Any that are not in the log
+        (e.g. job still running) are None.
+    """
+    jobs = {}
+    with open(log_filename) as log_file:
+        for code, cluster, proc, event_time, text, lines in iter_condor_log_events(log_file):
+            job = jobs.get((cluster, proc))
+            if job is None:
+                job = jobs[(cluster, proc)] = new_condor_job(cluster, proc, log_filename)
+            if code == 0:  # submitted
+                job['submit'] = event_time
+            elif code == 1:  # executing
+                job['executions'] += 1
+                if job['first_start'] is None:
+                    job['first_start'] = event_time
+                job['start'] = event_time
+                job['host'] = text.split('host:')[-1].strip().strip('<>').split(':')[0]
+            elif code == 4:  # evicted
+                job['evictions'] += 1
+            elif code == 12:  # held
+                job['holds'] += 1
+            elif code == 6:  # image size updated
+                values = {}
+                for line in lines:
+                    match = CONDOR_VALUE_RE.match(line)
+                    if match:
+                        values[match.group(2).strip()] = int(match.group(1))
+                memory = values.get('MemoryUsage of job (MB)', 0)
+                rss = values.get('ResidentSetSize of job (KB)', 0)
+                job['peak_memory_mb'] = max(job['peak_memory_mb'], memory)
+                job['peak_rss_kb'] = max(job['peak_rss_kb'], rss)
+                since_start = (event_time - job['start']).total_seconds() if job['start'] else None
+                job['series'].append((since_start, memory, rss))
+            elif code in (5, 9):  # terminated, aborted
+                job['end'] = event_time
+                parse_condor_termination(job, lines)
+
+    for job in jobs.itervalues():
+        if job['submit'] and job['first_start']:
+            job['queue_wait'] = (job['first_start'] - job['submit']).total_seconds()
+        if job['start'] and job['end'] and job['executions']:
+            job['run_time'] = (job['end'] - job['start']).total_seconds()
+        if job['cpu'] is not None and job['run_time']:
+            job['cpu_efficiency'] = job['cpu'] / job['run_time']
+    return sorted(jobs.values(), key=lambda j: (j['cluster'], j['proc']))
+
+
+def parse_condor_termination(job, lines):
+    """Get return value (or signal if killed), CPU usage, bytes transferred,
+    and resource usage & requests from the lines of a job terminated event"""
+    for line in lines:
+        match = CONDOR_RETURN_RE.search(line)
+        if match and job['return_value'] is None and job['signal'] is None:
+            job['return_value' if match.group(1) == 'return value' else 'signal'] = int(match.group(2))
+            continue
+        match = CONDOR_USAGE_RE.search(line)
+        if match:
+            t = [int(x) for x in match.groups()]
+            job['cpu'] = float(t[0] * 86400 + t[1] * 3600 + t[2] * 60 + t[3] +
+                               t[4] * 86400 + t[5] * 3600 + t[6] * 60 + t[7])
+            continue
+        match = CONDOR_VALUE_RE.match(line)
+        if match:
+            if match.group(2).strip() == 'Run Bytes Sent By Job':
+                job['bytes_sent'] = int(match.group(1))
+            elif match.group(2).strip() == 'Run Bytes Received By Job':
+                job['bytes_received'] = int(match.group(1))
+            continue
+        match = CONDOR_RESOURCE_RE.match(line)
+        if match:
+            usage = int(match.group(2)) if match.group(2) else None
+            if match.group(1) == 'Disk (KB)':
+                job['disk_kb'], job['disk_request_kb'] = usage, int(match.group(3))
+            elif match.group(1) == 'Memory (MB)':
+                job['peak_memory_mb'] = max(job['peak_memory_mb'], usage or 0)
+                job['memory_request_mb'] = int(match.group(3))
+
+
+def parse_condor_logs(log_filenames, num_procs=None):
+    """Parse many condor user logs in parallel with parse_condor_log.
+
+    Returns
+    -------
+    list[dict]
+        Jobs from all logs, sorted by cluster & process.
+    """
+    jobs = []
+    if not log_filenames:
+        return jobs
+    pool = Pool(min(num_procs or cpu_count(), len(log_filenames)))
+    try:
+        for log_jobs in pool.imap_unordered(parse_condor_log, log_filenames, chunksize=32):
+            jobs.extend(log_jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(jobs, key=lambda j: (j['cluster'], j['proc']))
+
+
+def find_condor_logs(log_dirs):
+    """Get all condor user logs (*.log) in log_dirs"""
+    return [os.path.join(log_dir, f) for log_dir in log_dirs
+            for f in sorted(os.listdir(log_dir)) if f.endswith('.log')]
+
+
+def print_condor_jobs(jobs):
+    """Print table of median & max of condor job properties"""
+    log.info('%d jobs, %d finished, %d non-zero return value, %d killed by a signal', len(jobs),
+             sum(1 for j in jobs if j['run_time'] is not None),
+             sum(1 for j in jobs if j['return_value']),
+             sum(1 for j in jobs if j['signal'] is not None))
+    log.info('%-24s %12s %12s', '', 'median', 'max')
+    for name, key, scale in [('Queue wait [min]', 'queue_wait', 1 / 60.),
+                             ('Run time [min]', 'run_time', 1 / 60.),
+                             ('CPU time [min]', 'cpu', 1 / 60.),
+                             ('CPU efficiency [%]', 'cpu_efficiency', 100.),
+                             ('Peak RSS [MB]', 'peak_rss_kb', 1 / 1024.),
+                             ('Peak memory [MB]', 'peak_memory_mb', 1.),
+                             ('Disk [MB]', 'disk_kb', 1 / 1024.),
+                             ('Executions', 'executions', 1.)]:
+        values = [j[key] * scale for j in jobs if j[key] is not None]
+        if values:
+            log.info('%-24s %12.1f %12.1f', name, median(values), max(values))
+
+
+def condor_logs(in_args=sys.argv[2:]):
+    """Summarise the condor user logs of jobs: queue wait, run time,
+    CPU usage, and peak memory.
+    Run as `cmsRunCondor.py logs <logDir> [<logDir> ...]`."""
+    parser = argparse.ArgumentParser(prog='cmsRunCondor.py logs', description=condor_logs.__doc__)
+    parser.add_argument('logDir', nargs='+', help='--logDir of the jobs')
+    parser.add_argument('--jobsFile', help='Save per-job results to this .csv or .parquet file')
+    parser.add_argument('--seriesFile', help='Save memory usage over time to this .csv or .parquet file')
+    parser.add_argument('--procs', type=int, default=cpu_count(), help='Number of processes to parse with')
+    args = parser.parse_args(args=in_args)
+
+    log_filenames = find_condor_logs(args.logDir)
+    if not log_filenames:
+        raise IOError('No condor logs in %s' % ' '.join(args.logDir))
+    log.info('Parsing %d condor logs', len(log_filenames))
+    jobs = parse_condor_logs(log_filenames, args.procs)
+    print_condor_jobs(jobs)
+    if args.jobsFile:
+        save_report_table(jobs, CONDOR_JOB_COLUMNS, args.jobsFile)
+    if args.seriesFile:
+        series = [dict(cluster=j['cluster'], proc=j['proc'], time=t, memory_mb=mem, rss_kb=rss)
+                  for j in jobs for t, mem, rss in j['series']]
+        save_report_table(series, CONDOR_SERIES_COLUMNS, args.seriesFile)
+    return jobs
+
+
+def round_up(value, step):
+    """Round value up to a multiple of step"""
+    return int(math.ceil(value / float(step)) * step)
+
+
+def estimate_job_resources(jobs, margin):
+    """Choose memory & disk requests from the peak usage of previous jobs.
+
+    Uses the maximum over jobs, since a job that needs more than it requested
+    gets held. Jobs that didn't finish (e.g. held for using too much memory)
+    still count for memory.
+
+    Parameters
+    ----------
+    jobs : list[dict]
+        Previous jobs, from parse_condor_logs
+    margin : float
+        Fraction to add to the peak usage
+
+    Returns
+    -------
+    int, int
+        Memory & disk requests in MB, rounded up to 100 MB,
+        or None if either is unknown.
+    """
+    memory = [max(j['peak_memory_mb'], j['peak_rss_kb'] / 1024.) for j in jobs]
+    disk = [j['disk_kb'] / 1024. for j in jobs if j['disk_kb']]
+    if not any(memory) or not disk:
+        return None
+    return round_up(max(memory) * (1 + margin), 100), round_up(max(disk) * (1 + margin), 100)
 
 
 def get_output_files_from_config(cmssw_config_filename):
     """Get any output filenames from the CMSSW config file"""
+    return get_output_modules_from_config(cmssw_config_filename).values()
+
+
+def get_output_modules_from_config(cmssw_config_filename):
+    """Get {module label: output filename} from the CMSSW config file.
+    The TFileService has the label TFileService."""
     import FWCore.ParameterSet.Config as cms
     # Particularly nasty hack to cope with CMSSW configs that use VarParsing
     # These read in sys.argv, which of course is tailored for cmsRunCondor,
@@ -660,18 +3598,111 @@ def get_output_files_from_config(cmssw_config_filename):
     sys.path.append(os.path.dirname(cmssw_config_filename))
     myscript = __import__(os.path.basename(cmssw_config_filename).replace(".py", ""))
     process = myscript.process
-    output_files = []
+    output_files = OrderedDict()
     # do separately for TFileService as not an outputModule
     if hasattr(process, 'TFileService'):
-        output_files.append(process.TFileService.fileName.value())
-    for omod in process.outputModules.itervalues():
-        output_files.append(omod.fileName.value())
+        output_files['TFileService'] = process.TFileService.fileName.value()
+    for label, omod in process.outputModules.iteritems():
+        output_files[label] = omod.fileName.value()
     # reset everything as it was before
     sys.path.remove(os.path.dirname(cmssw_config_filename))
     sys.argv = keep_argv[:]
     return output_files
 
 
+def add_hadd_jobs(dag, cmsrun_jobs, output_filename, output_dir, group_size, hadd_args,
+                  condor_filename, log_dir, label, file_mb=100, margin=0.25):
+    """Add jobs to a DAG to hadd an output file from each cmsRun job,
+    using a tree of hadd jobs from haddaway.
+
+    Each hadd job in the first level only needs its group of cmsRun jobs
+    to finish, so merging happens while other jobs are still running.
+    Only the final hadd waits for everything.
+
+    Parameters
+    ----------
+    dag : htcondenser.DAGMan
+        DAG the cmsRun jobs are in
+    cmsrun_jobs : list[htcondenser.Job]
+        cmsRun jobs, in order of job index
+    output_filename : str
+        Output filename in the config, each job's is output_filename_<index>.root
+    output_dir : str
+        Directory on /hdfs with job output files. The final file goes here.
+    group_size : int
+        Number of files for each hadd job
+    hadd_args : str
+        Arguments to pass to hadd
+    condor_filename : str
+        Filename stem for the hadd & cleanup condor submit files
+    log_dir : str
+        Directory for hadd job logs
+    label : str
+        Module label, to make job names unique
+    file_mb : float, optional
+        Expected size of each cmsRun job's output file in MB, since the real
+        sizes aren't known until the jobs have run. Used to estimate the memory
+        & disk needed for each hadd job, as in haddaway.
+    margin : float, optional
+        Fraction to add to the memory & disk estimates
+
+    Returns
+    -------
+    list[list[htcondenser.Job]]
+        hadd jobs for each level, the last level being only the final hadd
+    """
+    job_files = [os.path.join(output_dir, output_filename.replace('.root', '_%d.root' % ind))
+                 for ind in xrange(len(cmsrun_jobs))]
+    producers = dict(izip(job_files, cmsrun_jobs))
+    final_filename = os.path.join(output_dir, output_filename)
+    name_prefix = 'hadd_%s_' % label
+    job_levels, requires = haddaway.create_hadd_jobs(job_files, group_size, final_filename,
+                                                     hadd_args=hadd_args, name_prefix=name_prefix)
+
+    condor_stem = os.path.splitext(condor_filename)[0] + '_' + name_prefix
+    log_stem = name_prefix + '$(cluster).$(process)'
+    file_sizes = dict.fromkeys(job_files, file_mb * 1024 ** 2)
+    for level_ind, jobs in enumerate(job_levels):
+        for (memory, disk), bucket_jobs in haddaway.bucket_hadd_jobs(jobs, file_sizes, margin):
+            log.info("hadd %s level %d: %d jobs requesting %dMB memory, %dMB disk",
+                     label, level_ind, len(bucket_jobs), memory, disk)
+            hadd_jobset = ht.JobSet(exe='hadd', copy_exe=False,
+                                    filename='%s%d_%d_%d.condor' % (condor_stem, level_ind, memory, disk),
+                                    out_dir=log_dir, out_file=log_stem + '.out',
+                                    err_dir=log_dir, err_file=log_stem + '.err',
+                                    log_dir=log_dir, log_file=log_stem + '.log',
+                                    cpus=1, memory='%dMB' % memory, disk='%dMB' % disk,
+                                    transfer_hdfs_input=True,
+                                    share_exe_setup=True,
+                                    hdfs_store=output_dir)
+            for job in bucket_jobs:
+                hadd_jobset.add_job(job)
+                # job files can be passed up to any level
+                dag.add_job(job, requires=requires[job.name] + [producers[f] for f in job.input_files
+                                                                 if f in producers])
+
+    # remove intermediate files once they have been merged
+    inter_jobs = [job for jobs in job_levels[:-1] for job in jobs]
+    if inter_jobs:
+        consumers = {parent.name: job for jobs in job_levels for job in jobs for parent in requires[job.name]}
+        rm_jobset = ht.JobSet(exe='hadoop', copy_exe=False,
+                              filename=condor_stem + 'rm.condor',
+                              out_dir=log_dir, out_file=name_prefix + 'rm.$(cluster).$(process).out',
+                              err_dir=log_dir, err_file=name_prefix + 'rm.$(cluster).$(process).err',
+                              log_dir=log_dir, log_file=name_prefix + 'rm.$(cluster).$(process).log',
+                              cpus=1, memory='100MB', disk='10MB',
+                              transfer_hdfs_input=False,
+                              share_exe_setup=False,
+                              hdfs_store=output_dir)
+        for inter_job, rm_job in izip(inter_jobs, haddaway.create_intermediate_cleanup_jobs(inter_jobs, name_prefix)):
+            rm_jobset.add_job(rm_job)
+            dag.add_job(rm_job, requires=consumers[inter_job.name])
+
+    log.info("hadd %s output with %d jobs in %d levels", label, sum(len(jobs) for jobs in job_levels),
+             len(job_levels))
+    return job_levels
+
+
 def check_create_dir(dirname, info_msg=None, debug_msg=None):
     """Check if directory exists, if not make it."""
     if not os.path.isdir(dirname):
@@ -755,6 +3786,9 @@ def cmsRunCondor(in_args=sys.argv[1:]):
 
     check_args(args)
 
+    # Previous jobs with this config, for their timing & resource usage
+    timing_history = TimingHistory(args.timingDir, args.config)
+
     # Why not just use args.lumiMask to hold result?
     run_list = parse_run_range(args.runRange) if args.runRange else None
     lumi_mask = setup_lumi_mask(args.lumiMask) if args.lumiMask else None
@@ -772,11 +3806,14 @@ def cmsRunCondor(in_args=sys.argv[1:]):
     # This could probably be done better!
 
     if not args.valgrind and not args.callgrind and not args.asIs:
-        list_of_files, list_of_secondary_files = None, None
-        list_of_lumis = None
+        list_of_files, catalog = None, None
+        das_cache = None
+        if args.dasCache:
+            das_cache = DASCache(args.dasCache, args.dasCacheTTL, args.refreshDAS)
 
-        if args.unitsPerJob is None:
-            raise RuntimeError('You must specify an integer number of --unitsPerJob')
+        if args.unitsPerJob is None and not args.targetJobMinutes:
+            raise RuntimeError('You must specify an integer number of --unitsPerJob '
+                               'or --targetJobMinutes')
 
         if args.filelist:
             # Get files from user's file
@@ -797,54 +3834,95 @@ def cmsRunCondor(in_args=sys.argv[1:]):
         else:
             filelist_filename = generate_filelist_filename(args.dataset)
             lumilist_filename = generate_lumilist_filename(args.dataset)
-            # Get list of files from DAS, also store corresponding lumis
+            # Get files from DAS, also store corresponding lumis, in a compact
+            # FileCatalog. The secondary dataset is fetched and indexed in the
+            # background whilst this happens.
+            if args.secondaryDataset:
+                index_pool = ThreadPool(1)
+                secondary_result = index_pool.apply_async(
+                    lambda: LumiIndex(get_file_catalog_from_das(args.secondaryDataset, -1, das_cache)))
+                index_pool.close()
             n_files = args.totalUnits if args.splitByFiles else -1
-            list_of_files = get_list_of_files_from_das(args.dataset, n_files)
-            log.debug("Pre lumi filter")
-            log.debug(list_of_files)
+            catalog = get_file_catalog_from_das(args.dataset, n_files, das_cache,
+                                                events=args.splitByEvents or bool(args.targetJobMinutes),
+                                                sizes=args.grouping != 'sequential',
+                                                sites=args.siteAware)
             if run_list:
-                list_of_files = filter_by_run_num(list_of_files, run_list)
+                catalog = catalog.filter_by_run_num(run_list)
             if lumi_mask:
-                list_of_files = filter_by_lumi_list(list_of_files, lumi_mask)
-            log.debug("After lumi filter")
-            log.debug(list_of_files)
+                catalog = catalog.filter_by_lumi_mask(lumi_mask)
             if args.secondaryDataset:
-                list_of_secondary_files = get_list_of_files_from_das(args.secondaryDataset, -1)
                 # do lumisection matching between primary and secondary datasets
-                for f in list_of_files:
-                    f.parents = find_matching_files(list_of_secondary_files, f.lumi_list)
+                catalog.match_parents(secondary_result.get(DAS_QUERY_TIMEOUT))
+            if args.siteAware:
+                # so jobs split by lumis/events mostly have files at one site
+                catalog = catalog.group_by_site()
+                num_local = sum(LOCAL_SITE in file_sites for file_sites in catalog.sites)
+                log.info("%d/%d files are at %s", num_local, len(catalog), LOCAL_SITE)
+            list_of_files = catalog.files()
+
+        if args.targetJobMinutes:
+            timing_history.update_from_logs()
+            if args.probeEvents > 0:
+                probe_time = run_probe_job(args.config, catalog.names[:1], args.probeEvents)
+                timing_history.add_measurement('probe %s' % strftime("%d_%b_%y %H%M%S"), probe_time)
+            time_per_event = timing_history.time_per_event()
+            if time_per_event is None:
+                raise RuntimeError('No time per event measured yet for this config: '
+                                   'use --probeEvents or --unitsPerJob')
+            unit = 'files' if args.splitByFiles else 'lumis' if args.splitByLumis else 'events'
+            args.unitsPerJob = choose_units_per_job(catalog, time_per_event, args.targetJobMinutes, unit)
+            log.info("Using %d %s per job for %g minute jobs (%g s/event)",
+                     args.unitsPerJob, unit, args.targetJobMinutes, time_per_event)
 
         # figure out job grouping
         if args.splitByFiles:
-            job_files = group_files_by_files_per_job(list_of_files, args.unitsPerJob)
+            # each job only has files from one site
+            site_files = split_files_by_site(list_of_files) if args.siteAware else [list_of_files]
+            if args.grouping == 'sequential':
+                job_files = [group for files in site_files
+                             for group in group_files_by_files_per_job(files, args.unitsPerJob)]
+            else:
+                weight_array = catalog.file_size if args.groupingWeight == 'size' else catalog.file_events
+                if min(weight_array or [0]) < 0:
+                    raise RuntimeError("File %s unknown for some files, cannot use --grouping %s"
+                                       % (args.groupingWeight, args.grouping))
+                group_func = group_files_by_lpt if args.grouping == 'lpt' else group_files_by_ffd
+                job_files = []
+                for files in site_files:
+                    num_groups = int(math.ceil(len(files) / float(args.unitsPerJob)))
+                    job_files.extend(group_func(files, [weight_array[f.file_id] for f in files], num_groups))
+                log_group_loads(job_files, lambda f: weight_array[f.file_id], args.groupingWeight)
             total_num_jobs = len(job_files)
             create_filelist(job_files, filelist_filename)
             if lumilist_filename:
                 # make an overall lumilist for all files in each job
-                job_lumis = []
-                for f in job_files:
-                    tmp = f[0].lumi_list
-                    for x in f[1:]:
-                        tmp += x.lumi_list
-                    job_lumis.append(tmp)
+                job_lumis = [catalog.lumi_list([f.file_id for f in files]) for files in job_files]
                 create_lumilists(job_lumis, lumilist_filename)
 
         elif args.splitByLumis:
-            # need to keep track of which files correspond with which lumi
-            # this holds a map of {(run:LS) : DatasetFile}
-            list_of_lumis = {}
-            for f in list_of_files:
-                for x in f.lumi_list.getLumis():
-                    list_of_lumis[x] = f
             # choose the required number of lumis
             if 0 < args.totalUnits < 1:
-                end = int(math.ceil(len(list_of_lumis) * args.totalUnits))
-                list_of_lumis = {k:list_of_lumis[k] for k in list_of_lumis.keys()[0:end + 1]}
+                catalog = catalog.head_lumis(int(math.ceil(catalog.num_lumis() * args.totalUnits)))
             elif args.totalUnits >= 1:
-                list_of_lumis = {k:list_of_lumis[k] for k in list_of_lumis.keys()[0:int(args.totalUnits)]}
+                catalog = catalog.head_lumis(int(args.totalUnits))
 
             # do job grouping
-            job_files, job_lumis = group_files_by_lumis_per_job(list_of_lumis, args.unitsPerJob)
+            job_files, job_lumis = group_catalog_by_lumis_per_job(catalog, args.unitsPerJob)
+            total_num_jobs = len(job_files)
+            create_filelist(job_files, filelist_filename)
+            create_lumilists(job_lumis, lumilist_filename)
+
+        elif args.splitByEvents:
+            # choose the required number of events
+            max_events = -1
+            if 0 < args.totalUnits < 1:
+                max_events = int(math.ceil(sum(catalog.events) * args.totalUnits))
+            elif args.totalUnits >= 1:
+                max_events = int(args.totalUnits)
+
+            # do job grouping, each job gets its own lumisToProcess
+            job_files, job_lumis = group_catalog_by_events_per_job(catalog, args.unitsPerJob, max_events)
             total_num_jobs = len(job_files)
             create_filelist(job_files, filelist_filename)
             create_lumilists(job_lumis, lumilist_filename)
@@ -854,13 +3932,28 @@ def cmsRunCondor(in_args=sys.argv[1:]):
     ###########################################################################
     # Create sandbox of user's files
     ###########################################################################
-    sandbox_local = "sandbox.tgz"
+    sandbox_local = "sandbox" + SANDBOX_COMPRESSIONS[args.sandboxCompression][0]
+    overlay_local = "overlay.tgz"
+    runtime_env_local = None
+    if args.shipRuntime:
+        runtime_env_local = capture_runtime_env(os.environ['CMSSW_BASE'], "runtime_env.sh")
 
     additional_input_files = args.inputFile or []
     if lumilist_filename and os.path.isfile(lumilist_filename):
         additional_input_files.append(lumilist_filename)
 
-    setup_sandbox(sandbox_local, args.config, filelist_filename, additional_input_files)
+    sandbox, overlay = setup_sandbox(sandbox_local, overlay_local, args.config, filelist_filename,
+                                     additional_input_files, cache_dir=args.sandboxCache,
+                                     compression=args.sandboxCompression,
+                                     strip_debug=args.sandboxStripDebug, report=args.sandboxReport,
+                                     runtime_env=runtime_env_local)
+    # The base sandbox rarely changes, so keep it on /hdfs where the worker
+    # can fetch it (if it doesn't already have it). Only the overlay is
+    # transferred with every job.
+    sandbox_input_files = [sandbox, overlay]
+    if args.sandboxStore:
+        sandbox = store_sandbox(sandbox, args.sandboxStore)
+        sandbox_input_files = [overlay]
 
     ###########################################################################
     # Setup DAG if needed
@@ -883,43 +3976,71 @@ def cmsRunCondor(in_args=sys.argv[1:]):
 
         cmsrun_dag = ht.DAGMan(filename=args.dag, status_file=status_filename)
 
+    ###########################################################################
+    # Choose resources
+    ###########################################################################
+    memory, disk = args.memory, args.disk
+    if args.autoResources:
+        previous_jobs = parse_condor_logs(timing_history.job_log_files('.log'))
+        resources = estimate_job_resources(previous_jobs, args.resourceMargin)
+        if resources:
+            memory, disk = '%dMB' % resources[0], '%dMB' % resources[1]
+            log.info("From %d previous jobs, with a %g%% margin:", len(previous_jobs), 100 * args.resourceMargin)
+        else:
+            log.info("No previous jobs with this config to choose resources from")
+    log.info("Requesting %s memory and %s disk per job", memory, disk)
+
     ###########################################################################
     # Create Jobs
     ###########################################################################
     script_dir = os.path.dirname(__file__)
+    log_stem = job_log_stem(hash_file(args.config)) + '.$(cluster).$(process)'
 
     cmsrun_jobs = ht.JobSet(
         exe=os.path.join(script_dir, 'cmsRun_worker.sh'),
         copy_exe=True,
         filename=args.condorScript,
-        out_dir=args.logDir, out_file='cmsRun.$(cluster).$(process).out',
-        err_dir=args.logDir, err_file='cmsRun.$(cluster).$(process).err',
-        log_dir=args.logDir, log_file='cmsRun.$(cluster).$(process).log',
-        cpus=1, memory='2GB', disk='3GB',
+        out_dir=args.logDir, out_file=log_stem + '.out',
+        err_dir=args.logDir, err_file=log_stem + '.err',
+        log_dir=args.logDir, log_file=log_stem + '.log',
+        cpus=1, memory=memory, disk=disk,
         # cpus=1, memory='1GB', disk='500MB',
         certificate=True,
         transfer_hdfs_input=True,
         share_exe_setup=True,
-        common_input_files=[sandbox_local],  # EVERYTHING should be in the sandbox
+        common_input_files=sandbox_input_files,  # EVERYTHING should be in the sandbox
         hdfs_store=args.outputDir
     )
 
-    output_files = get_output_files_from_config(args.config)
+    output_modules = get_output_modules_from_config(args.config)
+    output_files = output_modules.values()
+    for label in args.haddModule or []:
+        if label not in output_modules:
+            raise RuntimeError("No output module %s to hadd in config, choose from: %s"
+                               % (label, ', '.join(output_modules)))
 
+    job_list = []
     for job_ind in xrange(total_num_jobs):
         # Construct args to pass to cmsRun_worker.sh on the worker node
         args_dict = dict(output=args.outputDir, ind=job_ind)
         report_filename = "report{ind}.xml".format(**args_dict)
         args_dict['report'] = report_filename
+        timing_filename = "timing{ind}.json".format(**args_dict)
+        args_dict['timing'] = timing_filename
+        args_dict['sandbox'] = sandbox if args.sandboxStore else os.path.basename(sandbox)
         args_str = "-o {output} -i {ind} -a $ENV(SCRAM_ARCH) " \
-                   "-c $ENV(CMSSW_VERSION) -r {report}".format(**args_dict)
-        if args.lumiMask or args.runRange:
+                   "-c $ENV(CMSSW_VERSION) -r {report} -T {timing} -b {sandbox}".format(**args_dict)
+        if args.lumiMask or args.runRange or args.splitByEvents:
             if lumilist_filename:
                 args_str += ' -l ' + os.path.basename(lumilist_filename)
             elif is_url(args.lumiMask):
                 args_str += ' -l ' + args.lumiMask
         if args.asIs:
             args_str += ' -u'
+        # always print the timing summary, so later submissions can use it
+        args_str += ' -t'
+        if args.shipRuntime:
+            args_str += ' -e runtime_env.sh'
         if args.valgrind:
             args_str += ' -m'
         if args.callgrind:
@@ -928,6 +4049,7 @@ def cmsRunCondor(in_args=sys.argv[1:]):
         # warning: this must be aligned with whatever cmsRun_worker.sh does...
         job_output_files = [o.replace('.root', '_%d.root' % job_ind) for o in output_files]
         job_output_files.append(report_filename)
+        job_output_files.append(timing_filename)
 
         if args.callgrind or args.valgrind:
             job_output_files.append('callgrind.out.*')
@@ -942,9 +4064,18 @@ def cmsRunCondor(in_args=sys.argv[1:]):
         )
 
         cmsrun_jobs.add_job(job)
+        job_list.append(job)
         if args.dag:
             cmsrun_dag.add_job(job, retry=5)
 
+    ###########################################################################
+    # hadd outputs as the jobs finish
+    ###########################################################################
+    for label in args.haddModule or []:
+        add_hadd_jobs(cmsrun_dag, job_list, output_modules[label], args.outputDir,
+                      args.haddSize, args.haddArgs, args.condorScript, args.logDir, label,
+                      args.haddFileMB, args.resourceMargin)
+
     ###########################################################################
     # Submit unless dry run
     ###########################################################################
@@ -954,8 +4085,15 @@ def cmsRunCondor(in_args=sys.argv[1:]):
         else:
             cmsrun_jobs.submit()
 
-        # Cleanup local files
+        # store where the job logs will be, so later submissions can use their timing & resources
+        timing_history.add_log_dir(args.logDir)
+        timing_history.save()
+
+        # Cleanup local files, but keep any cached sandbox
         remove_file(sandbox_local)
+        remove_file(overlay_local)
+        if runtime_env_local:
+            remove_file(runtime_env_local)
         if filelist_filename:
             remove_file(filelist_filename)
         if lumilist_filename:
@@ -967,5 +4105,12 @@ def cmsRunCondor(in_args=sys.argv[1:]):
     return cmsrun_dag, cmsrun_jobs
 
 
+# Other things to do instead of submitting jobs: cmsRunCondor.py <command> ...
+SUBCOMMANDS = {'timing': job_timing, 'report': job_report, 'logs': condor_logs}
+
+
 if __name__ == "__main__":
-    cmsRunCondor()
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        cmsRunCondor()
@@ -4,7 +4,7 @@
 # Script to run cmsRun on condor worker node
 #
 # Briefly, it:
-# - setups up environment & CMSSW
+# - setups up environment & CMSSW (or uses the environment saved at submission)
 # - extracts all the user's libs, header files, etc from a sandbox zip
 # - makes a wrapper script for the CMSSW config file,
 #   so that it uses the correct input/output files
@@ -18,6 +18,29 @@ echo "START: $(date)"
 worker=$PWD # top level of worker node
 export HOME=$worker # need this if getenv = false
 
+# Time each phase, printed at the end and saved in the timing file
+# CPU time of this script & everything it has run, in seconds
+cpu_seconds() {
+    awk -v tck=$(getconf CLK_TCK) '{printf "%.2f", ($14 + $15 + $16 + $17) / tck}' /proc/$$/stat
+}
+jobStart=$(date +%s)
+phaseStart=$(date +%s.%N)
+phaseCpuStart=$(cpu_seconds)
+phaseTimes=""
+phaseJson=""
+# Record the time since the last call as phase $1
+end_phase() {
+    local now=$(date +%s.%N)
+    local cpu=$(cpu_seconds)
+    local duration=$(echo "$now $phaseStart" | awk '{printf "%.2f", $1 - $2}')
+    local cpuDuration=$(echo "$cpu $phaseCpuStart" | awk '{printf "%.2f", $1 - $2}')
+    echo "Phase $1 took ${duration} s (${cpuDuration} s CPU)"
+    phaseTimes="${phaseTimes}$(printf '%-16s %10s %10s' $1 $duration $cpuDuration)\n"
+    phaseJson="${phaseJson}${phaseJson:+, }{\"name\": \"$1\", \"wall\": $duration, \"cpu\": $cpuDuration}"
+    phaseStart=$now
+    phaseCpuStart=$cpu
+}
+
 ###############################################################################
 # Store args
 ###############################################################################
@@ -28,13 +51,19 @@ ind="" # ind is the job number
 arch="" # architecture
 cmssw_version="" # cmssw version
 reportFile="" # job report XMl file
-sandbox="" # sandbox location
+timingFile="" # JSON file of phase timings
+cmsRunTimeFile="" # resource usage of cmsRun from /usr/bin/time
+sandbox="sandbox.tgz" # sandbox of user's libs etc, if on /hdfs it is cached on the worker node
+sandboxNodeCache=${CMSRUNCONDOR_SANDBOX_CACHE:-/tmp/${USER:-$(id -un)}_cmsRunCondor_sandboxes} # where to cache it
+overlay="overlay.tgz" # sandbox of config, filelist, etc for this submission
 overrideConfig=1 # override the files and num events in the config
 doCallgrind=0  # do profiling - runs with callgrind
 doValgrind=0  # do memcheck - runs with valgrind
 lumiMaskSrc=""  # filename or URL for lumi mask
 lumiMaskType="filename"  # source type (filename or url)
-while getopts ":s:f:o:i:a:c:r:upml:" opt; do
+wantSummary=0  # print cmsRun TimeReport summary, for timing
+runtimeEnv=""  # scramv1 runtime environment saved at submission, in the overlay
+while getopts ":s:f:o:i:a:c:r:T:b:upml:te:" opt; do
     case $opt in
         \?)
             echo "Invalid option $OPTARG" >&2
@@ -72,6 +101,14 @@ while getopts ":s:f:o:i:a:c:r:upml:" opt; do
             echo "Job framework report XML: $OPTARG"
             reportFile=$OPTARG
             ;;
+        T)
+            echo "Timing JSON: $OPTARG"
+            timingFile=$OPTARG
+            ;;
+        b)
+            echo "Sandbox: $OPTARG"
+            sandbox=$OPTARG
+            ;;
         u)
             echo "Using files in config"
             overrideConfig=0
@@ -96,9 +133,46 @@ while getopts ":s:f:o:i:a:c:r:upml:" opt; do
                 echo "Running with lumiMask $lumiMaskType $lumiMaskSrc"
             fi
             ;;
+        t)
+            echo "Printing timing summary"
+            wantSummary=1
+            ;;
+        e)
+            echo "Runtime environment: $OPTARG"
+            runtimeEnv=$OPTARG
+            ;;
     esac
 done
 
+###############################################################################
+# Write the phase timings & cmsRun resource usage to $timingFile on exit,
+# even if something failed, so it is transferred with the other outputs
+###############################################################################
+write_timing() {
+    local exitCode=$?
+    if [ -z "$timingFile" ]; then
+        return
+    fi
+    # awkward as the directory depends on how far we got
+    local timingPath=$worker/$timingFile
+    if [ -d $worker/${cmssw_version}/src ]; then
+        timingPath=$worker/${cmssw_version}/src/$timingFile
+    fi
+    local cmsRunJson=""
+    if [ -f "$cmsRunTimeFile" ]; then
+        cmsRunJson=$(awk -F': ' '
+            /User time \(seconds\)/ {user = $2}
+            /System time \(seconds\)/ {sys = $2}
+            /Maximum resident set size \(kbytes\)/ {rss = $2}
+            END {printf ", \"cmsRun\": {\"user\": %.2f, \"sys\": %.2f, \"max_rss_kb\": %d}", user, sys, rss}
+        ' $cmsRunTimeFile)
+    fi
+    echo "{\"job\": ${ind:-null}, \"host\": \"$(hostname)\", \"start\": $jobStart, \"exit_code\": $exitCode, "\
+"\"phases\": [$phaseJson]$cmsRunJson}" > $timingPath
+    echo "Timing written to $timingPath"
+}
+trap write_timing EXIT
+
 ###############################################################################
 # Setup CMSSW
 ###############################################################################
@@ -106,17 +180,85 @@ export SCRAM_ARCH=${arch}
 echo "Setting up ${cmssw_version} ..."
 echo "... sourcing CMS default environment from CVMFS"
 source /cvmfs/cms.cern.ch/cmsset_default.sh
-echo "... creating CMSSW project area"
-scramv1 project CMSSW ${cmssw_version}
-cd ${cmssw_version}/src
-eval `scramv1 runtime -sh`  # cmsenv
-echo "${cmssw_version} has been set up"
+if [ -z "$runtimeEnv" ]; then
+    echo "... creating CMSSW project area"
+    scramv1 project CMSSW ${cmssw_version}
+    cd ${cmssw_version}/src
+    eval `scramv1 runtime -sh`  # cmsenv
+    echo "${cmssw_version} has been set up"
+else
+    # Just the directories, the environment is set once the overlay is extracted
+    echo "... creating project skeleton"
+    mkdir -p ${cmssw_version}/src
+    cd ${cmssw_version}/src
+fi
+end_phase cmssw_setup
 
 ###############################################################################
 # Extract sandbox of user's libs, headers, and python files
 ###############################################################################
+# Extract a tarball, detecting the compression from its first bytes
+extract_tarball() {
+    local magic=$(head -c 4 "$1" | od -An -tx1 | tr -d ' \n')
+    case $magic in
+        1f8b*)
+            if command -v pigz >/dev/null 2>&1; then
+                pigz -dc "$1" | tar xvf -
+            else
+                tar xvzf "$1"
+            fi
+            ;;
+        28b52ffd)
+            zstd -dcq "$1" | tar xvf -
+            ;;
+        04224d18)
+            lz4 -dcq "$1" | tar xvf -
+            ;;
+        *)
+            tar xvf "$1"
+            ;;
+    esac
+}
+set -o pipefail
+
 cd ..
-tar xvzf ../sandbox.tgz
+if [[ "$sandbox" == /hdfs/* ]]; then
+    # The sandbox is named by its contents, so a cached copy on this node
+    # can be used as is. Lock so only one job on the node fetches it.
+    mkdir -p $sandboxNodeCache
+    cachedSandbox=$sandboxNodeCache/$(basename $sandbox)
+    (
+        flock -w 1800 9
+        if [ ! -f $cachedSandbox ]; then
+            echo "Copying $sandbox to $cachedSandbox"
+            # left over if a job was killed while copying
+            rm -f $cachedSandbox.tmp
+            hadoop fs -copyToLocal ${sandbox#/hdfs} $cachedSandbox.tmp
+            mv $cachedSandbox.tmp $cachedSandbox
+        else
+            echo "Using cached sandbox $cachedSandbox"
+        fi
+        touch $cachedSandbox
+        # remove sandboxes not used for a week
+        find $sandboxNodeCache -name "sandbox_*" -mtime +7 -delete || true
+    ) 9>$sandboxNodeCache/lock
+    extract_tarball $cachedSandbox
+else
+    extract_tarball ../${sandbox}
+fi
+end_phase sandbox
+if [ -f ../${overlay} ]; then
+    extract_tarball ../${overlay}
+fi
+end_phase overlay
+
+if [ ! -z "$runtimeEnv" ]; then
+    echo "... using saved runtime environment"
+    export CMSRUNCONDOR_CMSSW_BASE=$PWD
+    source src/${runtimeEnv}
+    echo "${cmssw_version} has been set up"
+    end_phase runtime_env
+fi
 
 cd src # run everything inside CMSSW_BASE/src
 
@@ -151,6 +293,10 @@ if [ $overrideConfig == 1 ]; then
         fi
     fi
 fi
+if [ $wantSummary == 1 ]; then
+    echo "if not hasattr(process, 'options'): process.options = cms.untracked.PSet()" >> $wrapper
+    echo "process.options.wantSummary = cms.untracked.bool(True)" >> $wrapper
+fi
 echo "if hasattr(process, 'TFileService'): process.TFileService.fileName = "\
 "cms.string(process.TFileService.fileName.value().replace('.root', '_${ind}.root'))" >> $wrapper
 echo "for omod in process.outputModules.itervalues():" >> $wrapper
@@ -162,6 +308,7 @@ echo ""
 cat $wrapper
 echo ""
 echo "========================"
+end_phase wrapper
 
 ###############################################################################
 # Log the modified script
@@ -185,9 +332,16 @@ elif [[ $doValgrind == 1 ]]; then
     valgrind --tool=memcheck --leak-check=full --show-leak-kinds=all cmsRun -j $reportFile $wrapper
 else
     # cmsRun args MUST be in this order otherwise complains it doesn't know -j
-    /usr/bin/time -v cmsRun -j $reportFile $wrapper
+    cmsRunTimeFile=$PWD/cmsRun_time.txt
+    /usr/bin/time -v -o $cmsRunTimeFile cmsRun -j $reportFile $wrapper || cmsResult=$?
+    cat $cmsRunTimeFile >&2
 fi
-cmsResult=$?
+cmsResult=${cmsResult:-$?}
+end_phase cmsRun
+echo "==== Timing [s] ===="
+printf '%-16s %10s %10s\n' phase wall cpu
+printf "$phaseTimes"
+echo "===================="
 echo "CMS JOB OUTPUT" $cmsResult
 if [ "$cmsResult" -ne 0 ]; then
     exit $cmsResult
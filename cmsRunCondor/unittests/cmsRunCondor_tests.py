@@ -9,10 +9,20 @@ Unittests for cmsrunCondor.py
 import unittest
 import sys
 import os
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import subprocess
+from StringIO import StringIO
 sys.path.append(os.path.join(os.getcwd(), '..'))
 import cmsRunCondor as crc
 
 
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
 class cmsRunCondorTests(unittest.TestCase):
 
     def test_run_range_parser(self):
@@ -22,6 +32,729 @@ class cmsRunCondorTests(unittest.TestCase):
         self.assertEqual(crc.parse_run_range(''), [])
         self.assertEqual(crc.parse_run_range(None), None)
 
+    def test_lumi_index_matching(self):
+        raw_a = crc.DatasetFile('a.root', crc.LumiList.LumiList(compactList={'1': [[1, 10]]}))
+        raw_b = crc.DatasetFile('b.root', crc.LumiList.LumiList(compactList={'1': [[11, 20]], '2': [[1, 5]]}))
+        raw_c = crc.DatasetFile('c.root', crc.LumiList.LumiList(compactList={'1': [[5, 12]]}))
+        index = crc.LumiIndex([raw_a, raw_b, raw_c])
+        self.assertEqual(index.find(1, [1, 4]), [raw_a])
+        self.assertEqual(set(index.find('1', [10, 11])), set([raw_a, raw_b, raw_c]))
+        self.assertEqual(index.find(2, [6, 10]), [])
+        self.assertEqual(index.find(3, [1, 1]), [])
+
+        reco = crc.DatasetFile('reco.root', crc.LumiList.LumiList(compactList={'1': [[13, 14]], '2': [[2, 2]]}))
+        list(crc.match_parent_files([reco], [raw_a, raw_b, raw_c]))
+        self.assertEqual(reco.parents, [raw_b])
+
+        missing = crc.DatasetFile('reco.root', crc.LumiList.LumiList(compactList={'3': [[1, 1]]}))
+        self.assertRaises(RuntimeError, crc.find_matching_files, index, missing.lumi_list)
+
+
+    def test_iter_json_list(self):
+        data = [{'file': [{'name': 'a.root', 'nevents': 12345}]}, [], 1.5, None, 'str,]}']
+        obj = {'status': 'ok', 'nresults': 123456, 'data': data, 'ctime': 9.75}
+        for chunk_size in [1, 2, 7, 4096]:
+            for indent in [None, 2]:
+                header = {}
+                entries = list(crc.iter_json_list(StringIO(json.dumps(obj, indent=indent)),
+                                                  'data', header, chunk_size=chunk_size))
+                self.assertEqual(entries, data)
+                self.assertEqual(header, {'status': 'ok', 'nresults': 123456, 'ctime': 9.75})
+        self.assertRaises(ValueError, list, crc.iter_json_list(StringIO('{"data": [1, 2'), 'data', {}))
+
+    def make_files(self):
+        return [crc.DatasetFile('a.root', crc.LumiList.LumiList(compactList={'1': [[1, 10], [12, 20]]})),
+                crc.DatasetFile('b.root', crc.LumiList.LumiList(compactList={'1': [[21, 30]], '2': [[1, 5]]})),
+                crc.DatasetFile('c.root', crc.LumiList.LumiList(compactList={'3': [[1, 8]]}))]
+
+    def test_catalog_filtering(self):
+        catalog = crc.FileCatalog.from_files(self.make_files())
+        self.assertEqual(len(catalog), 3)
+        self.assertEqual(catalog.num_lumis(), 42)
+        self.assertEqual(catalog.head_lumis(12).lumi_list().getCompactList(), {'1': [[1, 10], [12, 13]]})
+
+        lumi_mask = crc.LumiList.LumiList(compactList={'1': [[5, 13], [25, 40]], '3': [[2, 3]]})
+        legacy_lumi = crc.filter_by_lumi_list(self.make_files(), lumi_mask)
+        legacy_run = crc.filter_by_run_num(self.make_files(), [2, 3])
+
+        for use_numpy in ([False, True] if crc.np else [False]):
+            filtered = catalog.filter_by_lumi_mask(lumi_mask, use_numpy=use_numpy)
+            self.assertEqual([f.name for f in filtered.files()], [f.name for f in legacy_lumi])
+            for f, g in zip(filtered.files(), legacy_lumi):
+                self.assertEqual(f.lumi_list.getCompactList(), g.lumi_list.getCompactList())
+
+            filtered = catalog.filter_by_run_num([2, 3], use_numpy=use_numpy)
+            self.assertEqual([f.name for f in filtered.files()], ['b.root', 'c.root'])
+            for f, g in zip(filtered.files(), legacy_run):
+                self.assertEqual(f.lumi_list.getCompactList(), g.lumi_list.getCompactList())
+
+    def test_catalog_split_by_lumis(self):
+        catalog = crc.FileCatalog.from_files(self.make_files())
+        job_files, job_lumis = crc.group_catalog_by_lumis_per_job(catalog, 15)
+        self.assertEqual(len(job_files), 3)
+        self.assertEqual([[f.name for f in files] for files in job_files],
+                         [['a.root'], ['a.root', 'b.root'], ['b.root', 'c.root']])
+        self.assertEqual(job_lumis[1].getCompactList(), {'1': [[17, 30]], '2': [[1, 1]]})
+        self.assertEqual(sum(len(l.getLumis()) for l in job_lumis), catalog.num_lumis())
+
+    def test_catalog_split_by_events(self):
+        catalog = crc.FileCatalog()
+        catalog.add_file('a.root', {'1': [[1, 4]]}, lumi_events={1: {1: 10, 2: 50, 3: 10, 4: 10}})
+        catalog.add_file('b.root', {'1': [[5, 14]]}, num_events=100)
+        self.assertEqual(list(catalog.file_events), [80, 100])
+        job_files, job_lumis = crc.group_catalog_by_events_per_job(catalog, 40)
+        self.assertEqual([[f.name for f in files] for files in job_files],
+                         [['a.root'], ['a.root', 'b.root'], ['b.root'], ['b.root']])
+        self.assertEqual([l.getCompactList() for l in job_lumis],
+                         [{'1': [[1, 2]]}, {'1': [[3, 6]]}, {'1': [[7, 10]]}, {'1': [[11, 14]]}])
+        job_files, job_lumis = crc.group_catalog_by_events_per_job(catalog, 40, max_events=100)
+        self.assertEqual([l.getCompactList() for l in job_lumis], [{'1': [[1, 2]]}, {'1': [[3, 6]]}])
+
+        # narrowing a lumisection range scales its events
+        filtered = catalog.filter_by_lumi_mask(crc.LumiList.LumiList(compactList={'1': [[2, 7]]}))
+        self.assertEqual(list(filtered.events), [50, 10, 10, 30])
+
+        catalog.add_file('c.root', {'1': [[15, 20]]})
+        self.assertRaises(RuntimeError, crc.group_catalog_by_events_per_job, catalog, 1000)
+
+    def test_catalog_match_parents(self):
+        raw = crc.FileCatalog.from_files(self.make_files())
+        reco = crc.FileCatalog()
+        reco.add_file('reco.root', {'1': [[9, 12]], '3': [[2, 2]]})
+        reco.match_parents(crc.LumiIndex(raw))
+        self.assertEqual([p.name for p in reco.files()[0].parents], ['a.root', 'c.root'])
+
+    def test_parse_time_per_event(self):
+        log_dir = os.path.join(TEST_DIR, '..', 'XrootdVsLocal', 'log_local')
+        err_file = os.path.join(log_dir, 'SimL1Emulator_Stage2_profile_local_135730.153388.0.err')
+        with open(err_file) as f:
+            self.assertAlmostEqual(crc.parse_time_per_event(f.read()), 0.462931)
+        self.assertEqual(crc.parse_time_per_event('no timing here'), None)
+
+    def test_timing_history(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = os.path.join(tmp_dir, 'pset.py')
+            with open(config, 'w') as f:
+                f.write('process = None\n')
+            log_dir = os.path.join(tmp_dir, 'logs')
+            os.makedirs(log_dir)
+            stem = crc.job_log_stem(crc.hash_file(config))
+            for i, t in enumerate([0.5, 1.5, 2.0]):
+                with open(os.path.join(log_dir, '%s.1.%d.err' % (stem, i)), 'w') as f:
+                    f.write('TimeReport      event loop Real/event = %g\n' % t)
+            # another config's job in the same directory
+            with open(os.path.join(log_dir, 'cmsRun.0123abcd.2.0.err'), 'w') as f:
+                f.write('TimeReport      event loop Real/event = 100\n')
+
+            history = crc.TimingHistory(os.path.join(tmp_dir, 'timing'), config)
+            self.assertEqual(history.time_per_event(), None)
+            history.add_log_dir(log_dir)
+            self.assertEqual(history.update_from_logs(), 3)
+            history.save()
+
+            # reloaded history only reads new logs
+            history = crc.TimingHistory(os.path.join(tmp_dir, 'timing'), config)
+            self.assertEqual(history.update_from_logs(), 0)
+            self.assertEqual(history.time_per_event(), 1.5)
+            history.add_measurement('probe', 1.0)
+            self.assertEqual(history.time_per_event(), 1.25)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def make_submission(self, tmp_dir, log_dir):
+        """Record a submission of a config without --targetJobMinutes or --autoResources,
+        as cmsRunCondor does after submitting"""
+        config = os.path.join(tmp_dir, 'pset.py')
+        with open(config, 'w') as f:
+            f.write('process = None\n')
+        os.makedirs(log_dir)
+        history = crc.TimingHistory(os.path.join(tmp_dir, 'timing'), config)
+        history.add_log_dir(log_dir)
+        history.save()
+        return config, crc.job_log_stem(history.config_hash)
+
+    def test_timing_history_plain_submission(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_dir = os.path.join(tmp_dir, 'logs')
+            config, stem = self.make_submission(tmp_dir, log_dir)
+            # jobs always print the timing summary
+            with open(os.path.join(log_dir, '%s.1.0.err' % stem), 'w') as f:
+                f.write('TimeReport      event loop Real/event = 0.75\n')
+
+            # a later --targetJobMinutes submission
+            history = crc.TimingHistory(os.path.join(tmp_dir, 'timing'), config)
+            self.assertEqual(history.update_from_logs(), 1)
+            self.assertEqual(history.time_per_event(), 0.75)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_job_timings(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for ind, (wall, exit_code) in enumerate([(10., 0), (20., 0), (60., 65)]):
+                with open(os.path.join(tmp_dir, 'timing%d.json' % ind), 'w') as f:
+                    json.dump({'job': ind, 'exit_code': exit_code,
+                               'phases': [{'name': 'cmssw_setup', 'wall': wall, 'cpu': 1.},
+                                          {'name': 'cmsRun', 'wall': 100., 'cpu': 90.}],
+                               'cmsRun': {'user': 80., 'sys': 10., 'max_rss_kb': 1000 * (ind + 1)}}, f)
+            with open(os.path.join(tmp_dir, 'timing3.json'), 'w') as f:
+                f.write('{"job": 3, ')  # incomplete, ignored
+            with open(os.path.join(tmp_dir, 'report0.xml'), 'w') as f:
+                f.write('<FrameworkJobReport/>')
+
+            timings = crc.load_job_timings(tmp_dir)
+            self.assertEqual([t['job'] for t in timings], [0, 1, 2])
+            summary = crc.summarise_job_timings(timings)
+            self.assertEqual(summary['jobs'], 3)
+            self.assertEqual(summary['failed'], 1)
+            self.assertEqual([p['name'] for p in summary['phases']], ['cmssw_setup', 'cmsRun'])
+            setup = summary['phases'][0]
+            self.assertEqual((setup['wall_mean'], setup['wall_median'], setup['wall_max'], setup['cpu_total']),
+                             (30., 20., 60., 3.))
+            self.assertEqual(summary['cmsrun_cpu'], 270.)
+            self.assertEqual((summary['max_rss_kb_median'], summary['max_rss_kb_max']), (2000, 3000))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_job_reports(self):
+        report = """<FrameworkJobReport>
+<InputFile>
+<LFN>/store/a.root</LFN>
+<PFN>root://xrootd.example//store/a.root</PFN>
+<InputType>primaryFiles</InputType>
+<EventsRead>300</EventsRead>
+</InputFile>
+<InputFile>
+<LFN>/store/b.root</LFN>
+<PFN>root://xrootd.example//store/b.root</PFN>
+<InputType>primaryFiles</InputType>
+<EventsRead>100</EventsRead>
+</InputFile>
+<InputFile>
+<LFN>/store/b_parent.root</LFN>
+<InputType>secondaryFiles</InputType>
+<EventsRead>100</EventsRead>
+</InputFile>
+<FrameworkError ExitStatus="8021" Type="FileReadError">
+Failed to read root://xrootd.example//store/c.root.
+</FrameworkError>
+<PerformanceReport>
+<PerformanceSummary Metric="Timing">
+<Metric Name="TotalJobTime" Value="100.0"/>
+<Metric Name="TotalJobCPU" Value="80.0"/>
+<Metric Name="NumberOfThreads" Value="1"/>
+</PerformanceSummary>
+<PerformanceSummary Metric="StorageStatistics">
+<Metric Name="Timing-tstoragefile-read-totalMegabytes" Value="200.0"/>
+<Metric Name="Timing-tstoragefile-read-totalMsecs" Value="10000.0"/>
+</PerformanceSummary>
+<PerformanceSummary Metric="ApplicationMemory">
+<Metric Name="PeakValueRss" Value="1500.5"/>
+</PerformanceSummary>
+</PerformanceReport>
+</FrameworkJobReport>
+"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for ind in range(3):
+                filenames.append(os.path.join(tmp_dir, 'report%d.xml' % ind))
+                with open(filenames[-1], 'w') as f:
+                    f.write(report if ind < 2 else report[:60])  # last one truncated
+
+            job, files = crc.parse_job_report(filenames[0])
+            self.assertEqual((job['job'], job['exit_code'], job['events']), (0, 8021, 400))
+            self.assertAlmostEqual(job['cpu_efficiency'], 0.8)
+            self.assertEqual((job['read_mb'], job['read_s'], job['read_mb_per_s']), (200., 10., 20.))
+            self.assertEqual(job['peak_rss_mb'], 1500.5)
+            self.assertEqual([(f['lfn'], f['status']) for f in files],
+                             [('/store/a.root', 'ok'), ('/store/b.root', 'ok'), ('/store/b_parent.root', 'ok'),
+                              ('', 'failed')])
+            self.assertEqual(files[0]['read_mb'], 120.)
+            self.assertEqual(files[3]['pfn'], 'root://xrootd.example//store/c.root')
+
+            # nothing is left attached to the root (the last element) once parsed
+            elems = []
+            iterparse = crc.ElementTree.iterparse
+
+            def record_elems(*args, **kwargs):
+                for event, elem in iterparse(*args, **kwargs):
+                    elems.append(elem)
+                    yield event, elem
+
+            crc.ElementTree.iterparse = record_elems
+            try:
+                self.assertEqual(crc.parse_job_report(filenames[0])[0], job)
+            finally:
+                crc.ElementTree.iterparse = iterparse
+            self.assertEqual(elems[-1].tag, 'FrameworkJobReport')
+            self.assertEqual(len(elems[-1]), 0)
+
+            jobs, files = crc.parse_job_reports(filenames, num_procs=2)
+            self.assertEqual([j['job'] for j in jobs], [0, 1, 2])
+            self.assertEqual(jobs[2]['exit_code'], -1)
+            summary = crc.summarise_job_reports(jobs, files)
+            self.assertEqual((summary['jobs'], summary['failed_jobs'], summary['events']), (3, 3, 800))
+            self.assertEqual(summary['read_mb_per_s'], 20.)
+            self.assertEqual(summary['failed_files'], ['root://xrootd.example//store/c.root'])
+
+            csv_filename = os.path.join(tmp_dir, 'jobs.csv')
+            crc.save_report_table(jobs, crc.JOB_REPORT_COLUMNS, csv_filename)
+            with open(csv_filename) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[0], ','.join(crc.JOB_REPORT_COLUMNS))
+            self.assertEqual(len(lines), 4)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_condor_log(self):
+        log_dir = os.path.join(TEST_DIR, '..', 'XrootdVsLocal', 'log_local')
+        jobs = crc.parse_condor_log(os.path.join(log_dir, 'SimL1Emulator_Stage2_profile_local_135730.153388.0.log'))
+        self.assertEqual(len(jobs), 1)
+        job = jobs[0]
+        self.assertEqual((job['cluster'], job['proc'], job['host'], job['return_value']),
+                         (153388, 0, '10.129.5.161', 0))
+        self.assertEqual((job['queue_wait'], job['run_time'], job['cpu']), (155., 2203., 1933.))
+        self.assertEqual((job['peak_rss_kb'], job['peak_memory_mb'], job['memory_request_mb']), (332604, 325, 2048))
+        self.assertEqual((job['disk_kb'], job['bytes_sent'], job['bytes_received']), (165190, 110813, 12811))
+        self.assertEqual(job['series'][0], (9., 14, 13412))
+        self.assertEqual(len(job['series']), 7)
+        self.assertEqual(job['signal'], None)
+
+        killed = crc.new_condor_job(1, 0, 'test.log')
+        crc.parse_condor_termination(killed, ['\t(0) Abnormal termination (signal 9)'])
+        self.assertEqual((killed['return_value'], killed['signal']), (None, 9))
+
+        all_jobs = crc.parse_condor_logs(crc.find_condor_logs([log_dir]), num_procs=2)
+        self.assertEqual(len(all_jobs), 5)
+        self.assertEqual(all_jobs, sorted(all_jobs, key=lambda j: j['cluster']))
+
+    def test_condor_log_evicted(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_filename = os.path.join(tmp_dir, 'evicted.log')
+            with open(log_filename, 'w') as f:
+                f.write('000 (200.000.000) 10/24 10:00:00 Job submitted from host: <1.2.3.4:1>\n...\n'
+                        '001 (200.000.000) 10/24 10:01:00 Job executing on host: <10.0.0.1:1>\n...\n'
+                        '004 (200.000.000) 10/24 10:31:00 Job was evicted.\n...\n'
+                        '001 (200.000.000) 10/24 10:40:00 Job executing on host: <10.0.0.2:1>\n...\n'
+                        '006 (200.000.000) 10/24 10:45:00 Image size of job updated: 1000\n'
+                        '\t100  -  MemoryUsage of job (MB)\n'
+                        '\t90000  -  ResidentSetSize of job (KB)\n...\n'
+                        '005 (200.000.000) 10/24 11:00:00 Job terminated.\n'
+                        '\t(1) Normal termination (return value 0)\n...\n')
+            job, = crc.parse_condor_log(log_filename)
+            # queue wait is to the first execution, run time from the last one
+            self.assertEqual((job['queue_wait'], job['run_time']), (60., 1200.))
+            self.assertEqual((job['executions'], job['evictions'], job['host']), (2, 1, '10.0.0.2'))
+            self.assertEqual(job['series'], [(300., 100, 90000)])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_estimate_job_resources(self):
+        log_dir = os.path.join(TEST_DIR, '..', 'XrootdVsLocal', 'log_local')
+        jobs = crc.parse_condor_logs(crc.find_condor_logs([log_dir]), num_procs=1)
+        peak_memory = max(max(j['peak_memory_mb'], j['peak_rss_kb'] / 1024.) for j in jobs)
+        memory, disk = crc.estimate_job_resources(jobs, 0.25)
+        self.assertEqual(memory % 100, 0)
+        self.assertTrue(peak_memory * 1.25 <= memory < peak_memory * 1.25 + 100)
+        self.assertEqual(disk, 300)  # 165190 KB * 1.25
+        self.assertEqual(crc.estimate_job_resources([], 0.25), None)
+
+    @unittest.skipIf(crc.haddaway is None, "haddaway not importable")
+    def test_auto_resources_plain_submission(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_dir = os.path.join(tmp_dir, 'logs')
+            config, stem = self.make_submission(tmp_dir, log_dir)
+            shutil.copy(os.path.join(TEST_DIR, '..', 'XrootdVsLocal', 'log_local',
+                                     'SimL1Emulator_Stage2_profile_local_135730.153388.0.log'),
+                        os.path.join(log_dir, '%s.153388.0.log' % stem))
+
+            # a later --autoResources submission
+            history = crc.TimingHistory(os.path.join(tmp_dir, 'timing'), config)
+            jobs = crc.parse_condor_logs(history.job_log_files('.log'))
+            self.assertEqual([j['cluster'] for j in jobs], [153388])
+            self.assertEqual(crc.estimate_job_resources(jobs, 0.25)[1], 300)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_add_hadd_jobs(self):
+        dag = crc.ht.DAGMan(filename='test.dag')
+        cmsrun_jobs = [crc.ht.Job(name='cmsRun_%d' % i) for i in xrange(4)]
+        job_levels = crc.add_hadd_jobs(dag, cmsrun_jobs, 'tree.root', '/hdfs/user/test', 2, '-f',
+                                       'job.condor', '/tmp', 'TFileService')
+        self.assertEqual([len(jobs) for jobs in job_levels], [2, 1])
+        first = job_levels[0][0]
+        self.assertEqual(first.input_files, ['/hdfs/user/test/tree_0.root', '/hdfs/user/test/tree_1.root'])
+        # each first level hadd only waits for its own cmsRun jobs
+        self.assertEqual(dag.requires[first.name], cmsrun_jobs[:2])
+        final = job_levels[-1][0]
+        self.assertEqual(final.name, 'hadd_TFileService_finalHadd')
+        self.assertEqual(final.output_files, ['/hdfs/user/test/tree.root'])
+        self.assertEqual(dag.requires[final.name], job_levels[0])
+        self.assertEqual(dag.requires['hadd_TFileService_rm_0'], final)
+
+        # the output of the last job is passed up to the final hadd, which must wait for it
+        cmsrun_jobs.append(crc.ht.Job(name='cmsRun_4'))
+        job_levels = crc.add_hadd_jobs(dag, cmsrun_jobs, 'tree.root', '/hdfs/user/test', 2, '-f',
+                                       'job.sub', '/tmp', 'out', file_mb=1000, margin=0)
+        final = job_levels[-1][0]
+        self.assertEqual(final.input_files[-1], '/hdfs/user/test/tree_4.root')
+        self.assertEqual(dag.requires[final.name], [job_levels[1][0], cmsrun_jobs[4]])
+        # resources grow with the amount of data each level merges
+        self.assertEqual((job_levels[0][0].manager.memory, job_levels[0][0].manager.disk), ('2000MB', '4000MB'))
+        self.assertEqual((final.manager.memory, final.manager.disk), ('8000MB', '16000MB'))
+        self.assertNotEqual(final.manager.filename, 'job.sub')
+        self.assertNotEqual(final.manager.filename, job_levels[0][0].manager.filename)
+
+    def test_condor_time(self):
+        t = crc.parse_condor_time('12/31', '23:59:00')
+        self.assertEqual(crc.parse_condor_time('01/01', '00:01:00', t) - t, crc.timedelta(minutes=2))
+        self.assertEqual(crc.parse_condor_time('2016-10-24', '14:36:49'), crc.datetime(2016, 10, 24, 14, 36, 49))
+
+    def test_choose_units_per_job(self):
+        catalog = crc.FileCatalog()
+        catalog.add_file('a.root', {'1': [[1, 10]]}, num_events=1000)
+        catalog.add_file('b.root', {'1': [[11, 20]]}, num_events=3000)
+        # 2000 events per job
+        self.assertEqual(crc.choose_units_per_job(catalog, 0.6, 20, 'events'), 2000)
+        self.assertEqual(crc.choose_units_per_job(catalog, 0.6, 20, 'lumis'), 10)
+        self.assertEqual(crc.choose_units_per_job(catalog, 0.6, 20, 'files'), 1)
+        self.assertEqual(crc.choose_units_per_job(catalog, 0.6, 0.01, 'files'), 1)
+        catalog.add_file('c.root', {'1': [[21, 30]]})
+        self.assertRaises(RuntimeError, crc.choose_units_per_job, catalog, 0.6, 20)
+
+    def test_bin_packing_grouping(self):
+        files = ['a', 'b', 'c', 'd', 'e', 'f']
+        weights = [5, 1, 4, 2, 3, 3]
+        sequential = crc.group_files_by_files_per_job(files, 2)
+        self.assertEqual(sequential, [['a', 'b'], ['c', 'd'], ['e', 'f']])
+        lpt = crc.group_files_by_lpt(files, weights, 3)
+        self.assertEqual(lpt, [['a', 'b'], ['c', 'd'], ['e', 'f']])
+        weights = [9, 1, 1, 1, 7, 5]
+        lpt = crc.group_files_by_lpt(files, weights, 3)
+        self.assertEqual(len(lpt), 3)
+        loads = [sum(weights[files.index(f)] for f in g) for g in lpt]
+        self.assertEqual(max(loads), 9)
+        ffd = crc.group_files_by_ffd(files, weights, 3)
+        self.assertEqual(ffd, [['a'], ['b', 'c', 'e'], ['d', 'f']])
+        self.assertEqual(crc.group_files_by_ffd([], [], 3), [])
+        self.assertEqual(crc.log_group_loads(lpt, lambda f: weights[files.index(f)], 'size'), (9, 8))
+
+    def test_site_grouping(self):
+        files = self.make_files()
+        files[0].sites = ['T1_US_FNAL_Disk']
+        files[2].sites = ['T1_US_FNAL_Disk', crc.LOCAL_SITE]
+        self.assertEqual(crc.choose_site(files[2].sites), crc.LOCAL_SITE)
+        self.assertEqual(crc.choose_site([]), None)
+        self.assertEqual([[f.name for f in g] for g in crc.split_files_by_site(files)],
+                         [['c.root'], ['a.root'], ['b.root']])
+
+        catalog = crc.FileCatalog.from_files(files)
+        for file_id, f in enumerate(files):
+            catalog.sites[file_id].extend(f.sites)
+        grouped = catalog.group_by_site()
+        self.assertEqual(grouped.names, ['c.root', 'a.root', 'b.root'])
+        self.assertEqual(grouped.files()[1].lumi_list.getCompactList(), {'1': [[1, 10], [12, 20]]})
+        self.assertEqual(grouped.num_lumis(), catalog.num_lumis())
+
+        store_file = crc.DatasetFile('/store/data/x.root', None)
+        self.assertEqual(crc.local_pfn(store_file), '/store/data/x.root')
+        store_file.sites = [crc.LOCAL_SITE]
+        self.assertEqual(crc.local_pfn(store_file), crc.LOCAL_PFN_PREFIX + '/store/data/x.root')
+
+
+class SandboxTests(unittest.TestCase):
+    """Make sandboxes from a fake CMSSW area"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cmssw_base = os.path.join(self.tmp_dir, 'CMSSW_8_0_0')
+        self.make_file('lib/arch/libFoo.so', 'lib')
+        self.make_file('python/Foo/Bar/__init__.py', '')
+        self.make_file('src/Foo/Bar/interface/Bar.h', 'header')
+        self.make_file('src/Foo/Bar/data/bar.txt', 'data')
+        self.make_file('src/Foo/Bar/src/Bar.cc', 'source')
+        self.config = self.make_file('config_test.py', 'process = None')
+        self.old_cwd = os.getcwd()
+        self.old_cmssw_base = os.environ.get('CMSSW_BASE')
+        os.environ['CMSSW_BASE'] = self.cmssw_base
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        if self.old_cmssw_base is None:
+            del os.environ['CMSSW_BASE']
+        else:
+            os.environ['CMSSW_BASE'] = self.old_cmssw_base
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, name, contents):
+        filename = os.path.join(self.cmssw_base, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def tar_names(self, filename):
+        with tarfile.open(filename) as tar:
+            return sorted(tar.getnames())
+
+    def test_sandbox_contents(self):
+        sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None, [])
+        self.assertEqual(sandbox, 'sandbox.tgz')
+        self.assertEqual(self.tar_names(sandbox),
+                         ['lib/arch/libFoo.so', 'python/Foo/Bar/__init__.py',
+                          'src/Foo/Bar/data/bar.txt', 'src/Foo/Bar/interface/Bar.h'])
+        self.assertEqual(self.tar_names(overlay), ['src/config.py'])
+
+    def test_sandbox_ignore(self):
+        self.make_file('python/Foo/Bar/__init__.pyc', 'compiled')
+        self.make_file('src/Foo/Bar/data/big.root', 'big')
+        self.make_file('src/Foo/Bar/data/needed.root', 'needed')
+        self.make_file('.sandboxignore', '# comment\n*.root\n!src/Foo/Bar/data/needed.root\n')
+        external = os.path.join(self.tmp_dir, 'external.so')
+        with open(external, 'w') as f:
+            f.write('external')
+        os.symlink(external, os.path.join(self.cmssw_base, 'lib', 'arch', 'libExternal.so'))
+        crc.SANDBOX_EXTERNAL_PREFIXES.append(self.tmp_dir)
+        try:
+            sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None, [],
+                                                 report=True)
+        finally:
+            crc.SANDBOX_EXTERNAL_PREFIXES.remove(self.tmp_dir)
+        self.assertEqual(self.tar_names(sandbox),
+                         ['lib/arch/libExternal.so', 'lib/arch/libFoo.so', 'python/Foo/Bar/__init__.py',
+                          'src/Foo/Bar/data/bar.txt', 'src/Foo/Bar/data/needed.root',
+                          'src/Foo/Bar/interface/Bar.h'])
+        with tarfile.open(sandbox) as tar:
+            self.assertTrue(tar.getmember('lib/arch/libExternal.so').issym())
+
+    def test_sandbox_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None, [], cache_dir)
+        self.assertEqual(os.path.dirname(sandbox), cache_dir)
+        self.assertFalse(os.path.exists('sandbox.tgz'))
+        # changing the overlay reuses the cached sandbox
+        extra = self.make_file('extra.txt', 'extra')
+        same_sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None,
+                                                  [extra], cache_dir)
+        self.assertEqual(same_sandbox, sandbox)
+        self.assertEqual(self.tar_names(overlay), ['src/config.py', 'src/extra.txt'])
+        # changing a lib makes a new one
+        self.make_file('lib/arch/libFoo.so', 'new lib')
+        new_sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None, [], cache_dir)
+        self.assertNotEqual(new_sandbox, sandbox)
+        self.assertEqual(len([f for f in os.listdir(cache_dir) if f.endswith('.tgz')]), 2)
+
+    def test_sandbox_compression(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        sandbox_files = crc.list_sandbox_files(self.cmssw_base)
+        for compression, (ext, compress_cmd) in crc.SANDBOX_COMPRESSIONS.iteritems():
+            if compress_cmd and not crc.find_executable(compress_cmd[0]):
+                continue
+            sandbox, overlay = crc.setup_sandbox('sandbox' + ext, 'overlay.tgz', self.config, None, [],
+                                                 cache_dir, compression)
+            self.assertTrue(sandbox.endswith(ext))
+            tar_filename = sandbox
+            if compress_cmd and compression != 'pigz':
+                tar_filename = os.path.join(self.tmp_dir, 'sandbox.tar')
+                with open(tar_filename, 'wb') as f:
+                    subprocess.check_call([compress_cmd[0], '-dc', sandbox], stdout=f)
+            self.assertEqual(self.tar_names(tar_filename), sorted(name for _, name in sandbox_files))
+
+    def test_incremental_sandbox(self):
+        for i in range(5):
+            self.make_file('python/Foo/Mod%d/__init__.py' % i, 'x = %d' % i)
+        for compression, (ext, compress_cmd) in crc.SANDBOX_COMPRESSIONS.iteritems():
+            if compress_cmd and not crc.find_executable(compress_cmd[0]):
+                continue
+            tar_filename = os.path.join(self.tmp_dir, 'sandbox' + ext)
+            self.make_file('python/Foo/Mod3/__init__.py', 'x = 3')
+            sandbox_files = crc.list_sandbox_files(self.cmssw_base)
+            manifest = crc.create_chunked_tarball(tar_filename, sandbox_files, compression)
+            self.assertEqual(len(manifest['chunks']), 9)
+
+            # only the chunk with the changed file is compressed again
+            self.make_file('python/Foo/Mod3/__init__.py', 'x = "%s"' % compression)
+            new_manifest = crc.create_chunked_tarball(tar_filename, sandbox_files, compression,
+                                                      previous_manifest=manifest)
+            changed_chunks = [new for old, new in zip(manifest['chunks'], new_manifest['chunks'])
+                              if old['members'] != new['members']]
+            self.assertEqual([m[0] for c in changed_chunks for m in c['members']], ['python/Foo/Mod3/__init__.py'])
+
+            if compress_cmd and compression != 'pigz':
+                with open(tar_filename + '.tar', 'wb') as f:
+                    subprocess.check_call([compress_cmd[0], '-dc', tar_filename], stdout=f)
+                tar_filename += '.tar'
+            with tarfile.open(tar_filename) as tar:
+                self.assertEqual(sorted(tar.getnames()), sorted(name for _, name in sandbox_files))
+                self.assertEqual(tar.extractfile('python/Foo/Mod3/__init__.py').read(), 'x = "%s"' % compression)
+                self.assertEqual(tar.extractfile('python/Foo/Mod4/__init__.py').read(), 'x = 4')
+
+    def test_incremental_sandbox_strip_debug(self):
+        for i in range(5):
+            self.make_file('python/Foo/Mod%d/__init__.py' % i, 'x = %d' % i)
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(cache_dir)
+        tar_filename = os.path.join(cache_dir, 'sandbox.tgz')
+        sandbox_files = crc.list_sandbox_files(self.cmssw_base)
+        manifest = crc.create_chunked_tarball(tar_filename, sandbox_files)
+        with open(tar_filename + '.manifest.json', 'w') as f:
+            json.dump(manifest, f)
+        self.assertEqual(crc.load_latest_manifest(cache_dir, 'gzip')['tarball'], 'sandbox.tgz')
+        self.assertEqual(crc.load_latest_manifest(cache_dir, 'gzip', strip_debug=True), None)
+
+        # no chunks from the unstripped tarball can be reused, so garbage in it doesn't matter
+        with open(tar_filename, 'r+b') as f:
+            f.write('\0' * os.path.getsize(tar_filename))
+        stripped = crc.create_chunked_tarball(tar_filename, sandbox_files, strip_debug=True,
+                                              previous_manifest=manifest)
+        self.assertTrue(stripped['strip_debug'])
+        with tarfile.open(tar_filename) as tar:
+            self.assertEqual(sorted(tar.getnames()), sorted(name for _, name in sandbox_files))
+
+    def test_sandbox_store(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        store_dir = os.path.join(self.tmp_dir, 'store')
+        sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None, [], cache_dir)
+        stored = crc.store_sandbox(sandbox, store_dir)
+        self.assertEqual(stored, os.path.join(store_dir, os.path.basename(sandbox)))
+        self.assertEqual(self.tar_names(stored), self.tar_names(sandbox))
+        mtime = os.path.getmtime(stored)
+        time.sleep(0.01)
+        self.assertEqual(crc.store_sandbox(sandbox, store_dir), stored)
+        self.assertEqual(os.path.getmtime(stored), mtime)
+        self.assertEqual(os.listdir(store_dir), [os.path.basename(sandbox)])
+
+    def test_runtime_env(self):
+        # fake scramv1 that prints an environment using this CMSSW_BASE
+        scram = os.path.join(self.tmp_dir, 'bin', 'scramv1')
+        os.makedirs(os.path.dirname(scram))
+        with open(scram, 'w') as f:
+            f.write('#!/bin/sh\necho "export CMSSW_BASE=\\"$(dirname $PWD)\\";"\n'
+                    'echo "export LD_LIBRARY_PATH=\\"$(dirname $PWD)/lib/arch:/cvmfs/cms.cern.ch/lib\\";"\n')
+        os.chmod(scram, 0755)
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(scram) + os.pathsep + old_path
+        try:
+            env_file = crc.capture_runtime_env(self.cmssw_base, 'runtime_env.sh')
+        finally:
+            os.environ['PATH'] = old_path
+        self.assertNotIn(self.cmssw_base, open(env_file).read())
+        env = subprocess.check_output(['bash', '-c', 'source %s; echo $CMSSW_BASE $LD_LIBRARY_PATH' % env_file],
+                                      env=dict(os.environ, CMSRUNCONDOR_CMSSW_BASE='/worker/CMSSW_8_0_0'))
+        self.assertEqual(env.split(), ['/worker/CMSSW_8_0_0', '/worker/CMSSW_8_0_0/lib/arch:/cvmfs/cms.cern.ch/lib'])
+        sandbox, overlay = crc.setup_sandbox('sandbox.tgz', 'overlay.tgz', self.config, None, [],
+                                             runtime_env=env_file)
+        self.assertEqual(self.tar_names(overlay), ['src/config.py', 'src/runtime_env.sh'])
+
+
+class DASCacheTests(unittest.TestCase):
+    """Uses the stub das_client.py in this directory instead of DAS"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stub_log = os.path.join(self.tmp_dir, 'das_calls.txt')
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = TEST_DIR + os.pathsep + self.old_path
+        os.environ['DAS_STUB_LOG'] = self.stub_log
+        self.dataset = '/Stub/Dataset-v1/RECO'
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        del os.environ['DAS_STUB_LOG']
+        shutil.rmtree(self.tmp_dir)
+
+    def num_das_calls(self, query_type=''):
+        if not os.path.isfile(self.stub_log):
+            return 0
+        with open(self.stub_log) as f:
+            return len([l for l in f if l.startswith(query_type)])
+
+    def test_no_cache(self):
+        files = crc.get_list_of_files_from_das(self.dataset, -1)
+        self.assertEqual(len(files), 3)
+        self.assertEqual(self.num_das_calls(), 2)
+        crc.get_list_of_files_from_das(self.dataset, -1)
+        self.assertEqual(self.num_das_calls(), 4)
+
+    def test_cache_reuse(self):
+        cache = crc.DASCache(os.path.join(self.tmp_dir, 'cache'))
+        files = crc.get_list_of_files_from_das(self.dataset, 2, cache)
+        self.assertEqual(self.num_das_calls(), 2)
+        cached_files = crc.get_list_of_files_from_das(self.dataset, 2, cache)
+        self.assertEqual(self.num_das_calls(), 2)
+        self.assertEqual([f.name for f in files], [f.name for f in cached_files])
+        # different number of files is a different query
+        crc.get_list_of_files_from_das(self.dataset, 1, cache)
+        self.assertEqual(self.num_das_calls(), 3)
+
+    def test_cache_refresh(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        crc.get_list_of_files_from_das(self.dataset, -1, crc.DASCache(cache_dir))
+        crc.get_list_of_files_from_das(self.dataset, -1, crc.DASCache(cache_dir, refresh=True))
+        self.assertEqual(self.num_das_calls(), 4)
+
+    def test_cache_expiry(self):
+        cache = crc.DASCache(os.path.join(self.tmp_dir, 'cache'), ttl_hours=1)
+        crc.get_list_of_files_from_das(self.dataset, -1, cache)
+        two_hours_ago = time.time() - 7200
+        for f in os.listdir(cache.cache_dir):
+            os.utime(os.path.join(cache.cache_dir, f), (two_hours_ago, two_hours_ago))
+        crc.get_list_of_files_from_das(self.dataset, -1, cache)
+        self.assertEqual(self.num_das_calls(), 4)
+
+    def test_failed_query_not_cached(self):
+        cache = crc.DASCache(os.path.join(self.tmp_dir, 'cache'))
+        self.assertRaises(RuntimeError, crc.get_list_of_files_from_das, '/Not/A/Dataset', -1, cache)
+        self.assertRaises(RuntimeError, crc.get_list_of_files_from_das, '/Not/A/Dataset', -1, cache)
+        self.assertEqual(self.num_das_calls('summary'), 2)
+        self.assertFalse(os.path.isdir(cache.cache_dir) and
+                         [f for f in os.listdir(cache.cache_dir) if f.endswith('.json.gz')])
+
+    def test_catalog_events(self):
+        catalog = crc.get_file_catalog_from_das(self.dataset, -1, events=True)
+        self.assertEqual(catalog.num_lumis(), 50)
+        self.assertEqual(len(catalog.events), 50)
+        self.assertEqual(catalog.file_events[0], sum(10 + ls for ls in range(1, 11)))
+        self.assertEqual(catalog.lumi_list().getCompactList(), {'1': [[1, 20]], '2': [[1, 30]]})
+        self.assertEqual(self.num_das_calls('file,run,lumi,events'), 1)
+
+    def test_catalog_sizes(self):
+        catalog = crc.get_file_catalog_from_das(self.dataset, 2, sizes=True)
+        self.assertEqual(list(catalog.file_size), [10000, 15000])
+        self.assertEqual(catalog.file_events[0], sum(10 + ls for ls in range(1, 11)))
+        # DAS gives null size & events for the 3rd file
+        catalog = crc.get_file_catalog_from_das(self.dataset, -1, sizes=True)
+        self.assertEqual(catalog.file_size[2], -1)
+        self.assertEqual(catalog.file_events[2], -1)
+
+    def test_catalog_sites(self):
+        cache = crc.DASCache(os.path.join(self.tmp_dir, 'cache'))
+        catalog = crc.get_file_catalog_from_das(self.dataset, -1, cache, sites=True)
+        self.assertEqual(catalog.sites, [['T1_US_FNAL_Disk', 'T2_UK_SGrid_Bristol'],
+                                         ['T1_US_FNAL_Disk'],
+                                         ['T1_US_FNAL_Disk', 'T2_UK_SGrid_Bristol']])
+        num_calls = self.num_das_calls()
+        self.assertEqual(self.num_das_calls('site'), 1)
+        crc.get_file_catalog_from_das(self.dataset, -1, cache, sites=True)
+        self.assertEqual(self.num_das_calls(), num_calls)
+
+    def test_concurrent_queries(self):
+        # summary & file queries should overlap, so take ~1 x delay, not 2 x delay
+        os.environ['DAS_STUB_DELAY'] = '1'
+        try:
+            start = time.time()
+            crc.get_list_of_files_from_das(self.dataset, -1)
+            self.assertLess(time.time() - start, 1.8)
+        finally:
+            del os.environ['DAS_STUB_DELAY']
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Stub of das_client.py, to allow offline testing of DAS lookups.
+
+Only knows about STUB_DATASET. Every call is appended to the file named by
+the DAS_STUB_LOG environment variable (if set), so tests can check if DAS
+was actually queried. Each call takes DAS_STUB_DELAY seconds (default 0)
+to mimic DAS latency.
+"""
+
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+
+STUB_DATASET = '/Stub/Dataset-v1/RECO'
+
+STUB_FILES = [
+    {'name': '/store/stub/file1.root', 'lumis': {1: [[1, 10]]},
+     'sites': ['T1_US_FNAL_Disk', 'T2_UK_SGrid_Bristol']},
+    {'name': '/store/stub/file2.root', 'lumis': {1: [[11, 20]], 2: [[1, 5]]},
+     'sites': ['T1_US_FNAL_Disk']},
+    {'name': '/store/stub/file3.root', 'lumis': {2: [[6, 30]]},
+     'sites': ['T1_US_FNAL_Disk', 'T2_UK_SGrid_Bristol'], 'null_info': True},
+]
+
+
+def summary_result():
+    return {'status': 'ok',
+            'data': [{'summary': [{'nfiles': len(STUB_FILES), 'nlumis': 50}]}]}
+
+
+def lumi_events(run, ls):
+    """Number of events in a stub lumisection"""
+    return 10 * run + ls
+
+
+def site_result():
+    sites = sorted(set(site for f in STUB_FILES for site in f['sites']))
+    return {'status': 'ok', 'nresults': len(sites),
+            'data': [{'site': [{'name': site}, {'se': site.lower() + '.example.com'}]}
+                     for site in sites]}
+
+
+def file_info_result(limit, site=None):
+    data = []
+    for f in [f for f in STUB_FILES if site is None or site in f['sites']][:limit]:
+        num_lumis = sum(end - start + 1 for lumis in f['lumis'].values() for start, end in lumis)
+        data.append({'file': [{'name': f['name'], 'size': 1000 * num_lumis,
+                               'nevents': sum(lumi_events(run, ls)
+                                              for run, lumis in f['lumis'].items()
+                                              for start, end in lumis
+                                              for ls in range(start, end + 1))}]})
+        if f.get('null_info'):
+            # DAS sometimes gives null instead of a number
+            data[-1]['file'][0].update(size=None, nevents=None)
+    return {'status': 'ok', 'nresults': len(data), 'data': data}
+
+
+def file_result(limit, events=False):
+    data = []
+    for f in STUB_FILES[:limit]:
+        runs = sorted(f['lumis'].keys())
+        entry = {'file': [{'name': f['name']}],
+                 'run': [{'run_number': run} for run in runs],
+                 'lumi': [{'number': f['lumis'][run]} for run in runs]}
+        if events:
+            # DAS gives single lumisections when asking for events
+            lumis = [[ls for start, end in f['lumis'][run] for ls in range(start, end + 1)]
+                     for run in runs]
+            entry['lumi'] = [{'number': ls_list} for ls_list in lumis]
+            entry['events'] = [{'number': [lumi_events(run, ls) for ls in ls_list]}
+                               for run, ls_list in zip(runs, lumis)]
+            entry['file'][0]['nevents'] = sum(sum(e['number']) for e in entry['events'])
+        data.append(entry)
+    return {'status': 'ok', 'nresults': len(data), 'data': data}
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--query', required=True)
+    parser.add_argument('--limit', type=int, default=0)
+    parser.add_argument('--format', default='json')
+    args = parser.parse_args(in_args)
+
+    if os.environ.get('DAS_STUB_LOG'):
+        with open(os.environ['DAS_STUB_LOG'], 'a') as stub_log:
+            stub_log.write(args.query + '\n')
+
+    time.sleep(float(os.environ.get('DAS_STUB_DELAY', 0)))
+
+    dataset = re.search(r'dataset=(\S+)', args.query)
+    if not dataset or dataset.group(1) != STUB_DATASET:
+        result = {'status': 'fail', 'reason': 'Unknown dataset'}
+    elif args.query.startswith('summary'):
+        result = summary_result()
+    elif args.query.startswith('site'):
+        result = site_result()
+    elif args.query.split()[0] == 'file':
+        site = re.search(r'site=(\S+)', args.query)
+        result = file_info_result(args.limit or None, site.group(1) if site else None)
+    else:
+        result = file_result(args.limit or None, events='events' in args.query.split()[0])
+    sys.stdout.write(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,10 +5,16 @@ Script and modules to perform more efficient hadd-ing using HTCondor.
 
 Requires htcondenser
 
+The files are merged in a tree: each hadd job merges up to --size files,
+and its output is merged by a job in the next level, until there is one
+final job. So the time to merge grows with the log of the number of files.
+
+For a few small files, the same tree of hadds is run on this machine instead,
+since that is quicker than waiting for condor to schedule the jobs.
+
 TODO:
 
-- clever RAM/disk requirements using estimate
-- recursive algo - avoid hardcoding in just 2 layers - somehow allow for maximum?
+- better RAM estimate, from the objects in the files rather than their size
 
 [Refers to either the 80s classic "What is love",
 or the more modern "Hideaway" by Kiesza.]
@@ -16,13 +22,20 @@ or the more modern "Hideaway" by Kiesza.]
 
 import sys
 import os
+import re
 import argparse
 import logging
 from distutils.spawn import find_executable
-from itertools import izip_longest, chain
+from itertools import izip_longest, izip, chain
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import math
+import heapq
+import shutil
 import string
 import random
+import tempfile
+import subprocess
 from time import strftime
 
 
@@ -47,7 +60,7 @@ class ArgParser(argparse.ArgumentParser):
 
     def add_arguments(self):
         self.add_argument("--output",
-                          help="Output filename, must be on HDFS",
+                          help="Output filename, must be on HDFS unless running locally",
                           required=True)
 
         self.add_argument("--inputList",
@@ -57,10 +70,50 @@ class ArgParser(argparse.ArgumentParser):
                           help="Input file[s]")
 
         self.add_argument("--size", type=int, default=20,
-                          help="Number of files for an intermediate hadd job")
+                          help="Number of files for each hadd job")
+        self.add_argument("--grouping", choices=['count', 'size'], default='count',
+                          help="How to group the input files for the first level of hadd jobs: "
+                          "by number of files (--size), or by file size, so each job gets "
+                          "about --groupMB of files (and at most --size files)")
+        self.add_argument("--groupMB", type=float, default=2000,
+                          help="Total size of input files for each hadd job, for --grouping size")
+        self.add_argument("--maxDepth", type=int,
+                          help="Maximum number of levels of hadd jobs, including the final one. "
+                          "--size is increased if needed.")
 
         self.add_argument("--haddArgs",
-                          help="Arguments to pass to hadd")
+                          help="Arguments to pass to hadd. Any compression option (-f...) "
+                          "is only used for the final hadd, see --interCompression")
+        self.add_argument("--interCompression", default=DEFAULT_INTER_COMPRESSION,
+                          help="hadd compression option for the intermediate hadds, instead of "
+                          "any in --haddArgs. Their output is only read once, so use a fast level.")
+        self.add_argument("--haddProcs", type=int, default=1,
+                          help="Number of processes for each hadd (hadd -j), "
+                          "and CPUs requested for each hadd job")
+        self.add_argument("--resourceMargin", type=float, default=0.25,
+                          help="Fraction to add to the memory & disk space estimated from the file sizes")
+        self.add_argument("--dry",
+                          help="Only print the jobs & resources, don't submit them",
+                          action='store_true')
+
+        where = self.add_mutually_exclusive_group()
+        where.add_argument("--local",
+                           help="Run the hadds on this machine. "
+                           "Default is to do so if the input files are small enough "
+                           "(see --localMaxMB, --localMaxFiles)",
+                           action='store_true')
+        where.add_argument("--condor",
+                           help="Run the hadds as condor jobs, however small the input files",
+                           action='store_true')
+        self.add_argument("--localMaxMB", type=float, default=2000,
+                          help="Maximum total size of input files to hadd locally by default")
+        self.add_argument("--localMaxFiles", type=int, default=500,
+                          help="Maximum number of input files to hadd locally by default")
+        self.add_argument("--nProcs", type=int, default=cpu_count(),
+                          help="Maximum number of hadds to run at once locally. "
+                          "Limited so this times --haddProcs is at most the number of CPUs.")
+        self.add_argument("--scratchDir", default=tempfile.gettempdir(),
+                          help="Directory for intermediate files when running locally")
         self.add_argument("--verbose", "-v",
                           help="Extra printout to clog up your screen.",
                           action='store_true')
@@ -87,7 +140,18 @@ def grouper(iterable, n, fillvalue=None):
     return izip_longest(fillvalue=fillvalue, *args)
 
 
-def arrange_hadd_files(input_files, group_size):
+# Most files one hadd job can merge
+MAX_HADD_INPUTS = 255
+
+# Intermediate files are only read once by the next level, then deleted,
+# so don't spend time compressing them much
+DEFAULT_INTER_COMPRESSION = "-f1"
+
+# hadd compression options, e.g. -f, -f6, -fk, -ff
+HADD_COMPRESSION_RE = re.compile(r'^-f[kf]?\d*$')
+
+
+def group_hadd_files(input_files, group_size):
     """Groups `input_files` into groups of `group_size`.
 
     Parameters
@@ -119,80 +183,298 @@ def arrange_hadd_files(input_files, group_size):
     else:
         intermediate_jobs = []
         for i, job_group in enumerate(grouper(input_files, group_size)):
-            job_group = list(filter(None, job_group))
+            job_group = [f for f in job_group if f is not None]
             intermediate_jobs.append(job_group)
     return intermediate_jobs
 
 
-def rand_str(length=3):
-    """Generate a random string of user-specified length"""
-    return ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase)
-                   for _ in range(length))
+def group_hadd_files_by_size(input_files, file_sizes, target_bytes, max_files):
+    """Groups `input_files` so each group has about `target_bytes` of files,
+    and at most `max_files` files.
 
+    The total size of each group is balanced by adding files, largest first,
+    to the group with the smallest total (longest processing time first).
 
-def create_hadd_jobs(input_files, group_size, final_filename, hadd_args=None):
-    """Create htcondenser.Job objects for intermediate and final hadd jobs.
+    Parameters
+    ----------
+    input_files : list[str]
+        List of input files to be grouped
+    file_sizes : dict
+        {filename: size in bytes}
+    target_bytes : float
+        Ideal total size of each group
+    max_files : int
+        Maximum number of files in each group
+
+    Returns
+    -------
+    list[list[str]]
+        List of groups of filenames, each in the same order as `input_files`
+    """
+    total_bytes = sum(file_sizes[f] for f in input_files)
+    n_groups = max(int(math.ceil(total_bytes / float(target_bytes))),
+                   int(math.ceil(len(input_files) / float(max_files))), 1)
+    n_groups = min(n_groups, len(input_files))
+    if n_groups == 1:
+        return [list(input_files)]
+
+    groups = [[] for _ in xrange(n_groups)]
+    # (total bytes, group index) of groups that can take more files
+    heap = [(0, ind) for ind in xrange(n_groups)]
+    for f in sorted(input_files, key=lambda f: file_sizes[f], reverse=True):
+        group_bytes, ind = heapq.heappop(heap)
+        groups[ind].append(f)
+        if len(groups[ind]) < max_files:
+            heapq.heappush(heap, (group_bytes + file_sizes[f], ind))
+
+    order = {f: i for i, f in enumerate(input_files)}
+    return [sorted(group, key=order.get) for group in groups]
+
+
+def arrange_hadd_files(input_files, group_size, max_depth=None, file_sizes=None, target_bytes=None):
+    """Arrange `input_files` into a tree of hadd jobs, each merging up to
+    `group_size` files, with one final job at the top.
 
     Parameters
     ----------
     input_files : list[str]
-        List of input files
+        List of input files to be merged
     group_size : int
-        Size of each intermediate hadd job
-    final_filename : str
-        Final filename
-    hadd_args : str, optional
-        Optional args to pass to hadd
+        Ideal number of files for each hadd job (fan-in)
+    max_depth : int, optional
+        Maximum number of levels, including the final job.
+        If needed, group_size is increased so the tree fits.
+    file_sizes : dict, optional
+        {filename: size in bytes} of input files. If this and target_bytes
+        are set, the first level is grouped by size (see group_hadd_files_by_size)
+    target_bytes : float, optional
+        Ideal total size of the files for each job in the first level
 
     Returns
     -------
-    list[htcondenser.Job], htcondenser.Job
-        List of intermediate jobs, and a final hadd job
+    list[list[list]]
+        Groups for each level. Groups in the first level are lists of
+        input files, groups in later levels are lists of indices of the
+        groups in the level before. The last level has one group.
+
+    Raises
+    ------
+    RuntimeError
+        If a group would have more than MAX_HADD_INPUTS files,
+        or the tree cannot fit in max_depth levels
+    """
+    if max_depth is not None and max_depth < 1:
+        raise RuntimeError("max_depth must be >= 1")
+    group_size = int(group_size)
+    if max_depth is not None:
+        # smallest that could fit, may need to go up if groups aren't all full
+        group_size = max(group_size, int(math.ceil(len(input_files) ** (1. / max_depth))))
+    while True:
+        if file_sizes is not None and target_bytes:
+            levels = [group_hadd_files_by_size(input_files, file_sizes, target_bytes, group_size)]
+        else:
+            levels = [group_hadd_files(input_files, group_size)]
+        while len(levels[-1]) > 1:
+            levels.append(group_hadd_files(range(len(levels[-1])), group_size))
+        if max_depth is None or len(levels) <= max_depth:
+            break
+        if group_size >= len(input_files):
+            raise RuntimeError("Cannot merge files in %d levels" % max_depth)
+        group_size += 1
+    log.debug("Using up to %d files per hadd job, in %d levels", group_size, len(levels))
+    if max(len(g) for level in levels for g in level) > MAX_HADD_INPUTS:
+        raise RuntimeError("hadd cannot cope with more than %d files, reduce --size or increase --maxDepth"
+                           % MAX_HADD_INPUTS)
+    return levels
+
+
+def resource_bucket(mb):
+    """Round up to 125 MB times a power of 2 (..., 500MB, 1GB, 2GB, ...),
+    so jobs needing similar resources can share a JobSet"""
+    return 125 * 2 ** int(math.ceil(math.log(max(mb, 125) / 125., 2)))
+
+
+def estimate_hadd_memory(largest_input_bytes, margin=0.25):
+    """Estimate the memory needed for a hadd job.
+
+    A rough guess: hadd holds the objects from about one input file at a
+    time, so allow twice the largest (compressed) input file, and at least 1GB.
 
+    Returns
+    -------
+    int
+        Memory in MB, rounded up to 100 MB
+    """
+    return max(1000, int(math.ceil(2 * largest_input_bytes * (1 + margin) / 1024. ** 2 / 100.) * 100))
+
+
+def estimate_hadd_disk(input_bytes, margin=0.25):
+    """Estimate the disk space needed for a hadd job: its input files,
+    plus the output, which is at most the same size as the inputs.
+
+    Parameters
+    ----------
+    input_bytes : int
+        Total size of input files
+    margin : float, optional
+        Fraction to add
+
+    Returns
+    -------
+    int
+        Disk space in MB, rounded up to 100 MB
+    """
+    return max(100, int(math.ceil(2 * input_bytes * (1 + margin) / 1024. ** 2 / 100.) * 100))
+
+
+def bucket_hadd_jobs(jobs, file_sizes, margin=0.25, num_procs=1):
+    """Work out the memory & disk for each hadd job in a level from the
+    sizes of its input files, and group jobs that need the same, so they
+    can share a JobSet.
+
+    Parameters
+    ----------
+    jobs : list[htcondenser.Job]
+        hadd jobs in one level
+    file_sizes : dict
+        {filename: size in bytes} of input files. The size of each job's output
+        is added, assuming it is at most the size of its inputs.
+    margin : float, optional
+        Fraction to add to the estimates
+    num_procs : int, optional
+        Number of processes for each hadd, each of which holds its own objects
+
+    Returns
+    -------
+    list[((int, int), list[htcondenser.Job])]
+        (memory, disk) in MB and the jobs needing them
     """
-    hadd_file_groups = arrange_hadd_files(input_files, group_size)
+    buckets = {}
+    for job in jobs:
+        input_sizes = [file_sizes[f] for f in job.input_files]
+        file_sizes[job.output_files[0]] = sum(input_sizes)
+        memory = resource_bucket(num_procs * estimate_hadd_memory(max(input_sizes), margin))
+        disk = resource_bucket(estimate_hadd_disk(sum(input_sizes), margin))
+        buckets.setdefault((memory, disk), []).append(job)
+    return sorted(buckets.items())
 
-    hadd_args = hadd_args or ""
 
-    inter_jobs = []
-    final_file_input = hadd_file_groups[0]  # when only 1 intermediate job
+def rand_str(length=3):
+    """Generate a random string of user-specified length"""
+    return ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase)
+                   for _ in range(length))
+
 
-    # add intermediate files if needed
-    if len(hadd_file_groups) > 1:
-        final_file_input = []
+def inter_hadd_args(hadd_args, compression=DEFAULT_INTER_COMPRESSION):
+    """Get the args for intermediate hadds: hadd_args, with any compression
+    option replaced by `compression`, so other options (e.g. -k) are kept."""
+    args = [a for a in (hadd_args or "").split() if not HADD_COMPRESSION_RE.match(a)]
+    return ' '.join([compression] + args)
 
-        if len(hadd_file_groups) > 255:
-            raise RuntimeError("Final hadd cannot cope with %d intermediate jobs" % len(hadd_file_groups))
 
-        final_dir = os.path.dirname(final_filename)
+def hadd_command_args(hadd_args, num_procs=1):
+    """Split hadd args into a list, adding -j if using several processes"""
+    args = (hadd_args or "").split()
+    if num_procs > 1:
+        args += ["-j", str(num_procs)]
+    return args
 
-        for ind, group in enumerate(hadd_file_groups):
-            inter_output_file = os.path.join(final_dir, 'haddInter_%d_%s.root' % (ind, rand_str(5)))
-            this_hadd_args = hadd_args.split() + [inter_output_file] + group
-            inter_job = ht.Job(name="interHadd_%d" % ind,
-                               args=this_hadd_args,
-                               input_files=group,
-                               output_files=[inter_output_file])
-            inter_jobs.append(inter_job)
-            final_file_input.append(inter_output_file)
 
-    # add final job
-    this_hadd_args = hadd_args.split() + [final_filename] + final_file_input
-    final_hadd_job = ht.Job(name="finalHadd",
-                            args=this_hadd_args,
-                            input_files=final_file_input,
-                            output_files=[final_filename])
+def create_hadd_jobs(input_files, group_size, final_filename, hadd_args=None, max_depth=None,
+                     file_sizes=None, target_bytes=None, name_prefix="",
+                     inter_compression=DEFAULT_INTER_COMPRESSION, num_procs=1):
+    """Create htcondenser.Job objects for a tree of hadd jobs
+    (see arrange_hadd_files). A group of one file doesn't get a job,
+    the file is passed up to be merged in the next level.
 
-    return (inter_jobs, final_hadd_job)
+    Parameters
+    ----------
+    input_files : list[str]
+        List of input files
+    group_size : int
+        Number of files for each hadd job
+    final_filename : str
+        Final filename
+    hadd_args : str, optional
+        Optional args to pass to the final hadd
+    max_depth : int, optional
+        Maximum number of levels of jobs
+    file_sizes : dict, optional
+        {filename: size in bytes}, to group the first level by size
+    target_bytes : float, optional
+        Ideal total size of the input files for each job in the first level
+    name_prefix : str, optional
+        Prefix for job names, to keep them unique if there are several
+        sets of hadd jobs in one DAG
+    inter_compression : str, optional
+        Compression option for the intermediate hadds (see inter_hadd_args)
+    num_procs : int, optional
+        Number of processes for each hadd (hadd -j)
 
+    Returns
+    -------
+    list[list[htcondenser.Job]], dict
+        Jobs for each level, the last level being only the final hadd job,
+        and a dict of {job name: list of jobs it needs to run after}
 
-def create_intermediate_cleanup_jobs(inter_hadd_jobs):
+    """
+    hadd_file_groups = arrange_hadd_files(input_files, group_size, max_depth, file_sizes, target_bytes)
+
+    final_args = hadd_command_args(hadd_args, num_procs)
+    inter_args = hadd_command_args(inter_hadd_args(hadd_args, inter_compression), num_procs)
+    final_dir = os.path.dirname(final_filename)
+
+    job_levels = []
+    requires = {}
+    # (file, job that makes it or None) for each group in the level before
+    level_outputs = [(f, None) for f in input_files]
+    for level_ind, groups in enumerate(hadd_file_groups):
+        jobs = []
+        outputs = []
+        for ind, group in enumerate(groups):
+            if level_ind == 0:
+                group_outputs = [(f, None) for f in group]
+            else:
+                # merge the outputs of the level before
+                group_outputs = [level_outputs[i] for i in group]
+            parents = [job for _, job in group_outputs if job is not None]
+            group_files = [f for f, _ in group_outputs]
+
+            if len(group_files) == 1 and level_ind < len(hadd_file_groups) - 1:
+                # nothing to merge, pass it up to the next level
+                outputs.append(group_outputs[0])
+                continue
+
+            if level_ind == len(hadd_file_groups) - 1:
+                name, output_file = name_prefix + "finalHadd", final_filename
+                this_hadd_args = final_args[:]
+            else:
+                name = name_prefix + "interHadd_%d_%d" % (level_ind, ind)
+                output_file = os.path.join(final_dir, 'haddInter_%d_%d_%s.root' % (level_ind, ind, rand_str(5)))
+                this_hadd_args = inter_args[:]
+            this_hadd_args += [output_file] + group_files
+            job = ht.Job(name=name,
+                         args=this_hadd_args,
+                         input_files=group_files,
+                         output_files=[output_file])
+            requires[name] = parents
+            jobs.append(job)
+            outputs.append((output_file, job))
+        job_levels.append(jobs)
+        level_outputs = outputs
+
+    return job_levels, requires
+
+
+def create_intermediate_cleanup_jobs(inter_hadd_jobs, name_prefix=""):
     """Create htcondenser.Job objects to cleanup intermediate hadd files.
 
     Parameters
     ----------
     inter_hadd_jobs : list[htcondenser.Job]
         List of intermediate hadd Jobs
+    name_prefix : str, optional
+        Prefix for job names
 
     Returns
     -------
@@ -201,12 +483,147 @@ def create_intermediate_cleanup_jobs(inter_hadd_jobs):
     """
     rm_jobs = []
     for ind, job in enumerate(inter_hadd_jobs):
-        rm_job = ht.Job(name="rm_%d" % ind,
+        rm_job = ht.Job(name=name_prefix + "rm_%d" % ind,
                         args=" fs -rm -skipTrash %s" % job.output_files[0].replace("/hdfs", ""))
         rm_jobs.append(rm_job)
     return rm_jobs
 
 
+def use_local_hadd(file_sizes, max_bytes, max_files):
+    """Decide whether to hadd files on this machine rather than with condor:
+    for a few small files, waiting for condor to schedule the jobs takes
+    longer than the hadds themselves.
+
+    Parameters
+    ----------
+    file_sizes : dict
+        {filename: size in bytes} of input files
+    max_bytes : float
+        Maximum total size of input files
+    max_files : int
+        Maximum number of input files
+
+    Returns
+    -------
+    bool
+    """
+    return len(file_sizes) <= max_files and sum(file_sizes.itervalues()) <= max_bytes
+
+
+def run_hadd(cmd):
+    """Run a hadd command, returning (command, exit code, output)"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return cmd, proc.returncode, output
+
+
+def copy_to_output(filename, final_filename):
+    """Move a local file to its final location, using hadoop if on HDFS"""
+    if final_filename.startswith('/hdfs'):
+        subprocess.check_call(['hadoop', 'fs', '-copyFromLocal', '-f', filename,
+                               final_filename.replace('/hdfs', '', 1)])
+        os.remove(filename)
+    else:
+        if not os.path.isdir(os.path.dirname(final_filename)):
+            os.makedirs(os.path.dirname(final_filename))
+        shutil.move(filename, final_filename)
+
+
+def num_local_hadds(num_procs, hadd_procs=1):
+    """Number of hadds to run at once locally, so that with `hadd_procs`
+    processes each they don't use more than the number of CPUs"""
+    return max(1, min(num_procs or cpu_count(), cpu_count() // hadd_procs))
+
+
+def local_hadd(input_files, group_size, final_filename, hadd_args=None, max_depth=None,
+               file_sizes=None, target_bytes=None, num_procs=None, scratch_dir=None, dry=False,
+               inter_compression=DEFAULT_INTER_COMPRESSION, hadd_procs=1):
+    """Run a tree of hadds (see arrange_hadd_files) on this machine.
+
+    Each level is run with up to `num_procs` hadds at once
+    (see num_local_hadds).
+    Intermediate files are made in a temporary directory in `scratch_dir`,
+    and are deleted once they have been merged.
+
+    Parameters
+    ----------
+    input_files : list[str]
+        List of input files
+    group_size : int
+        Number of files for each hadd
+    final_filename : str
+        Final filename
+    hadd_args : str, optional
+        Optional args to pass to the final hadd
+    max_depth : int, optional
+        Maximum number of levels of hadds
+    file_sizes : dict, optional
+        {filename: size in bytes}, to group the first level by size
+    target_bytes : float, optional
+        Ideal total size of the input files for each hadd in the first level
+    num_procs : int, optional
+        Maximum number of hadds to run at once, default is the number of CPUs
+    scratch_dir : str, optional
+        Directory for intermediate files
+    dry : bool, optional
+        Only print the hadds to be run
+    inter_compression : str, optional
+        Compression option for the intermediate hadds (see inter_hadd_args)
+    hadd_procs : int, optional
+        Number of processes for each hadd (hadd -j)
+
+    Raises
+    ------
+    RuntimeError
+        If a hadd fails
+    """
+    levels = arrange_hadd_files(input_files, group_size, max_depth, file_sizes, target_bytes)
+    final_args = hadd_command_args(hadd_args, hadd_procs)
+    inter_args = hadd_command_args(inter_hadd_args(hadd_args, inter_compression), hadd_procs)
+    num_hadds = 1 + sum(1 for groups in levels[:-1] for group in groups if len(group) > 1)
+    log.info("Running %d hadds in %d levels locally", num_hadds, len(levels))
+    if dry:
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='haddaway_', dir=scratch_dir)
+    pool = ThreadPool(num_local_hadds(num_procs, hadd_procs))
+    try:
+        level_files = input_files
+        for level_ind, groups in enumerate(levels):
+            if level_ind > 0:
+                groups = [[level_files[i] for i in group] for group in groups]
+            outputs, cmds = [], []
+            for ind, group in enumerate(groups):
+                if len(group) == 1 and level_ind < len(levels) - 1:
+                    # nothing to merge, pass it up to the next level
+                    outputs.append(group[0])
+                    continue
+                output = os.path.join(tmp_dir, 'haddInter_%d_%d.root' % (level_ind, ind))
+                this_args = final_args if level_ind == len(levels) - 1 else inter_args
+                cmds.append(['hadd'] + this_args + [output] + group)
+                outputs.append(output)
+
+            log.info("Level %d: %d hadds", level_ind, len(cmds))
+            for cmd, returncode, output in pool.imap_unordered(run_hadd, cmds):
+                log.debug(output)
+                if returncode != 0:
+                    log.error(output)
+                    raise RuntimeError("hadd failed with exit code %d: %s" % (returncode, ' '.join(cmd)))
+
+            # intermediate files from the level before are no longer needed
+            for f in set(level_files) - set(outputs):
+                if f.startswith(tmp_dir):
+                    os.remove(f)
+            level_files = outputs
+
+        copy_to_output(level_files[0], final_filename)
+        log.info("Written %s", final_filename)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmp_dir)
+
+
 def haddaway(in_args=sys.argv[1:]):
     parser = ArgParser(description=__doc__, formatter_class=CustomFormatter)
     args = parser.parse_args(args=in_args)
@@ -219,12 +636,16 @@ def haddaway(in_args=sys.argv[1:]):
     # Check hadd exists
     check_hadd_exists()
 
+    if args.groupMB <= 0:
+        raise RuntimeError("--groupMB must be > 0")
+
+    if args.haddProcs < 1:
+        raise RuntimeError("--haddProcs must be >= 1")
+
     if not args.input and not args.inputList:
         raise RuntimeError("Need to specify --input or --inputFiles")
 
     final_filename = args.output
-    if not final_filename.startswith("/hdfs"):
-        raise RuntimeError("Output file MUST be on HDFS")
 
     # Get list of input files, do checks
     input_files = []
@@ -248,10 +669,30 @@ def haddaway(in_args=sys.argv[1:]):
 
     log.debug('Input:', input_files)
 
+    file_sizes = {f: os.path.getsize(f) for f in input_files}
+
+    target_bytes = args.groupMB * 1024 ** 2 if args.grouping == 'size' else None
+
+    if args.local or (not args.condor and use_local_hadd(file_sizes, args.localMaxMB * 1024 ** 2,
+                                                         args.localMaxFiles)):
+        local_hadd(input_files, args.size, os.path.abspath(final_filename),
+                   hadd_args=args.haddArgs, max_depth=args.maxDepth,
+                   file_sizes=file_sizes, target_bytes=target_bytes,
+                   num_procs=args.nProcs, scratch_dir=args.scratchDir, dry=args.dry,
+                   inter_compression=args.interCompression, hadd_procs=args.haddProcs)
+        return 0
+
+    if not final_filename.startswith("/hdfs"):
+        raise RuntimeError("Output file MUST be on HDFS")
+
     # Arrange into jobs
-    inter_hadd_jobs, final_hadd_job = create_hadd_jobs(input_files, args.size, final_filename, hadd_args=args.haddArgs)
+    job_levels, requires = create_hadd_jobs(input_files, args.size, final_filename,
+                                            hadd_args=args.haddArgs, max_depth=args.maxDepth,
+                                            file_sizes=file_sizes, target_bytes=target_bytes,
+                                            inter_compression=args.interCompression, num_procs=args.haddProcs)
+    inter_hadd_jobs = [job for jobs in job_levels[:-1] for job in jobs]
 
-    log.info("Creating %d intermediate jobs", len(inter_hadd_jobs))
+    log.info("Creating %d intermediate jobs in %d levels", len(inter_hadd_jobs), len(job_levels) - 1)
 
     # Add to JobSet and DAG
     user_dict = {
@@ -267,61 +708,67 @@ def haddaway(in_args=sys.argv[1:]):
     hadd_dag = ht.DAGMan(filename=dag_file,
                          status_file=status_file)
 
-    condor_file = os.path.join(log_dir, "haddaway_{timestamp}.condor".format(**user_dict))
     log_stem = "hadd.$(cluster).$(process)"
 
-    # TODO: clever estimate of RAM/disk size required
-
-    hadd_jobset = ht.JobSet(exe='hadd', copy_exe=False,
-                            filename=condor_file,
-                            out_dir=os.path.join(log_dir, 'logs'), out_file=log_stem + '.out',
-                            err_dir=os.path.join(log_dir, 'logs'), err_file=log_stem + '.err',
-                            log_dir=os.path.join(log_dir, 'logs'), log_file=log_stem + '.log',
-                            cpus=1, memory='1GB', disk='1.5GB',
-                            transfer_hdfs_input=True,
-                            share_exe_setup=True,
-                            hdfs_store=os.path.dirname(final_filename))
-
-    for job in inter_hadd_jobs:
-        hadd_jobset.add_job(job)
-        hadd_dag.add_job(job)
-
-    hadd_jobset.add_job(final_hadd_job)
-    hadd_dag.add_job(final_hadd_job, requires=inter_hadd_jobs if inter_hadd_jobs else None)
-
-    # Add removal jobs if necessary
+    # Memory & disk from the input file sizes. Each intermediate file is
+    # at most the size of its inputs. Jobs needing similar resources share a JobSet.
+    for level_ind, jobs in enumerate(job_levels):
+        for (memory, disk), bucket_jobs in bucket_hadd_jobs(jobs, file_sizes, args.resourceMargin,
+                                                            args.haddProcs):
+            if job_levels[-1] is jobs:
+                log.info("Final hadd job requesting %dMB memory, %dMB disk", memory, disk)
+                condor_file = os.path.join(log_dir, "haddFinal_{timestamp}.condor".format(**user_dict))
+            else:
+                log.info("Level %d: %d hadd jobs requesting %dMB memory, %dMB disk",
+                         level_ind, len(bucket_jobs), memory, disk)
+                condor_file = os.path.join(log_dir, "haddaway_{timestamp}_{level}_{memory}_{disk}.condor".format(
+                    level=level_ind, memory=memory, disk=disk, **user_dict))
+            hadd_jobset = ht.JobSet(exe='hadd', copy_exe=False,
+                                    filename=condor_file,
+                                    out_dir=os.path.join(log_dir, 'logs'), out_file=log_stem + '.out',
+                                    err_dir=os.path.join(log_dir, 'logs'), err_file=log_stem + '.err',
+                                    log_dir=os.path.join(log_dir, 'logs'), log_file=log_stem + '.log',
+                                    cpus=args.haddProcs, memory='%dMB' % memory, disk='%dMB' % disk,
+                                    transfer_hdfs_input=True,
+                                    share_exe_setup=True,
+                                    hdfs_store=os.path.dirname(final_filename))
+
+            for job in bucket_jobs:
+                hadd_jobset.add_job(job)
+                hadd_dag.add_job(job, requires=requires[job.name] or None)
+
+    # Add jobs to remove intermediate files once the next level has used them
+    consumers = {parent.name: job for jobs in job_levels for job in jobs for parent in requires[job.name]}
     rm_jobs = create_intermediate_cleanup_jobs(inter_hadd_jobs)
 
-    if len(rm_jobs) > 0:
-        condor_file = os.path.join(log_dir, "rm_{timestamp}.condor".format(**user_dict))
-        log_stem = "rm.$(cluster).$(process)"
-
-        rm_jobset = ht.JobSet(exe="hadoop", copy_exe=False,
-                              filename=condor_file,
-                              out_dir=os.path.join(log_dir, 'logs'), out_file=log_stem + '.out',
-                              err_dir=os.path.join(log_dir, 'logs'), err_file=log_stem + '.err',
-                              log_dir=os.path.join(log_dir, 'logs'), log_file=log_stem + '.log',
-                              cpus=1, memory='100MB', disk='10MB',
-                              transfer_hdfs_input=False,
-                              share_exe_setup=False,
-                              hdfs_store=os.path.dirname(final_filename))
-        for job in rm_jobs:
-            rm_jobset.add_job(job)
-            hadd_dag.add_job(job, requires=final_hadd_job)
+    condor_file = os.path.join(log_dir, "rm_{timestamp}.condor".format(**user_dict))
+    log_stem = "rm.$(cluster).$(process)"
+    rm_jobset = ht.JobSet(exe="hadoop", copy_exe=False,
+                          filename=condor_file,
+                          out_dir=os.path.join(log_dir, 'logs'), out_file=log_stem + '.out',
+                          err_dir=os.path.join(log_dir, 'logs'), err_file=log_stem + '.err',
+                          log_dir=os.path.join(log_dir, 'logs'), log_file=log_stem + '.log',
+                          cpus=1, memory='100MB', disk='10MB',
+                          transfer_hdfs_input=False,
+                          share_exe_setup=False,
+                          hdfs_store=os.path.dirname(final_filename))
+    for inter_job, rm_job in izip(inter_hadd_jobs, rm_jobs):
+        rm_jobset.add_job(rm_job)
+        hadd_dag.add_job(rm_job, requires=consumers[inter_job.name])
 
     # add jobs to remove copies from HDFS if they weren't there originally
-    for job_ind, job in enumerate(inter_hadd_jobs):
+    # (input files can be passed up to later levels)
+    for job_ind, job in enumerate(chain.from_iterable(job_levels)):
         for m_ind, mirror in enumerate(job.input_file_mirrors):
             if not mirror.original.startswith('/hdfs'):
-                condor_file = os.path.join(log_dir, "rmCopy_{timestamp}.condor".format(**user_dict))
-                log_stem = "rmCopy.$(cluster).$(process)"
                 rm_job = ht.Job(name="rmCopy_%d_%d" % (job_ind, m_ind),
                                 args=" fs -rm -skipTrash %s" % mirror.hdfs.replace("/hdfs", ""))
                 rm_jobset.add_job(rm_job)
                 hadd_dag.add_job(rm_job, requires=job)
 
     # Submit jobs
-    hadd_dag.submit()
+    if not args.dry:
+        hadd_dag.submit()
 
     return 0
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+Unittests for haddaway.py
+
+"""
+
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+from itertools import chain
+sys.path.append(os.path.join(os.getcwd(), '..'))
+import haddaway as hw
+
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_names(num_files):
+    return ['/hdfs/in/file%d.root' % i for i in xrange(num_files)]
+
+
+class HaddTreeTests(unittest.TestCase):
+
+    def test_group_hadd_files(self):
+        # file 0 must not be dropped
+        self.assertEqual(hw.group_hadd_files(range(4), 2), [[0, 1], [2, 3]])
+        self.assertEqual(hw.group_hadd_files(range(5), 2), [[0, 1], [2, 3], [4]])
+        # avoid a group of 1
+        self.assertEqual(hw.group_hadd_files(range(7), 3), [[0, 1], [2, 3], [4, 5], [6]])
+        self.assertEqual(hw.group_hadd_files(range(3), 5), [[0, 1, 2]])
+        self.assertRaises(RuntimeError, hw.group_hadd_files, range(3), 1)
+
+    def test_arrange_hadd_files(self):
+        files = make_names(16)
+        levels = hw.arrange_hadd_files(files, 4)
+        self.assertEqual(levels, [[files[0:4], files[4:8], files[8:12], files[12:16]], [[0, 1, 2, 3]]])
+
+        files = make_names(50)
+        levels = hw.arrange_hadd_files(files, 4)
+        self.assertEqual(sorted(chain.from_iterable(levels[0])), sorted(files))
+        for level_ind in xrange(1, len(levels)):
+            self.assertEqual(sorted(chain.from_iterable(levels[level_ind])), range(len(levels[level_ind - 1])))
+        self.assertEqual(len(levels[-1]), 1)
+        self.assertTrue(all(len(g) <= 4 for level in levels for g in level))
+
+    def test_arrange_max_depth(self):
+        files = make_names(100)
+        self.assertEqual(len(hw.arrange_hadd_files(files, 2)), 7)
+        # group size goes up to fit in 2 levels
+        levels = hw.arrange_hadd_files(files, 2, max_depth=2)
+        self.assertEqual(len(levels), 2)
+        self.assertTrue(max(len(g) for g in levels[0]) >= 10)
+        self.assertEqual(hw.arrange_hadd_files(files, 2, max_depth=1), [[files]])
+        self.assertRaises(RuntimeError, hw.arrange_hadd_files, files, 2, max_depth=0)
+
+    def test_arrange_max_inputs(self):
+        files = make_names(hw.MAX_HADD_INPUTS + 1)
+        self.assertRaises(RuntimeError, hw.arrange_hadd_files, files, 2, max_depth=1)
+        self.assertRaises(RuntimeError, hw.arrange_hadd_files, files, hw.MAX_HADD_INPUTS + 1)
+        self.assertEqual(len(hw.arrange_hadd_files(files, 20)), 2)
+
+    def test_create_hadd_jobs(self):
+        files = make_names(5)
+        job_levels, requires = hw.create_hadd_jobs(files, 2, '/hdfs/out/final.root', name_prefix='test_')
+        self.assertEqual([[j.name for j in jobs] for jobs in job_levels],
+                         [['test_interHadd_0_0', 'test_interHadd_0_1'], ['test_interHadd_1_0'], ['test_finalHadd']])
+        # no job merges a single file, the last file is passed up to the final hadd
+        self.assertTrue(all(len(j.input_files) > 1 for jobs in job_levels for j in jobs))
+        final = job_levels[-1][0]
+        self.assertEqual(final.input_files, [job_levels[1][0].output_files[0], files[4]])
+        self.assertEqual(final.output_files, ['/hdfs/out/final.root'])
+        self.assertEqual(requires[final.name], job_levels[1])
+        self.assertEqual(requires[job_levels[1][0].name], job_levels[0])
+        self.assertEqual(requires[job_levels[0][0].name], [])
+
+    def test_inter_hadd_args(self):
+        self.assertEqual(hw.inter_hadd_args(None), '-f1')
+        self.assertEqual(hw.inter_hadd_args('-f7 -k -T'), '-f1 -k -T')
+        self.assertEqual(hw.inter_hadd_args('-fk404 -k', '-f0'), '-f0 -k')
+        job_levels, _ = hw.create_hadd_jobs(make_names(4), 2, '/hdfs/out/final.root', hadd_args='-k -f7',
+                                            num_procs=2)
+        self.assertEqual(job_levels[0][0].args[:5], ['-f1', '-k', '-j', '2', job_levels[0][0].output_files[0]])
+        self.assertEqual(job_levels[-1][0].args[:5], ['-k', '-f7', '-j', '2', '/hdfs/out/final.root'])
+
+
+class GroupingTests(unittest.TestCase):
+
+    def test_group_by_size(self):
+        files = ['a', 'b', 'c', 'd', 'e', 'f']
+        sizes = dict(zip(files, [9, 1, 1, 1, 7, 5]))
+        groups = hw.group_hadd_files_by_size(files, sizes, 8, 10)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sorted(chain.from_iterable(groups)), files)
+        # largest first onto the smallest group: [a], [d, e], [b, c, f]
+        self.assertEqual(sorted(sum(sizes[f] for f in g) for g in groups), [7, 8, 9])
+        # groups keep the order of the input files
+        self.assertTrue(all(g == sorted(g) for g in groups))
+        self.assertEqual(hw.group_hadd_files_by_size(files, sizes, 100, 10), [files])
+
+    def test_group_by_size_max_files(self):
+        files = make_names(10)
+        sizes = dict((f, 1) for f in files)
+        groups = hw.group_hadd_files_by_size(files, sizes, 100, 3)
+        self.assertEqual(len(groups), 4)
+        self.assertTrue(all(len(g) <= 3 for g in groups))
+        # a big file doesn't stop small files filling up the other groups
+        sizes[files[0]] = 1000
+        groups = hw.group_hadd_files_by_size(files, sizes, 10, 3)
+        self.assertTrue(all(len(g) <= 3 for g in groups))
+        self.assertEqual(sorted(chain.from_iterable(groups)), sorted(files))
+        self.assertIn([files[0]], groups)
+
+    def test_resources(self):
+        self.assertEqual(hw.resource_bucket(1), 125)
+        self.assertEqual(hw.resource_bucket(125), 125)
+        self.assertEqual(hw.resource_bucket(126), 250)
+        self.assertEqual(hw.resource_bucket(1000), 1000)
+        self.assertEqual(hw.resource_bucket(1001), 2000)
+        self.assertEqual(hw.estimate_hadd_memory(1024 ** 2), 1000)
+        self.assertEqual(hw.estimate_hadd_memory(1024 ** 3, 0.25), 2600)
+        self.assertEqual(hw.estimate_hadd_disk(0), 100)
+        self.assertEqual(hw.estimate_hadd_disk(1024 ** 3, 0), 2100)
+
+
+class LocalHaddTests(unittest.TestCase):
+    """Uses the stub hadd & hadoop in this directory"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stub_log = os.path.join(self.tmp_dir, 'hadd_calls.txt')
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = TEST_DIR + os.pathsep + self.old_path
+        os.environ['HADD_STUB_LOG'] = self.stub_log
+        os.environ['HADOOP_STUB_ROOT'] = os.path.join(self.tmp_dir, 'hdfs')
+        self.scratch_dir = os.path.join(self.tmp_dir, 'scratch')
+        os.makedirs(self.scratch_dir)
+        self.files = []
+        for i in xrange(5):
+            self.files.append(os.path.join(self.tmp_dir, 'in_%d.root' % i))
+            with open(self.files[-1], 'w') as f:
+                f.write('%d\n' % i)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        del os.environ['HADD_STUB_LOG']
+        del os.environ['HADOOP_STUB_ROOT']
+        shutil.rmtree(self.tmp_dir)
+
+    def hadd_calls(self):
+        with open(self.stub_log) as f:
+            return [l.split() for l in f]
+
+    def test_local_hadd(self):
+        output = os.path.join(self.tmp_dir, 'out', 'final.root')
+        hw.local_hadd(self.files, 2, output, hadd_args='-f7', num_procs=2, scratch_dir=self.scratch_dir)
+        with open(output) as f:
+            self.assertEqual(f.read(), '0\n1\n2\n3\n4\n')
+        # 2 hadds, then 1 to merge them, then the final one with the last file passed up
+        calls = self.hadd_calls()
+        self.assertEqual(len(calls), 4)
+        self.assertTrue(all(len(c) > 3 for c in calls))
+        self.assertEqual([c[0] for c in calls], ['-f1', '-f1', '-f1', '-f7'])
+        self.assertEqual(calls[-1][-1], self.files[-1])
+        # intermediate files are cleaned up
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_local_hadd_fails(self):
+        os.remove(self.files[2])
+        output = os.path.join(self.tmp_dir, 'final.root')
+        self.assertRaises(RuntimeError, hw.local_hadd, self.files, 2, output, scratch_dir=self.scratch_dir)
+        self.assertFalse(os.path.exists(output))
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_copy_to_output(self):
+        output = os.path.join(self.tmp_dir, 'new_dir', 'final.root')
+        hw.copy_to_output(self.files[0], output)
+        self.assertTrue(os.path.isfile(output))
+        self.assertFalse(os.path.exists(self.files[0]))
+
+        hw.copy_to_output(self.files[1], '/hdfs/user/test/final.root')
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'hdfs', 'user', 'test', 'final.root')))
+        self.assertFalse(os.path.exists(self.files[1]))
+
+    def test_num_local_hadds(self):
+        num_cpus = hw.cpu_count()
+        self.assertEqual(hw.num_local_hadds(None), num_cpus)
+        self.assertEqual(hw.num_local_hadds(1), 1)
+        self.assertEqual(hw.num_local_hadds(num_cpus * 4), num_cpus)
+        self.assertEqual(hw.num_local_hadds(num_cpus, 2), max(1, num_cpus // 2))
+        self.assertEqual(hw.num_local_hadds(num_cpus, num_cpus * 2), 1)
+
+    def test_use_local_hadd(self):
+        sizes = dict((f, 1000) for f in self.files)
+        self.assertTrue(hw.use_local_hadd(sizes, 5000, 5))
+        self.assertFalse(hw.use_local_hadd(sizes, 4999, 5))
+        self.assertFalse(hw.use_local_hadd(sizes, 5000, 4))
+
+
+if __name__ == "__main__":
+    unittest.main()